@@ -1,15 +1,37 @@
 """This lensit package contains some convenience functions in its __init__.py for quick startup.
 
+    The covariance, filtering and simulation modules (and pyfftw and the Fortran extensions with them) are only
+    imported once needed, by the factory functions below or on first access to one of the subpackages.
+    Module attribute lookups are only customisable from python 3.7 on: older interpreters import them all eagerly.
+
 """
 from __future__ import print_function
 
 import numpy as np
 import os
+import sys
+import importlib
 
-from lensit.ffs_covs import ffs_cov, ell_mat
-from lensit.sims import ffs_phas, ffs_maps, ffs_cmbs
 from lensit.pbs import pbs
-from lensit.misc.misc_utils import enumerate_progress, camb_clfile, gauss_beam
+from lensit.misc.misc_utils import camb_clfile, gauss_beam
+
+_subpackages = ['benchmarks', 'bicubic', 'ffs_covs', 'ffs_deflect', 'ffs_iterators', 'ffs_qlms', 'misc', 'pseudocls', 'qcinv', 'sims']
+_modules = {'ffs_cov': 'ffs_covs.ffs_cov', 'ell_mat': 'ffs_covs.ell_mat',
+            'ffs_phas': 'sims.ffs_phas', 'ffs_maps': 'sims.ffs_maps', 'ffs_cmbs': 'sims.ffs_cmbs'}
+_fidcls = {}  # CAMB files parsed so far
+
+
+def __getattr__(name):
+    """Lazy access to the subpackages (e.g. *lensit.qcinv*) and to the modules *import lensit* used to import.
+
+        Any of these also imports all of the latter, for scripts relying on them.
+
+    """
+    if name in _subpackages or name in _modules:
+        for mod in _modules.values():
+            importlib.import_module('lensit.' + mod)
+        return importlib.import_module('lensit.' + _modules.get(name, name))
+    raise AttributeError("module 'lensit' has no attribute '%s'" % name)
 
 
 def _get_lensitdir():
@@ -30,22 +52,31 @@ def get_fidcls(ellmax_sky=6000):
 
     """
     cls_unl = {}
-    cls_unlr = camb_clfile(os.path.join(_get_lensitdir()[1], 'fiducial_flatsky_lenspotentialCls.dat'))
+    cls_unlr = _load_fidcls('fiducial_flatsky_lenspotentialCls.dat')
     for key in cls_unlr.keys():
-        cls_unl[key] = cls_unlr[key][0:ellmax_sky + 1]
-        if key == 'pp': cls_unl[key] = cls_unlr[key][:]  # might need this one to higher lmax
+        cls_unl[key] = cls_unlr[key][0:ellmax_sky + 1].copy()
+        if key == 'pp': cls_unl[key] = cls_unlr[key][:].copy()  # might need this one to higher lmax
     cls_len = {}
-    cls_lenr = camb_clfile(os.path.join(_get_lensitdir()[1], 'fiducial_flatsky_lensedCls.dat'))
+    cls_lenr = _load_fidcls('fiducial_flatsky_lensedCls.dat')
     for key in cls_lenr.keys():
-        cls_len[key] = cls_lenr[key][0:ellmax_sky + 1]
+        cls_len[key] = cls_lenr[key][0:ellmax_sky + 1].copy()
     return cls_unl, cls_len
 
 
+def _load_fidcls(fname):
+    """CAMB file in the lensit cls directory, parsed only once per process.
+
+    """
+    if fname not in _fidcls:
+        _fidcls[fname] = camb_clfile(os.path.join(_get_lensitdir()[1], fname))
+    return _fidcls[fname]
+
+
 def get_fidtenscls(ellmax_sky=6000):
     cls = {}
-    cls_tens = camb_clfile(os.path.join(_get_lensitdir()[1], 'fiducial_tensCls.dat'))
+    cls_tens = _load_fidcls('fiducial_tensCls.dat')
     for key in cls_tens.keys():
-        cls[key] = cls_tens[key][0:ellmax_sky + 1]
+        cls[key] = cls_tens[key][0:ellmax_sky + 1].copy()
     return cls
 
 def get_ellmat(LD_res, HD_res):
@@ -59,6 +90,7 @@ def get_ellmat(LD_res, HD_res):
     The patch area is :math:`4\pi` if *HD_res* = 14
 
     """
+    from lensit.ffs_covs import ell_mat
     assert HD_res <= 14 and LD_res <= 14, (LD_res, HD_res)
     lcell_rad = (np.sqrt(4. * np.pi) / 2 ** 14) * (2 ** (HD_res - LD_res))
     shape = (2 ** LD_res, 2 ** LD_res)
@@ -67,7 +99,8 @@ def get_ellmat(LD_res, HD_res):
     return ell_mat.ell_mat(lib_dir, shape, lsides)
 
 
-def get_lencmbs_lib(res=14, cache_sims=True, nsims=120, num_threads=int(os.environ.get('OMP_NUM_THREADS', 1))):
+def get_lencmbs_lib(res=14, cache_sims=True, nsims=120, num_threads=int(os.environ.get('OMP_NUM_THREADS', 1)),
+                    seed=None):
     r"""Default lensed CMB simulation library
 
     Lensing is always performed at resolution of :math:`0.75` arcmin
@@ -77,29 +110,31 @@ def get_lencmbs_lib(res=14, cache_sims=True, nsims=120, num_threads=int(os.envir
         cache_sims: saves the lensed CMBs when produced for the first time
         nsims: number of simulations in the library
         num_threads: number of threads used by the pyFFTW fft-engine.
+        seed: seed of the random phases (defaults to one derived from the library location)
 
     Note:
         All simulations random phases will be generated at the very first call if not performed previously; this might take some time
 
     """
+    from lensit.ffs_covs import ell_mat
+    from lensit.sims import ffs_phas, ffs_cmbs, sims_generic
     HD_ellmat = get_ellmat(res, HD_res=res)
     ellmax_sky = 6000
     fsky = int(np.round(np.prod(HD_ellmat.lsides) / 4. / np.pi * 1000.))
     lib_skyalm = ell_mat.ffs_alm_pyFFTW(HD_ellmat, num_threads=num_threads,
                                                  filt_func=lambda ell: ell <= ellmax_sky)
-    skypha_libdir = os.path.join(_get_lensitdir()[0], 'temp', '%s_sims' % nsims, 'fsky%04d' % fsky, 'len_alms', 'skypha')
-    skypha = ffs_phas.ffs_lib_phas(skypha_libdir, 4, lib_skyalm, nsims_max=nsims)
-    if not skypha.is_full() and pbs.rank == 0:
-        for i, idx in enumerate_progress(np.arange(nsims, dtype=int), label='Generating CMB phases'):
-            skypha.get_sim(int(idx))
-    pbs.barrier()
+    skypha_relpath = os.path.join('temp', '%s_sims' % nsims, 'fsky%04d' % fsky, 'len_alms', 'skypha')
+    if seed is None: seed = sims_generic.path_seed(skypha_relpath)
+    skypha = ffs_phas.ffs_lib_phas(os.path.join(_get_lensitdir()[0], skypha_relpath), 4, lib_skyalm, nsims_max=nsims,
+                                   seed=seed)
+    skypha.generate(nsims, label='Generating CMB phases')
     cls_unl, cls_len = get_fidcls(ellmax_sky=ellmax_sky)
     sims_libdir = os.path.join(_get_lensitdir()[0], 'temp', '%s_sims' % nsims, 'fsky%04d' % fsky, 'len_alms')
     return ffs_cmbs.sims_cmb_len(sims_libdir, lib_skyalm, cls_unl, lib_pha=skypha, cache_lens=cache_sims)
 
 
 def get_maps_lib(exp, LDres, HDres=14, cache_lenalms=True, cache_maps=False,
-                 nsims=120, num_threads=int(os.environ.get('OMP_NUM_THREADS', 1))):
+                 nsims=120, num_threads=int(os.environ.get('OMP_NUM_THREADS', 1)), seed=None):
     r"""Default CMB data maps simulation library
 
     Args:
@@ -110,29 +145,31 @@ def get_maps_lib(exp, LDres, HDres=14, cache_lenalms=True, cache_maps=False,
         cache_maps: saves the data maps when produced for the first time (defaults to False)
         nsims: number of simulations in the library
         num_threads: number of threads used by the pyFFTW fft-engine.
+        seed: seed of the noise random phases (defaults to one derived from the library location).
+              The CMB phases are those of *get_lencmbs_lib*
 
     Note:
         All simulations random phases (CMB sky and noise) will be generated at the very first call if not performed previously; this might take some time
 
     """
+    from lensit.ffs_covs import ell_mat
+    from lensit.sims import ffs_phas, ffs_maps, sims_generic
     sN_uKamin, sN_uKaminP, Beam_FWHM_amin, ellmin, ellmax = get_config(exp)
     len_cmbs = get_lencmbs_lib(res=HDres, cache_sims=cache_lenalms, nsims=nsims)
     lmax_sky = len_cmbs.lib_skyalm.ellmax
     cl_transf = gauss_beam(Beam_FWHM_amin / 60. * np.pi / 180., lmax=lmax_sky)
-    lib_datalm = ffs_covs.ell_mat.ffs_alm_pyFFTW(get_ellmat(LDres, HDres), filt_func=lambda ell: ell <= lmax_sky,
+    lib_datalm = ell_mat.ffs_alm_pyFFTW(get_ellmat(LDres, HDres), filt_func=lambda ell: ell <= lmax_sky,
                                                  num_threads=num_threads)
     fsky = int(np.round(np.prod(len_cmbs.lib_skyalm.ell_mat.lsides) / 4. / np.pi * 1000.))
     vcell_amin2 = np.prod(lib_datalm.ell_mat.lsides) / np.prod(lib_datalm.ell_mat.shape) * (180 * 60. / np.pi) ** 2
     nTpix = sN_uKamin / np.sqrt(vcell_amin2)
     nPpix = sN_uKaminP / np.sqrt(vcell_amin2)
 
-    pixpha_libdir = os.path.join(_get_lensitdir()[0], 'temp', '%s_sims' % nsims, 'fsky%04d' % fsky, 'res%s' % LDres, 'pixpha')
-    pixpha = ffs_phas.pix_lib_phas(pixpha_libdir, 3, lib_datalm.ell_mat.shape, nsims_max=nsims)
-
-    if not pixpha.is_full() and pbs.rank == 0:
-        for _i, idx in enumerate_progress(np.arange(nsims), label='Generating Noise phases'):
-            pixpha.get_sim(idx)
-    pbs.barrier()
+    pixpha_relpath = os.path.join('temp', '%s_sims' % nsims, 'fsky%04d' % fsky, 'res%s' % LDres, 'pixpha')
+    if seed is None: seed = sims_generic.path_seed(pixpha_relpath)
+    pixpha = ffs_phas.pix_lib_phas(os.path.join(_get_lensitdir()[0], pixpha_relpath), 3, lib_datalm.ell_mat.shape,
+                                   nsims_max=nsims, seed=seed)
+    pixpha.generate(nsims, label='Generating Noise phases')
     sims_libdir = os.path.join(_get_lensitdir()[0], 'temp', '%s_sims'%nsims,'fsky%04d'%fsky, 'res%s'%LDres,'%s'%exp, 'maps')
     return ffs_maps.lib_noisemap(sims_libdir, lib_datalm, len_cmbs, cl_transf, nTpix, nPpix, nPpix,
                                       pix_pha=pixpha, cache_sims=cache_maps)
@@ -148,6 +185,7 @@ def get_isocov(exp, LD_res, HD_res=14, pyFFTWthreads=int(os.environ.get('OMP_NUM
 
 
     """
+    from lensit.ffs_covs import ffs_cov, ell_mat
     ellmax_sky = 6000
     sN_uKamin, sN_uKaminP, Beam_FWHM_amin, ellmin, ellmax = get_config(exp)
     cls_unl, cls_len = get_fidcls(ellmax_sky=ellmax_sky)
@@ -239,3 +277,10 @@ def get_config(exp):
         assert 0, '%s not implemented' % exp
     sN_uKaminP = sN_uKaminP or np.sqrt(2.) * sN_uKamin
     return sN_uKamin, sN_uKaminP, Beam_FWHM_amin, ellmin, ellmax
+
+
+if sys.version_info < (3, 7):  # no module __getattr__
+    for _name in _modules.keys():
+        globals()[_name] = importlib.import_module('lensit.' + _modules[_name])
+    for _name in _subpackages:
+        importlib.import_module('lensit.' + _name)
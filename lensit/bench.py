@@ -0,0 +1,52 @@
+"""Benchmarks of the lensit hot paths (see *lensit.benchmarks*)
+
+    Usage:
+        python -m lensit.bench run [--res 8,9 10,11] [--only alm2map cd_solve] [--repeat 3] [-o results.json]
+        python -m lensit.bench compare results_old.json results_new.json
+        python -m lensit.bench list
+
+"""
+from __future__ import print_function
+
+import argparse
+
+from lensit.benchmarks import runner
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m lensit.bench', description='lensit benchmarks')
+    sub = parser.add_subparsers(dest='command')
+    prun = sub.add_parser('run', help='runs the benchmarks')
+    prun.add_argument('--res', nargs='+', default=['8,9'], help='LDres,HDres resolutions (default 8,9)')
+    prun.add_argument('--only', nargs='+', default=None, help='names of the benchmarks to run (default all)')
+    prun.add_argument('--exp', default='S4', help='experimental configuration (default S4)')
+    prun.add_argument('--repeat', type=int, default=3, help='number of timed calls (default 3)')
+    prun.add_argument('--warmup', type=int, default=1, help='number of untimed calls (default 1)')
+    prun.add_argument('-o', '--output', default=None, help='JSON results file')
+    pcomp = sub.add_parser('compare', help='compares two JSON results files')
+    pcomp.add_argument('old')
+    pcomp.add_argument('new')
+    pcomp.add_argument('--threshold', type=float, default=0.1, help='flagged relative change (default 0.1)')
+    sub.add_parser('list', help='lists the benchmarks')
+    args = parser.parse_args(args)
+
+    if args.command == 'run':
+        resolutions = [tuple(int(r) for r in res.split(',')) for res in args.res]
+        for res in resolutions:
+            assert len(res) == 2, ('resolutions must be given as LDres,HDres', args.res)
+        results = runner.run(args.only, resolutions=resolutions, exp=args.exp, repeat=args.repeat,
+                             warmup=args.warmup)
+        if args.output is not None:
+            runner.dump(results, args.output)
+            print('** bench: results written to ' + args.output)
+    elif args.command == 'compare':
+        print(runner.compare(runner.load(args.old), runner.load(args.new), threshold=args.threshold))
+    elif args.command == 'list':
+        from lensit.benchmarks import hotpaths
+        print('\n'.join(hotpaths.benchmarks.keys()))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
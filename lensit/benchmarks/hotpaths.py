@@ -0,0 +1,262 @@
+"""Benchmarks of the lensit hot paths.
+
+    Each benchmark is a function of a *setup* instance, returning the callable to time. The setup work (simulations,
+    filters, chains...) is done beforehand and excluded from the timings. A callable may return a dictionary of
+    additional information on the run (e.g. the number of conjugate-gradient iterations).
+
+    A benchmark may instead return a (prepare, callable) pair, to time calls that need some fresh state each time:
+    prepare() is then called, untimed, before each call, and its output passed to the callable.
+
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+import lensit as li
+from lensit.ffs_covs import ell_mat, ffs_cov
+from lensit.ffs_deflect import ffs_deflect
+from lensit.qcinv import multigrid, chain_samples, ffs_ninv_filt_ideal, opfilt_cinv_noBB
+from lensit.misc.misc_utils import gauss_beam
+
+
+def _cli(cl):
+    return np.where(cl > 0, 1. / np.where(cl > 0, cl, 1.), 0.)
+
+
+def get_starting_point(isocov, datalms):
+    """Normalised and Wiener-filtered polarization quadratic estimate, starting point of the iterations
+
+        The lensing potential is reconstructed on all unlensed sky modes (*isocov.lib_skyalm*).
+
+        Returns:
+            plm0, the curvature guesses H0 (from N0 with unlensed spectra) and H0len (lensed spectra), and the prior
+
+    """
+    lib_qlm = isocov.lib_skyalm
+    cpp_prior = li.get_fidcls()[0]['pp'][:lib_qlm.ellmax + 1]
+    H0len = _cli(isocov.get_N0cls('QU', lib_qlm, use_cls_len=True)[0])
+    H0 = _cli(isocov.get_N0cls('QU', lib_qlm, use_cls_len=False)[0])
+    plm0 = 0.5 * isocov.get_qlms('QU', isocov.get_iblms('QU', datalms, use_cls_len=True)[0], lib_qlm,
+                                 use_cls_len=True)[0]
+    lib_qlm.almxfl(plm0, _cli(H0len + _cli(cpp_prior)), inplace=True)
+    return plm0, H0, H0len, cpp_prior
+
+
+def get_filt(lib_datalm, beam_fwhmamin, nlev_t, nlev_p=None, ellmax_sky=6000):
+    """Filter with unlensed spectra and homogeneous noise, and the diagonal-preconditioner chain to invert it
+
+    """
+    lib_skyalm = ell_mat.ffs_alm_pyFFTW(lib_datalm.ell_mat, filt_func=lambda ell: ell <= ellmax_sky)
+    transf = gauss_beam(beam_fwhmamin / 180. / 60. * np.pi, lmax=ellmax_sky)
+    filt = ffs_ninv_filt_ideal.ffs_ninv_filt(lib_datalm, lib_skyalm, li.get_fidcls(ellmax_sky)[0], transf,
+                                             nlev_t, nlev_p)
+    return filt, chain_samples.get_isomgchain(filt.lib_skyalm.ellmax, filt.lib_datalm.shape, tol=1e-6, iter_max=200)
+
+
+def get_itlib(lib_dir, filt, chain_descr, datalms, lib_qlm, plm0, H0, cpp_prior, verbose=False, **kwargs):
+    """Polarization iterator with perturbative mean-field (*kwargs* are passed to *ffs_iterator_pertMF*)
+
+    """
+    from lensit.ffs_iterators.ffs_iterator import ffs_iterator_pertMF
+    opfilt_cinv_noBB._type = 'QU'
+    return ffs_iterator_pertMF(lib_dir, 'QU', filt, datalms, lib_qlm, plm0, H0, cpp_prior, chain_descr=chain_descr,
+                               opfilt=opfilt_cinv_noBB, verbose=verbose, **kwargs)
+
+
+class setup(object):
+    """Objects entering the benchmarks, built only once needed.
+
+        Args:
+            LDres: the data is sampled with :math:`2^{\\rm LDres}` points on a side
+            HDres: the physical size of the patch is :math:`\\sim 0.74 \\cdot 2^{\\rm HDres}` arcmin
+            exp: experimental configuration (see *lensit.get_config*)
+
+    """
+    def __init__(self, LDres, HDres, exp='S4'):
+        self.LDres = LDres
+        self.HDres = HDres
+        self.exp = exp
+        self._cache = {}
+        self._lib_dirs = []
+
+    def _get(self, name, func):
+        if name not in self._cache:
+            self._cache[name] = func()
+        return self._cache[name]
+
+    def get_isocov(self):
+        return self._get('isocov', lambda: li.get_isocov(self.exp, self.LDres, self.HDres))
+
+    def get_lib_qlm(self):
+        return self.get_isocov().lib_skyalm
+
+    def get_maps_lib(self):
+        return self._get('maps_lib', lambda: li.get_maps_lib(self.exp, self.LDres, self.HDres, nsims=1))
+
+    def get_datalms(self):
+        isocov = self.get_isocov()
+        return self._get('datalms', lambda: np.array([isocov.lib_datalm.map2alm(m)
+                                                      for m in self.get_maps_lib().get_sim_qumap(0)]))
+
+    def get_iblms(self):
+        return self._get('iblms', lambda: self.get_isocov().get_iblms('QU', self.get_datalms(), use_cls_len=True)[0])
+
+    def get_displacement(self):
+        """Displacement of the input lensing potential of the simulation, at the data resolution
+
+        """
+        def build():
+            len_cmbs = self.get_maps_lib().lencmbs
+            plm = self.get_lib_qlm().udgrade(len_cmbs.lib_skyalm, len_cmbs.get_sim_plm(0))
+            return ffs_deflect.displacement_fromplm(self.get_lib_qlm(), plm, verbose=False)
+        return self._get('f', build)
+
+    def _get_filt_chain(self):
+        def build():
+            sN_uKamin, sN_uKaminP, Beam_FWHM_amin, ellmin, ellmax = li.get_config(self.exp)
+            return get_filt(self.get_isocov().lib_datalm, Beam_FWHM_amin, sN_uKamin, sN_uKaminP)
+        return self._get('filt_chain', build)
+
+    def get_filt(self):
+        return self._get_filt_chain()[0]
+
+    def get_lensed_filt(self):
+        """Filter including the displacement of the simulation
+
+        """
+        f = self.get_displacement()
+        return self._get('lensed_filt', lambda: self.get_filt().turn2wlfilt(f, f.get_inverse()))
+
+    def get_chain_descr(self):
+        return self._get_filt_chain()[1]
+
+    def get_opfilt(self):
+        opfilt_cinv_noBB._type = 'QU'
+        return opfilt_cinv_noBB
+
+    def get_starting_point(self):
+        return self._get('starting_point', lambda: get_starting_point(self.get_isocov(), self.get_datalms()))
+
+    def mkdtemp(self):
+        """New temporary directory, removed by *cleanup*
+
+        """
+        temp = os.path.join(li._get_lensitdir()[0], 'temp')
+        if not os.path.exists(temp): os.makedirs(temp)
+        lib_dir = tempfile.mkdtemp(prefix='bench_', dir=temp)
+        self._lib_dirs.append(lib_dir)
+        return lib_dir
+
+    def new_itlib(self, lib_dir):
+        plm0, H0, H0len, cpp_prior = self.get_starting_point()
+        return get_itlib(lib_dir, self.get_filt(), self.get_chain_descr(), self.get_datalms(), self.get_lib_qlm(),
+                         plm0, H0, cpp_prior)
+
+    def get_itlib(self):
+        """Iterator in a temporary directory, holding only its starting point
+
+        """
+        return self._get('itlib', lambda: self.new_itlib(os.path.join(self.mkdtemp(), 'it')))
+
+    def cleanup(self):
+        """Removes the directories written by the benchmarks
+
+        """
+        for lib_dir in self._lib_dirs:
+            if os.path.exists(lib_dir): shutil.rmtree(lib_dir)
+        self._lib_dirs = []
+
+
+def bench_alm2map(s):
+    lib_datalm = s.get_isocov().lib_datalm
+    alm = s.get_datalms()[0]
+    return lambda: lib_datalm.alm2map(alm)
+
+
+def bench_map2alm(s):
+    lib_datalm = s.get_isocov().lib_datalm
+    m = s.get_maps_lib().get_sim_qumap(0)[0]
+    return lambda: lib_datalm.map2alm(m)
+
+
+def bench_lens_map(s):
+    f = s.get_displacement()
+    m = s.get_maps_lib().get_sim_qumap(0)[0]
+    return lambda: f.lens_map(m)
+
+
+def bench_get_inverse(s):
+    f = s.get_displacement()
+    return lambda: f.get_inverse()
+
+
+def bench_cd_solve(s):
+    mchain = multigrid.multigrid_chain(s.get_opfilt(), 'QU', s.get_chain_descr(), s.get_lensed_filt())
+    datalms = s.get_datalms()
+    def solve():
+        soltn = np.zeros((s.get_opfilt().TEBlen('QU'), mchain.cov.lib_skyalm.alm_size), dtype=complex)
+        info = {'iterations': 0}
+        def logger(it, eps, **kwargs):
+            info['iterations'] += 1
+        mchain.solve(soltn, datalms, finiop='MLIK', logger=logger)
+        return info
+    return solve
+
+
+def _bench_N0cls(s, typ):
+    """N0 calculation on a fresh copy of the isotropic covariance at each call, which would otherwise read its cache
+
+    """
+    isocov = s.get_isocov()
+    lib_qlm = s.get_lib_qlm()
+    def prepare():
+        return ffs_cov.ffs_diagcov_alm(s.mkdtemp(), isocov.lib_datalm, isocov.cls_unl, isocov.cls_len,
+                                       isocov.cl_transf, isocov.cls_noise, lib_skyalm=isocov.lib_skyalm)
+    def get_N0cls(cov):
+        cov.get_N0cls(typ, lib_qlm, use_cls_len=True)
+    return prepare, get_N0cls
+
+
+def bench_get_N0cls(s):
+    return _bench_N0cls(s, 'QU')
+
+
+def bench_get_N0cls_TQU(s):
+    return _bench_N0cls(s, 'TQU')
+
+
+def bench_get_qlms(s):
+    isocov = s.get_isocov()
+    lib_qlm = s.get_lib_qlm()
+    iblms = s.get_iblms()
+    return lambda: isocov.get_qlms('QU', iblms, lib_qlm, use_cls_len=True)
+
+
+def bench_iteration(s):
+    """First iteration (it=1), on a fresh copy of the directory of the initial iterator at each call
+
+    """
+    base = s.get_itlib()
+    def prepare():
+        lib_dir = os.path.join(s.mkdtemp(), 'it')
+        shutil.copytree(base.lib_dir, lib_dir)
+        return s.new_itlib(lib_dir)
+    def iterate(itlib):
+        itlib.iterate(1, 'p')
+    return prepare, iterate
+
+
+benchmarks = OrderedDict([('alm2map', bench_alm2map),
+                          ('map2alm', bench_map2alm),
+                          ('lens_map', bench_lens_map),
+                          ('get_inverse', bench_get_inverse),
+                          ('cd_solve', bench_cd_solve),
+                          ('get_N0cls', bench_get_N0cls),
+                          ('get_N0cls_TQU', bench_get_N0cls_TQU),
+                          ('get_qlms', bench_get_qlms),
+                          ('iteration', bench_iteration)])
@@ -0,0 +1,136 @@
+"""Timing of the benchmarks of *lensit.benchmarks.hotpaths*, JSON results files and their comparison.
+
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import socket
+import platform
+import subprocess
+
+import numpy as np
+
+from lensit.pbs import pbs
+
+
+def get_metadata():
+    """Machine and software description stored together with the timings
+
+    """
+    ret = {'host': socket.gethostname(), 'platform': platform.platform(), 'machine': platform.machine(),
+           'processor': platform.processor(), 'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+           'python': platform.python_version(), 'numpy': np.__version__,
+           'OMP_NUM_THREADS': os.environ.get('OMP_NUM_THREADS', None), 'mpi_size': pbs.size,
+           'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    try:
+        import pyfftw
+        ret['pyfftw'] = pyfftw.__version__
+    except (ImportError, AttributeError):
+        ret['pyfftw'] = None
+    try:
+        ret['git'] = subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.STDOUT,
+                                             cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        ret['git'] = None
+    return ret
+
+
+def timeit(func, repeat=3, warmup=1):
+    """Wall times of *repeat* calls to *func*, after *warmup* untimed calls (e.g. fft plans)
+
+        *func* may also be a (prepare, func) pair: prepare() is then called untimed before each call, and its output
+        passed to func.
+
+        Returns:
+            dictionary with the times, their minimum, median and mean, and the information returned by the last call
+
+    """
+    prepare = None
+    if isinstance(func, tuple): prepare, func = func
+    times = []
+    info = {}
+    for i in range(warmup + repeat):
+        args = () if prepare is None else (prepare(),)
+        t0 = time.time()
+        ret = func(*args)
+        if i < warmup: continue
+        times.append(time.time() - t0)
+        if isinstance(ret, dict): info = ret
+    return {'times': times, 'min': np.min(times), 'median': np.median(times), 'mean': np.mean(times), 'info': info}
+
+
+def run(names=None, resolutions=((8, 9),), exp='S4', repeat=3, warmup=1, verbose=True):
+    """Runs the benchmarks
+
+        Args:
+            names: names of the benchmarks to run (defaults to all of them)
+            resolutions: list of (LDres, HDres) resolutions (see *lensit.get_isocov*)
+            exp: experimental configuration (see *lensit.get_config*)
+            repeat: number of timed calls per benchmark
+            warmup: number of untimed calls per benchmark
+
+        Returns:
+            dictionary with the metadata, the parameters of the run and the list of results
+
+    """
+    from lensit.benchmarks import hotpaths
+    if names is None: names = list(hotpaths.benchmarks.keys())
+    for name in names:
+        assert name in hotpaths.benchmarks, (name, list(hotpaths.benchmarks.keys()))
+    results = []
+    for LDres, HDres in resolutions:
+        s = hotpaths.setup(LDres, HDres, exp=exp)
+        try:
+            for name in names:
+                t0 = time.time()
+                func = hotpaths.benchmarks[name](s)
+                res = timeit(func, repeat=repeat, warmup=warmup)
+                res.update({'name': name, 'LDres': LDres, 'HDres': HDres, 'setup': time.time() - t0 - np.sum(res['times'])})
+                results.append(res)
+                if verbose:
+                    print('** bench %-12s res %s %s : min %.4f s, median %.4f s' % (name, LDres, HDres, res['min'], res['median']))
+        finally:
+            s.cleanup()
+    return {'metadata': get_metadata(), 'params': {'exp': exp, 'repeat': repeat, 'warmup': warmup}, 'results': results}
+
+
+def dump(results, fname):
+    with open(fname, 'w') as file:
+        json.dump(results, file, indent=1)
+        file.close()
+
+
+def load(fname):
+    with open(fname, 'r') as file:
+        return json.load(file)
+
+
+def compare(results1, results2, threshold=0.1):
+    """Comparison table of two benchmark runs, as a string.
+
+        Benchmarks are matched by name and resolutions, and compared with their minimal times. Changes larger than
+        *threshold* (relative) are flagged.
+
+    """
+    def key(res):
+        return (res['name'], res['LDres'], res['HDres'])
+    res1 = {key(res): res for res in results1['results']}
+    lines = []
+    for label, results in [('old', results1), ('new', results2)]:
+        meta = results['metadata']
+        lines.append('%s: %s, %s, %s cpus, git %s, %s' % (label, meta['host'], meta['platform'], meta['cpu_count'],
+                                                          meta['git'], meta['time']))
+    lines.append('%-14s %8s %12s %12s %8s' % ('benchmark', 'res', 'old [s]', 'new [s]', 'new/old'))
+    for res in results2['results']:
+        if key(res) not in res1: continue
+        t1, t2 = res1[key(res)]['min'], res['min']
+        ratio = t2 / max(t1, 1e-10)
+        flag = 'slower' if ratio > 1. + threshold else ('faster' if ratio < 1. - threshold else '')
+        lines.append('%-14s %8s %12.4f %12.4f %8.2f %s' % (res['name'], '%s,%s' % (res['LDres'], res['HDres']),
+                                                            t1, t2, ratio, flag))
+    missing = [k for k in res1.keys() if k not in [key(res) for res in results2['results']]]
+    if len(missing) > 0:
+        lines.append('not in new results: ' + ', '.join(['%s (%s,%s)' % k for k in missing]))
+    return '\n'.join(lines)
@@ -103,3 +103,51 @@ subroutine deflect_inverse(exo, eyo, ex, ey, dx, dy, minv_xx, minv_yy, minv_xy,
 
 end subroutine deflect_inverse
 
+real function cubicfilter_sp(x, c0, c1, c2, c3)
+    ! single precision version of cubicfilter
+    real x, c0, c1, c2, c3
+    real w0, w1, w2, w3
+    w0 = x*(x*(-x + 3.) - 3.) + 1.
+    w1 = x*x*(3.*x - 6.) + 4.;
+    w2 =  x*(x*(-3.*x + 3.) + 3.) + 1.
+    w3 =  x*x*x
+    cubicfilter_sp = (c0 * w0 + c1 * w1 + c2 * w2 + c3 * w3) * 0.16666667
+end
+
+real function eval_sp(ftl_map, fx, fy, nx, ny)
+    ! single precision version of eval, for single precision maps and double precision coordinates
+    implicit none
+    real, intent(in) :: ftl_map(0:ny-1, 0:nx-1)
+    double precision, intent(in) :: fx, fy
+    integer, intent(in) :: nx, ny
+    real, external :: cubicfilter_sp
+    real gx, gy, c(0:3)
+    integer px, py, i, j, xi(0:3), yj
+
+    px = floor(fx)
+    py = floor(fy)
+    gx = real(fx - px)
+    gy = real(fy - py)
+    do i = 0, 3
+        xi(i) = modulo(px - 1 + i, nx)
+    end do
+    do j = 0, 3
+        yj = modulo(py - 1 + j, ny)
+        c(j) = cubicfilter_sp(gx, ftl_map(yj, xi(0)), ftl_map(yj, xi(1)), ftl_map(yj, xi(2)), ftl_map(yj, xi(3)))
+    end do
+    eval_sp = cubicfilter_sp(gy, c(0), c(1), c(2), c(3))
+end
+
+subroutine deflect_sp(output, ftl_map, fx, fy, nx, ny, npts)
+    ! single precision version of deflect. Coordinates are kept in double precision.
+    implicit none
+    real, intent(in) :: ftl_map(0:ny-1,0:nx-1)
+    double precision, intent(in) :: fx(0:npts-1), fy(0:npts-1)
+    real, intent(out) :: output(0:npts-1)
+    real, external :: eval_sp
+    integer, intent(in) :: nx, ny, npts
+    integer i
+    do i = 0, npts - 1
+        output(i) = eval_sp(ftl_map, fx(i), fy(i), nx, ny)
+    end do
+end subroutine deflect_sp
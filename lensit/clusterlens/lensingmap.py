@@ -1,8 +1,8 @@
 from lensit.clusterlens.profile import  profile
 import numpy as np
-from lensit import ell_mat, pbs
-from lensit.sims import ffs_phas, ffs_cmbs, ffs_maps
-from lensit.misc.misc_utils import enumerate_progress, gauss_beam
+from lensit import ell_mat
+from lensit.sims import ffs_phas, ffs_cmbs, ffs_maps, sims_generic
+from lensit.misc.misc_utils import gauss_beam
 from lensit.ffs_deflect import ffs_deflect
 import lensit as li
 from os.path import join as opj
@@ -17,7 +17,7 @@ def get_cluster_libdir(cambinifile, profilename, npix, lpix_amin, ellmax_sky, M2
 
 
 class cluster_maps(object):
-    def __init__(self, libdir:str, npix:int, lpix_amin:float, nsims:int, cosmo:CAMBdata, profparams:dict, profilename='nfw', ellmax_sky = 6000, cmb_exp='5muKamin_1amin', cache_maps=False):
+    def __init__(self, libdir:str, npix:int, lpix_amin:float, nsims:int, cosmo:CAMBdata, profparams:dict, profilename='nfw', ellmax_sky = 6000, cmb_exp='5muKamin_1amin', cache_maps=False, seed=None):
         """Library for flat-sky CMB simulations lensed by a galaxy cluster.
 
         Args:
@@ -29,6 +29,7 @@ class cluster_maps(object):
             profparams: dict containing the parameters defining the profile 
             profilename: string defining the density profile of the cluster (e.g. nfw)
             ellmax_sky: maximum multipole of CMB spectra used to generate the CMB maps 
+            seed: seed of the CMB and noise random phases (defaults to one derived from libdir)
     """
         self.libdir = libdir
         self.cosmo = cosmo
@@ -56,11 +57,9 @@ class cluster_maps(object):
         
         # Generate the CMB random phases
         skypha_libdir = opj(self.libdir,  'len_alms', 'skypha')
-        skypha = ffs_phas.ffs_lib_phas(skypha_libdir, nfields, self.lib_skyalm, nsims_max=nsims)
-        if not skypha.is_full() and pbs.rank == 0:
-            for i, idx in enumerate_progress(np.arange(nsims, dtype=int), label='Generating CMB phases'):
-                skypha.get_sim(int(idx))
-        pbs.barrier()
+        if seed is None: seed = sims_generic.path_seed(os.path.abspath(self.libdir))
+        skypha = ffs_phas.ffs_lib_phas(skypha_libdir, nfields, self.lib_skyalm, nsims_max=nsims, seed=(seed, 1))
+        skypha.generate(nsims, label='Generating CMB phases')
 
         self.haloprofile = profile(self.cosmo, profilename)
 
@@ -83,11 +82,8 @@ class cluster_maps(object):
 
         # Generate the noise random phases
         pixpha_libdir = opj(self.libdir, 'pixpha')
-        pixpha = ffs_phas.pix_lib_phas(pixpha_libdir, 3, self.lib_datalm.ell_mat.shape, nsims_max=nsims)
-        if not pixpha.is_full() and pbs.rank == 0:
-            for _i, idx in enumerate_progress(np.arange(nsims), label='Generating Noise phases'):
-                pixpha.get_sim(idx)
-        pbs.barrier()
+        pixpha = ffs_phas.pix_lib_phas(pixpha_libdir, 3, self.lib_datalm.ell_mat.shape, nsims_max=nsims, seed=(seed, 2))
+        pixpha.generate(nsims, label='Generating Noise phases')
         maps_libdir = opj(self.libdir, 'maps')
 
         self.maps_lib = ffs_maps.lib_noisemap(maps_libdir, self.lib_datalm, self.len_cmbs, cl_transf, nTpix, nPpix, nPpix,
@@ -12,6 +12,20 @@ from lensit.misc.rfft2_utils import udgrade_rfft2, supersample
 from lensit.pbs import pbs
 
 
+def _rtype(arr):
+    """Real floating point type matching the precision of the input array.
+
+    """
+    return np.float32 if arr.dtype in (np.float32, np.complex64) else np.float64
+
+
+def _ctype(arr):
+    """Complex floating point type matching the precision of the input array.
+
+    """
+    return np.complex64 if arr.dtype in (np.float32, np.complex64) else np.complex128
+
+
 class ell_mat:
     """Library helping with flat-sky patch discretization and harmonic mode structure.
 
@@ -355,9 +369,11 @@ class ffs_alm(object):
         self.ellmin = np.min(self.reduced_ellmat()) if self.alm_size > 0 else None
 
         # Some trivial convenience factors :
-        self.fac_rfft2alm = np.sqrt(np.prod(ellmat.lsides)) / np.prod(self.ell_mat.shape)
+        self.fac_rfft2alm = float(np.sqrt(np.prod(ellmat.lsides)) / np.prod(self.ell_mat.shape))
         self.fac_alm2rfft = 1. / self.fac_rfft2alm
         self.__ellcounts = None
+        self.__conj_idc = None
+        self.__herm_idc = None
 
     def _cond(self):
         ret =  self.filt_func(self.ell_mat())
@@ -464,13 +480,13 @@ class ffs_alm(object):
 
     def alm2rfft(self, alm):
         assert alm.size == self.alm_size, alm.size
-        ret = np.zeros(self.ell_mat.rshape, dtype=complex)
+        ret = np.zeros(self.ell_mat.rshape, dtype=_ctype(alm))
         ret[self._cond()] = alm * self.fac_alm2rfft
         return ret
 
     def alm2almmap(self, alm):
         assert alm.size == self.alm_size, alm.size
-        ret = np.zeros(self.ell_mat.rshape, dtype=complex)
+        ret = np.zeros(self.ell_mat.rshape, dtype=_ctype(alm))
         ret[self._cond()] = alm
         return ret
 
@@ -485,18 +501,38 @@ class ffs_alm(object):
         else:
             return lib_almout.alm2map(lib_almout.udgrade(self, alm))
 
+    def alms2maps(self, alms):
+        """Returns position-space maps from a stack of alm arrays, performing a single batched transform
+
+        """
+        assert alms.ndim == 2 and alms.shape[1] == self.alm_size, (alms.shape, self.alm_size)
+        rffts = np.zeros((alms.shape[0],) + self.ell_mat.rshape, dtype=_ctype(alms))
+        rffts[:, self._cond()] = alms * self.fac_alm2rfft
+        return np.fft.irfft2(rffts, self.ell_mat.shape)
+
+    def maps2alms(self, maps):
+        """Returns alm arrays of a stack of position-space maps, performing a single batched transform
+
+        """
+        assert maps.ndim == 3 and maps.shape[1:] == self.ell_mat.shape, (maps.shape, self.ell_mat.shape)
+        return self.fac_rfft2alm * np.fft.rfft2(maps)[:, self._cond()]
+
     def almxfl(self, alm, fl, inplace=False):
         """Multiply :flat-sky math:`a_{\ell lm}` array with isotropic function :math:`f_\ell`
 
+            Single precision input arrays are kept single precision.
 
         """
         assert alm.size == self.alm_size, (alm.size, self.alm_size)
         assert len(fl) > self.ellmax
+        fl = fl[self.reduced_ellmat()]
+        if alm.dtype == np.complex64 and not np.iscomplexobj(fl):
+            fl = fl.astype(np.float32)
         if inplace:
-            alm *= fl[self.reduced_ellmat()]
+            alm *= fl
             return
         else:
-            return alm * fl[self.reduced_ellmat()]
+            return alm * fl
 
     def get_Nell(self):
         r"""Mode number counts on the flat-sky patch.
@@ -569,7 +605,7 @@ class ffs_alm(object):
 
         w0 = 6. / (2. * np.cos(2. * np.pi * Freq(np.arange(r0), s0) / s0) + 4.)
         w1 = 6. / (2. * np.cos(2. * np.pi * Freq(np.arange(r1), s1) / s1) + 4.)
-        return alm * self.almmap2alm(np.outer(w0, w1))
+        return alm * self.almmap2alm(np.outer(w0, w1)).astype(_rtype(alm))
 
     def get_kx(self):
         return self.ell_mat.get_kx_mat()[self._cond()]
@@ -587,6 +623,42 @@ class ffs_alm(object):
         cos, sin = self.ell_mat.get_cossin_2iphi_mat()
         return cos[self._cond()], sin[self._cond()]
 
+    def get_conj_idc(self):
+        r"""Indices in the alm array of the :math:`k_x = 0` modes with :math:`k_y \geq 0`, and of their conjugates :math:`-k`.
+
+            Obtained in closed form from the rfft layout (the conjugate of row i is row -i mod N on the first column).
+            The Nyquist row and modes without conjugate in the alm array are excluded.
+
+        """
+        if self.__conj_idc is None:
+            idc = -np.ones(self.ell_mat.rshape, dtype=int)
+            idc[self._cond()] = np.arange(self.alm_size)
+            rows = np.arange(self.shape[0] // 2)
+            pos, neg = idc[rows, 0], idc[(-rows) % self.shape[0], 0]
+            self.__conj_idc = (pos[(pos >= 0) & (neg >= 0)], neg[(pos >= 0) & (neg >= 0)])
+        return self.__conj_idc
+
+    def project_real(self, alm):
+        r"""Projects an alm array onto the modes of real maps, as *map2alm(alm2map(alm))* would, without FFTs.
+
+            On the :math:`k_x = 0` and Nyquist columns of the rfft layout the modes are replaced by
+            :math:`(a_k + a^*_{-k}) / 2`, with :math:`a_{-k} = 0` if :math:`-k` is not part of the alm array.
+
+        """
+        assert alm.size == self.alm_size, alm.size
+        if self.__herm_idc is None:
+            idc = -np.ones(self.ell_mat.rshape, dtype=int)
+            idc[self._cond()] = np.arange(self.alm_size)
+            rows = np.arange(self.shape[0])
+            cols = [0] + [self.ell_mat.rshape[1] - 1] * (self.shape[1] % 2 == 0)
+            pos = np.concatenate([idc[rows, c] for c in cols])
+            neg = np.concatenate([idc[(-rows) % self.shape[0], c] for c in cols])
+            self.__herm_idc = (pos[pos >= 0], neg[pos >= 0])
+        pos, neg = self.__herm_idc
+        ret = alm.copy()
+        ret[pos] = 0.5 * (alm[pos] + np.where(neg >= 0, alm[neg], 0.).conj())
+        return ret
+
     def alm2rlm(self, alm):
         assert alm.size == self.alm_size, alm.size
         return np.concatenate((alm.real, alm.imag))
@@ -597,18 +669,13 @@ class ffs_alm(object):
         return rlm[0:self.alm_size] + 1j * rlm[self.alm_size:]
 
     def alms2rlms(self, alms):
-        assert alms.ndim == 2 and np.all(alm.size == self.alm_size for alm in alms), alms.shape
-        rlms = np.zeros((alms.shape[0] * 2 * self.alm_size,))
-        for i in range(alms.shape[0]):
-            rlms[i * (2 * self.alm_size): (i + 1) * 2 * self.alm_size] = self.alm2rlm(alms[i])
-        return rlms
+        assert alms.ndim == 2 and alms.shape[1] == self.alm_size, alms.shape
+        return np.concatenate((alms.real, alms.imag), axis=1).flatten()
 
     def rlms2alms(self, rlms):
         assert rlms.ndim == 1 and rlms.size % (2 * self.alm_size) == 0, rlms.shape
-        alms = np.zeros((rlms.size / (2 * self.alm_size), self.alm_size), dtype=complex)
-        for i in range(alms.shape[0]):
-            alms[i, :] = self.rlm2alm(rlms[i * (2 * self.alm_size):(i + 1) * 2 * self.alm_size])
-        return alms
+        rlms = rlms.reshape(rlms.size // (2 * self.alm_size), 2, self.alm_size)
+        return rlms[:, 0] + 1j * rlms[:, 1]
 
     def write_alm(self, fname, alm):
         assert alm.size == self.alm_size
@@ -649,6 +716,27 @@ class ffs_alm(object):
         Cl[np.where(self._get_ell_counts())] /= self._get_ell_counts()[np.where(self._get_ell_counts())]
         return Cl[:(ellmax or self.ellmax) + 1]
 
+    def bin_realparts_inell(self, alms, ellmax=None):
+        """Same as *bin_realpart_inell* for a stack of alm arrays of shape (n, alm_size)
+
+        """
+        assert alms.ndim == 2 and alms.shape[1] == self.alm_size, (alms.shape, self.alm_size)
+        ellmax = ellmax or self.ellmax
+        nonred = np.zeros(self.ell_mat.rshape, dtype=bool)
+        nonred[:, 1:self.ell_mat.rshape[1] - 1] = True
+        nonred[0:self.shape[0] // 2 + 1, [-1, 0]] = True
+        ells = self.reduced_ellmat()
+        sel = np.where(nonred[self._cond()] & (ells <= ellmax))[0]
+        idx = (np.arange(alms.shape[0])[:, None] * (ellmax + 1) + ells[sel][None, :]).flatten()
+        Cl = np.bincount(idx, weights=alms[:, sel].real.flatten(), minlength=alms.shape[0] * (ellmax + 1))
+        Cl = Cl.reshape(alms.shape[0], ellmax + 1)
+        counts = np.zeros(ellmax + 1, dtype=float)
+        _counts = self._get_ell_counts()[:ellmax + 1]
+        counts[:len(_counts)] = _counts
+        ii = np.where(counts)
+        Cl[:, ii[0]] /= counts[ii]
+        return Cl
+
     def udgrade(self, lib_alm, alm):
         """Degrades or upgrades a alm vector from this *ffs_alm* instance to another instance.
 
@@ -704,27 +792,47 @@ class ffs_alm_pyFFTW(ffs_alm):
 
     def alm2rfft(self, alm):
         assert alm.size == self.alm_size, alm.size
-        ret = pyfftw.zeros_aligned(self.ell_mat.rshape, dtype='complex128')
+        ret = pyfftw.zeros_aligned(self.ell_mat.rshape, dtype=_ctype(alm))
         ret[self._cond()] = alm * self.fac_alm2rfft
         return ret
 
     def map2rfft(self, _map):
-        inpt = pyfftw.empty_aligned(self.ell_mat.shape, dtype='float64')
-        oupt = pyfftw.empty_aligned(self.ell_mat.rshape, dtype='complex128')
+        # single precision maps are transformed in single precision
+        inpt = pyfftw.empty_aligned(self.ell_mat.shape, dtype=_rtype(_map))
+        oupt = pyfftw.empty_aligned(self.ell_mat.rshape, dtype=_ctype(_map))
         fft = pyfftw.FFTW(inpt, oupt, axes=(0, 1), direction='FFTW_FORWARD', flags=self.flags, threads=self.threads)
-        return fft(pyfftw.byte_align(_map, dtype='float64'))
+        return fft(pyfftw.byte_align(_map, dtype=_rtype(_map)))
 
     def alm2map(self, alm, lib_almout=None):
         assert alm.size == self.alm_size, (alm.size, self.alm_size)
         if lib_almout is None:
-            oupt = pyfftw.empty_aligned(self.ell_mat.shape, dtype='float64')
-            inpt = pyfftw.empty_aligned(self.ell_mat.rshape, dtype='complex128')
+            oupt = pyfftw.empty_aligned(self.ell_mat.shape, dtype=_rtype(alm))
+            inpt = pyfftw.empty_aligned(self.ell_mat.rshape, dtype=_ctype(alm))
 
             ifft = pyfftw.FFTW(inpt, oupt, axes=(0, 1), direction='FFTW_BACKWARD', flags=self.flags, threads=self.threads)
-            return ifft(pyfftw.byte_align(self.alm2rfft(alm), dtype='complex128'))
+            # rfft coefficients written straight into the (planned) input array:
+            inpt[:] = 0.
+            inpt[self._cond()] = alm * self.fac_alm2rfft
+            return ifft()
         else:
             return lib_almout.alm2map(lib_almout.udgrade(self, alm))
 
+    def alms2maps(self, alms):
+        assert alms.ndim == 2 and alms.shape[1] == self.alm_size, (alms.shape, self.alm_size)
+        oupt = pyfftw.empty_aligned((alms.shape[0],) + self.ell_mat.shape, dtype=_rtype(alms))
+        inpt = pyfftw.empty_aligned((alms.shape[0],) + self.ell_mat.rshape, dtype=_ctype(alms))
+        ifft = pyfftw.FFTW(inpt, oupt, axes=(1, 2), direction='FFTW_BACKWARD', flags=self.flags, threads=self.threads)
+        inpt[:] = 0.
+        inpt[:, self._cond()] = alms * self.fac_alm2rfft
+        return ifft()
+
+    def maps2alms(self, maps):
+        assert maps.ndim == 3 and maps.shape[1:] == self.ell_mat.shape, (maps.shape, self.ell_mat.shape)
+        inpt = pyfftw.empty_aligned(maps.shape, dtype=_rtype(maps))
+        oupt = pyfftw.empty_aligned((maps.shape[0],) + self.ell_mat.rshape, dtype=_ctype(maps))
+        fft = pyfftw.FFTW(inpt, oupt, axes=(1, 2), direction='FFTW_FORWARD', flags=self.flags, threads=self.threads)
+        return self.fac_rfft2alm * fft(pyfftw.byte_align(maps, dtype=_rtype(maps)))[:, self._cond()]
+
     def clone(self):
         return ffs_alm_pyFFTW(self.ell_mat, filt_func=self.filt_func, num_threads=self.threads)
 
@@ -4,6 +4,7 @@ import datetime
 import os
 import pickle as pk
 import shutil
+import threading
 
 import numpy as np
 
@@ -12,7 +13,7 @@ from lensit.qcinv import opfilt_cinv, chain_samples, cd_solve, cd_monitors, mult
 from lensit.ffs_covs import ell_mat
 from lensit.ffs_covs import ffs_specmat as SM
 from lensit.ffs_covs import ffs_specmat as pmat
-from lensit.misc.misc_utils import timer, cls_hash, npy_hash, cl_inverse, extend_cl
+from lensit.misc.misc_utils import timer, cls_hash, npy_hash, dict_hash, cl_inverse, extend_cl
 from lensit.sims.sims_generic import hash_check
 
 typs = ['T', 'QU', 'TQU']
@@ -21,6 +22,8 @@ _timed = True
 _MFkeys = [0, 14]
 _runtimebarriers = False  # Can avoid problems with different MPI processes requiring different number of iterations
 _runtimerankzero = True
+_xiKmemo_size = 1  # Number of b^2 xi K spectral matrices memoised by each instance (set to zero to disable)
+_N0cache_maxbytes = 2 ** 30  # Disk budget of each N0 cache directory. Least recently used entries are removed first.
 
 
 def xylms_to_phiOmegalm(lib_alm, Fxx, Fyy, Fxy, Fyx=None):
@@ -46,6 +49,40 @@ def xylms_to_phiOmegalm(lib_alm, Fxx, Fyy, Fxy, Fyx=None):
     return np.array([Fpp, FOO, FpO])
 
 
+def _sum_rows(func, nrows, executor=None):
+    """Sum of func(i) for i in range(nrows), optionally distributed with *executor.map*
+
+    """
+    ret = None
+    for F in (map(func, range(nrows)) if executor is None else executor.map(func, range(nrows))):
+        if ret is None:
+            ret = F
+        else:
+            ret += F
+    return ret
+
+
+def _prune_cache(cache_dir, maxbytes, keep=(), verbose=False):
+    """Removes least recently used files or directories in cache_dir until its total size is below maxbytes
+
+    """
+    def get_size(path):
+        if not os.path.isdir(path): return os.path.getsize(path)
+        return sum([os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(path) for f in fs])
+    entries = sorted([os.path.join(cache_dir, f) for f in os.listdir(cache_dir)], key=os.path.getmtime)
+    sizes = [get_size(e) for e in entries]
+    tot = sum(sizes)
+    for entry, size in zip(entries, sizes):
+        if tot <= maxbytes: break
+        if entry in keep: continue
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
+        tot -= size
+        if verbose: print("Removed " + entry + " from cache")
+
+
 class ffs_diagcov_alm(object):
     """Library for flat-sky calculations of various lensing biases, responses, etc. in a idealized, isotropic case
 
@@ -91,6 +128,7 @@ class ffs_diagcov_alm(object):
 
         self.barrier = pbs.barrier if _runtimebarriers else lambda: -1
         self.pbsrank = 0 if _runtimerankzero else pbs.rank
+        self._xiKmemo = {}
 
     def _deg(self, skyalm):
         assert skyalm.shape == (self.lib_skyalm.alm_size,), (skyalm.shape, self.lib_skyalm.alm_size)
@@ -287,7 +325,7 @@ class ffs_diagcov_alm(object):
                     retalms[_i, _j, :] = (self.lib_datalm.map2alm(_map))
             return pmat.TQUPmats2TEBcls(self.lib_datalm, retalms) * (- 1. / np.sqrt(np.prod(self.lsides)))
 
-    def get_delensingcorrbias(self, typ, lib_qlm, alwfcl, CMBonly=False):
+    def get_delensingcorrbias(self, typ, lib_qlm, alwfcl, CMBonly=False, executor=None):
         r"""Calculate delensing bias given a reconstructed potential map spectrum
 
             Crudely, the delensing bias is defined as :math:`C_\ell^{\rm lensed} - C_\ell^{\rm delensed}` on Gaussian CMB maps (with lensed power spectrum).
@@ -299,6 +337,8 @@ class ffs_diagcov_alm(object):
                 lib_qlm: *ffs_alm* instance describing the lensing alm arrays
                 alwfcl: normalization of the Wiener-filter quadratic estimate (i.e. Wiener-filter times inverse response)
                 CMBonly: do not include noise spectra if set (defaults to False)
+                executor(optional): object with a *map* method (e.g. a *concurrent.futures.ThreadPoolExecutor*)
+                                    over which the four pairs of axes are distributed.
 
             Returns:
                 (3, 3, lmax +1) array with bias :math:`C_\ell^{ij}, \textrm{ with }i,j \in (T,E,B)`
@@ -308,7 +348,6 @@ class ffs_diagcov_alm(object):
 
         t = timer(_timed)
         t.checkpoint("delensing bias : Just started")
-        retalms = np.zeros((3, 3, self.lib_datalm.alm_size), dtype=complex)
         cls_noise = {}
 
         for key in self.cls_noise.keys():
@@ -328,63 +367,34 @@ class ffs_diagcov_alm(object):
             return pmat.get_datPmat_ij(
                 'TQU', self.lib_datalm, self.cls_len, np.ones_like(self.cl_transf), cls_noise, l_idx, j)
 
+        pmati = [[self._get_pmati(typ, k, l, use_cls_len=True) for l in range(len(typ))] for k in range(len(typ))]
+        xi = [[pmat.get_unlPmat_ij(typ, self.lib_datalm, self.cls_len, m, k) for k in range(len(typ))] for m in range(len(typ))]
+
         def _get_Balm(a, l, m):  # [ik_a b^2 C_len  Cov^{-1}]_{m l}
             # Here both indices should refer to the qest.
             assert a in [0, 1], a
             assert (l in range(len(typ))) and (m in range(len(typ))), (l, m)
             ik = self.lib_datalm.get_ikx if a == 1 else self.lib_datalm.get_iky
-            ret = pmat.get_unlPmat_ij(typ, self.lib_datalm, self.cls_len, m, 0) \
-                  * self._get_pmati(typ, 0, l, use_cls_len=True)
+            ret = xi[m][0] * pmati[0][l]
             for _i in range(1, len(typ)):
-                ret += pmat.get_unlPmat_ij(typ, self.lib_datalm, self.cls_len, m, _i) \
-                       * self._get_pmati(typ, _i, l, use_cls_len=True)
+                ret += xi[m][_i] * pmati[_i][l]
             return self.lib_datalm.almxfl(ret, self.cl_transf ** 2) * ik()
 
         def _get_Akm(l, m):  # [b^2  Cov^{-1}]_{m k}
             # Here both indices should refer to the qest.
             assert (l in range(len(typ))) and (m in range(len(typ))), (l, m)
-            return self.lib_datalm.almxfl(self._get_pmati(typ, m, l, use_cls_len=True), self.cl_transf ** 2)
-
-        def get_BCamj(a, m, j):  # sum_l B^{a, l m} \hat C^{lj}
-            # The first index m is one in th qest estimator of type 'typ' and
-            # the second any in TQU.
-            assert a in [0, 1], a
-            assert m in range(len(typ)), (m, typ)
-            assert j in range(3), j
-            ret = _get_Balm(a, 0, m) * get_datcl(0, j)
-            for _i in range(1, len(typ)):
-                ret += _get_Balm(a, _i, m) * get_datcl(_i, j)
-            return ret
-
-        def get_ACmj(m, j):  # sum_k A^{k m} \hat C^{kj}
-            # The first index m is one in th qest estimator of type 'typ' and
-            # the second any in TQU.
-            assert m in range(len(typ)), (m, typ)
-            assert j in range(3), j
-            ret = _get_Akm(0, m) * get_datcl(0, j)
-            for _i in range(1, len(typ)):
-                ret += _get_Akm(_i, m) * get_datcl(_i, j)
-            return ret
-
-        def ik(a, libalm=self.lib_datalm):
-            assert a in [0, 1], a
-            return libalm.get_ikx() if a == 1 else libalm.get_iky()
-
-        _map = lambda _alm: self.lib_datalm.alm2map(_alm)
-        for a in [0, 1]:
-            for b in [0, 1]:
-                t.checkpoint("    Doing axes %s %s" % (a, b))
-                Hab = lib_qlm.alm2map(alwfcl[lib_qlm.reduced_ellmat()] * ik(a, libalm=lib_qlm) * ik(b, libalm=lib_qlm))
-                for _i in range(3):  # Building TQU biases, before rotation to Gradient / Curl
-                    for _j in range(0, 3):
-                        t.checkpoint(
-                            "          Doing %s" % ({0: 'T', 1: 'Q', 2: 'U'}[_i] + {0: 'T', 1: 'Q', 2: 'U'}[_j]))
-                        # Need a sum over a and m
-                        for m in range(len(typ)):  # Hab(z) * [ (AC_m_dai)(-z) (BC_bmj) + (AC_mj)(-z) (BC_bmdai)]
-                            Pmat = (get_ACmj(m, _i) * ik(a)).conjugate()
-                            retalms[_i, _j, :] += self.lib_datalm.map2alm(Hab * _map(Pmat)) * get_BCamj(b, m, _j)
-                            Pmat = (get_BCamj(b, m, _i) * ik(a)).conjugate()
-                            retalms[_i, _j, :] += self.lib_datalm.map2alm(Hab * _map(Pmat)) * get_ACmj(m, _j)
+            return self.lib_datalm.almxfl(pmati[m][l], self.cl_transf ** 2)
+
+        # The first index m of AC and BC is one in th qest estimator of type 'typ' and the second any in TQU.
+        datcl = np.array([[get_datcl(l, j) for j in range(3)] for l in range(len(typ))])
+        ACmj = np.einsum('kmx,kjx->mjx', np.array([[_get_Akm(k, m) for m in range(len(typ))] for k in range(len(typ))]),
+                         datcl)  # sum_k A^{k m} \hat C^{kj}
+        BCamj = np.einsum('almx,ljx->amjx', np.array([[[_get_Balm(a, l, m) for m in range(len(typ))] for l in range(len(typ))] for a in [0, 1]]),
+                          datcl)  # sum_l B^{a, l m} \hat C^{lj}
+        t.checkpoint("  AC and BC matrices")
+
+        retalms = self._get_delensingcorrbias_TQUalms(lib_qlm, alwfcl, ACmj, BCamj, executor=executor)
+        t.checkpoint("  TQU biases")
         norm = 1. / np.sqrt(np.prod(self.lsides))
         # Sure that i - j x-y is the same ?
         for i in range(3):  # Building TQU biases, before rotation to Gradient / Curl
@@ -394,7 +404,8 @@ class ffs_diagcov_alm(object):
 
         return pmat.TQUPmats2TEBcls(self.lib_datalm, retalms) * norm
 
-    def get_RDdelensingcorrbias(self, typ, lib_qlm, alwfcl, clsobs_deconv, clsobs_deconv2=None, cls_weights=None):
+    def get_RDdelensingcorrbias(self, typ, lib_qlm, alwfcl, clsobs_deconv, clsobs_deconv2=None, cls_weights=None,
+                                executor=None):
         r"""Calculate delensing bias given a reconstructed potential map spectrum
 
             Same as *get_delensingcorrbias* using empirical input CMB spectra
@@ -404,6 +415,8 @@ class ffs_diagcov_alm(object):
                 lib_qlm: *ffs_alm* instance describing the lensing alm arrays
                 alwfcl: normalization of the Wiener-filter quadratic estimate (i.e. Wiener-filter times inverse response)
                 clsobs_deconv(dict): emprical beam-deconvolved CMB data spectra.
+                executor(optional): object with a *map* method (e.g. a *concurrent.futures.ThreadPoolExecutor*)
+                                    over which the four pairs of axes are distributed.
 
             Returns:
                 (3, 3, lmax +1) array with bias :math:`C_\ell^{ij}, \textrm{ with }i,j \in (T,E,B)`
@@ -413,7 +426,6 @@ class ffs_diagcov_alm(object):
         assert typ in typs, (typ, typs)
 
         t = timer(_timed, suffix=' (delensing RD corr. Bias)')
-        retalms = np.zeros((3, 3, self.lib_datalm.alm_size), dtype=complex)
         _cls_weights = cls_weights or self.cls_len
         _clsobs_deconv2 = clsobs_deconv2 or clsobs_deconv
         if cls_weights is not None: t.checkpoint("Using custom cls weights")
@@ -433,62 +445,35 @@ class ffs_diagcov_alm(object):
             _cmb_cls = clsobs_deconv if id == 1 else _clsobs_deconv2
             return pmat.get_unlPmat_ij('TQU', self.lib_datalm, _cmb_cls, l_idx, j)
 
+        pmati = [[self._get_pmati(typ, k, l, use_cls_len=True) for l in range(len(typ))] for k in range(len(typ))]
+        xi = [[pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_weights, m, k) for k in range(len(typ))] for m in range(len(typ))]
+
         def _get_Balm(a, l, m):  # [ik_a b^2 C_len  Cov^{-1}]_{m l}
             # Here both indices should refer to the qest.
             assert a in [0, 1], a
             assert (l in range(len(typ))) and (m in range(len(typ))), (l, m)
             ik = self.lib_datalm.get_ikx if a == 1 else self.lib_datalm.get_iky
-            ret = pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_weights, m, 0) \
-                  * self._get_pmati(typ, 0, l, use_cls_len=True)
+            ret = xi[m][0] * pmati[0][l]
             for _i in range(1, len(typ)):
-                ret += pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_weights, m, _i) \
-                       * self._get_pmati(typ, _i, l, use_cls_len=True)
+                ret += xi[m][_i] * pmati[_i][l]
             return self.lib_datalm.almxfl(ret, self.cl_transf ** 2) * ik()
 
         def _get_Akm(l, m):  # [b^2  Cov^{-1}]_{m k}
             # Here both indices should refer to the qest.
             assert (l in range(len(typ))) and (m in range(len(typ))), (l, m)
-            return self.lib_datalm.almxfl(self._get_pmati(typ, m, l, use_cls_len=True), self.cl_transf ** 2)
-
-        def get_BCamj(a, m, j):  # sum_l B^{a, l m} \hat C^{lj}
-            # The first index m is one in th qest estimator of type 'typ' and
-            # the second any in TQU.
-            assert a in [0, 1], a
-            assert m in range(len(typ)), (m, typ)
-            assert j in range(3), j
-            ret = _get_Balm(a, 0, m) * get_datcl(0, j, 2)
-            for _i in range(1, len(typ)):
-                ret += _get_Balm(a, _i, m) * get_datcl(_i, j, 2)
-            return ret
-
-        def get_ACmj(m, j):  # sum_k A^{k m} \hat C^{kj}
-            # The first index m is one in th qest estimator of type 'typ' and
-            # the second any in TQU.
-            assert m in range(len(typ)), (m, typ)
-            assert j in range(3), j
-            ret = _get_Akm(0, m) * get_datcl(0, j, 1)
-            for _i in range(1, len(typ)):
-                ret += _get_Akm(_i, m) * get_datcl(_i, j, 1)
-            return ret
-
-        def ik(a, libalm=self.lib_datalm):
-            assert a in [0, 1], a
-            return libalm.get_ikx() if a == 1 else libalm.get_iky()
-
-        _map = lambda _alm: self.lib_datalm.alm2map(_alm)
-        for a in [0, 1]:
-            for b in [0, 1]:
-                t.checkpoint("  Doing axes %s %s" % (a, b))
-                Hab = lib_qlm.alm2map(alwfcl[lib_qlm.reduced_ellmat()] * ik(a, libalm=lib_qlm) * ik(b, libalm=lib_qlm))
-                for _i in range(3):  # Building TQU biases, before rotation to Gradient / Curl
-                    for _j in range(0, 3):
-                        t.checkpoint("    Doing %s" % ({0: 'T', 1: 'Q', 2: 'U'}[_i] + {0: 'T', 1: 'Q', 2: 'U'}[_j]))
-                        # Need a sum over a and m
-                        for m in range(len(typ)):  # Hab(z) * [ (AC_m_dai)(-z) (BC_bmj) + (AC_mj)(-z) (BC_bmdai)]
-                            Pmat = (get_ACmj(m, _i) * ik(a)).conjugate()
-                            retalms[_i, _j, :] += self.lib_datalm.map2alm(Hab * _map(Pmat)) * get_BCamj(b, m, _j)
-                            Pmat = (get_BCamj(b, m, _i) * ik(a)).conjugate()
-                            retalms[_i, _j, :] += self.lib_datalm.map2alm(Hab * _map(Pmat)) * get_ACmj(m, _j)
+            return self.lib_datalm.almxfl(pmati[m][l], self.cl_transf ** 2)
+
+        # The first index m of AC and BC is one in th qest estimator of type 'typ' and the second any in TQU.
+        datcl1 = np.array([[get_datcl(l, j, 1) for j in range(3)] for l in range(len(typ))])
+        datcl2 = datcl1 if clsobs_deconv2 is None else np.array([[get_datcl(l, j, 2) for j in range(3)] for l in range(len(typ))])
+        ACmj = np.einsum('kmx,kjx->mjx', np.array([[_get_Akm(k, m) for m in range(len(typ))] for k in range(len(typ))]),
+                         datcl1)  # sum_k A^{k m} \hat C^{kj}
+        BCamj = np.einsum('almx,ljx->amjx', np.array([[[_get_Balm(a, l, m) for m in range(len(typ))] for l in range(len(typ))] for a in [0, 1]]),
+                          datcl2)  # sum_l B^{a, l m} \hat C^{lj}
+        t.checkpoint("  AC and BC matrices")
+
+        retalms = self._get_delensingcorrbias_TQUalms(lib_qlm, alwfcl, ACmj, BCamj, executor=executor)
+        t.checkpoint("  TQU biases")
         norm = 1. / np.sqrt(np.prod(self.lsides))  # ?
         # Sure that i - j x-y is the same ?
         for _i in range(3):  # Building TQU biases, before rotation to Gradient / Curl
@@ -500,6 +485,34 @@ class ffs_diagcov_alm(object):
 
         return pmat.TQUPmats2TEBcls(self.lib_datalm, retalms) * norm
 
+    def _get_delensingcorrbias_TQUalms(self, lib_qlm, alwfcl, ACmj, BCamj, executor=None):
+        r"""TQU delensing correlated bias matrix, before rotation to TEB and symmetrization
+
+            Sum over axes a, b and qest index m of  :math:`H_{ab}(z) [ (AC_{m\partial_a i})(-z) (BC_{bmj}) + (AC_{mj})(-z) (BC_{bm\partial_a i})]`
+
+            Args:
+                lib_qlm: *ffs_alm* instance describing the lensing alm arrays
+                alwfcl: normalization of the Wiener-filter quadratic estimate
+                ACmj: (m, TQU, alm) array :math:`\sum_k A^{k m} \hat C^{kj}`
+                BCamj: (axis, m, TQU, alm) array :math:`\sum_l B^{a, l m} \hat C^{lj}`
+                executor(optional): object with a *map* method over which the four pairs of axes are distributed
+
+        """
+        nm = ACmj.shape[0]
+        ik_d = [self.lib_datalm.get_iky(), self.lib_datalm.get_ikx()]
+        ik_q = [lib_qlm.get_iky(), lib_qlm.get_ikx()]
+        _HFt = lambda Hab, alms: self.lib_datalm.maps2alms(Hab * self.lib_datalm.alms2maps(alms.reshape(nm * 3, -1))).reshape(nm, 3, -1)
+
+        def get_retalms(ab):
+            a, b = ab // 2, ab % 2
+            Hab = lib_qlm.alm2map(alwfcl[lib_qlm.reduced_ellmat()] * ik_q[a] * ik_q[b])
+            # The transforms do not depend on the second TQU index and are done once for all of them.
+            HAC = _HFt(Hab, (ACmj * ik_d[a]).conjugate())
+            HBC = _HFt(Hab, (BCamj[b] * ik_d[a]).conjugate())
+            return np.einsum('mix,mjx->ijx', HAC, BCamj[b]) + np.einsum('mix,mjx->ijx', HBC, ACmj)
+
+        return _sum_rows(get_retalms, 4, executor=executor)
+
     def _apply_beams(self, typ, alms):
         assert alms.shape == self._skyalms_shape(typ), (alms.shape, self._skyalms_shape(typ))
         ret = np.empty_like(alms)
@@ -588,12 +601,16 @@ class ffs_diagcov_alm(object):
             def __call__(self, alms1, alms2, **kwargs):
                 return np.sum(alms1.real * alms2.real + alms1.imag * alms2.imag)
 
-        cond_func = getattr(self, 'apply_cond%s' % cond)
+        cond_func = getattr(self, 'apply_cond%s' % cond, None) or getattr(self, '_apply_cond%s' % cond)
 
         # ! fwd_op and pre_ops must not change their arguments !
         def fwd_op(_alms):
             return self.apply(typ, _alms, use_Pool=use_Pool)
 
+        fwd_op_roundoff = None
+        if getattr(self, 'precision', 'double') != 'double':  # residual refreshed in double precision
+            fwd_op_roundoff = lambda _alms: self.apply(typ, _alms, use_Pool=use_Pool, precision='double')
+
         def pre_ops(_alms):
             return cond_func(typ, _alms, use_Pool=use_Pool)
 
@@ -606,7 +623,7 @@ class ffs_diagcov_alm(object):
         print("++ ffs_cov cd_solve: starting, cond %s " % cond)
 
         it = cd_solve.cd_solve(ulm0, alms, fwd_op, [pre_ops], dot_op, criterion, tr_cd,
-                                              roundoff=cd_roundoff)
+                                              roundoff=cd_roundoff, fwd_op_roundoff=fwd_op_roundoff)
         return ulm0, it
 
     def _apply_cond3(self, typ, alms, use_Pool=0):
@@ -681,11 +698,12 @@ class ffs_diagcov_alm(object):
         return np.array([2 * dphi, 2 * dOm])  # Factor 2 since gradient w.r.t. real and imag. parts.
 
     def  _get_qlm_resprlm(self, typ, lib_qlm,
-                          use_cls_len=True, cls_obs=None, cls_obs2=None, cls_filt=None, cls_weights=None):
+                          use_cls_len=True, cls_obs=None, cls_obs2=None, cls_filt=None, cls_weights=None, executor=None):
         assert typ in typs, (typ, typs)
         t = timer(_timed)
         Fpp, FOO, FpO = self._get_qlm_curvature(typ, lib_qlm,
-                                                use_cls_len=use_cls_len, cls_obs=cls_obs, cls_filt=cls_filt, cls_weights=cls_weights, cls_obs2=cls_obs2)
+                                                use_cls_len=use_cls_len, cls_obs=cls_obs, cls_filt=cls_filt, cls_weights=cls_weights, cls_obs2=cls_obs2,
+                                                executor=executor)
 
         t.checkpoint("  get_qlm_resplm:: get curvature matrices")
 
@@ -699,7 +717,7 @@ class ffs_diagcov_alm(object):
         return Rpp, ROO
 
     def get_N0cls(self, typ, lib_qlm,
-                  use_cls_len=True, cls_obs=None, cls_obs2=None, cls_weights=None, cls_filt=None):
+                  use_cls_len=True, cls_obs=None, cls_obs2=None, cls_weights=None, cls_filt=None, executor=None):
         r"""Lensing Gaussian bias :math:`N^{(0)}_L`
 
             Args:
@@ -709,6 +727,8 @@ class ffs_diagcov_alm(object):
                 cls_weights(dict, optional): CMB cls entering the QE weights (numerator)
                 cls_filt(dict, optional): CMB cls entering the inverse-variance filtering step (denominator of QE weights)
                 use_cls_len(optional): Uses lensed or unlensed CMB cls (when not superseeded byt the other keywords)
+                executor(optional): object with a *map* method (e.g. a *concurrent.futures.ThreadPoolExecutor*)
+                                    over which the field pairs are distributed, row by row.
 
             Returns:
                 Gradient and curl lensing mode noise :math:`N^{(0)}_L`
@@ -721,7 +741,7 @@ class ffs_diagcov_alm(object):
             if not os.path.exists(fname):
                 if self.pbsrank == 0:
                     lib_full = ell_mat.ffs_alm_pyFFTW(self.lib_datalm.ell_mat, filt_func=lambda ell: ell > 0)
-                    Rpp, ROO = self._get_qlm_resprlm(typ, lib_full, use_cls_len=use_cls_len)
+                    Rpp, ROO = self._get_qlm_resprlm(typ, lib_full, use_cls_len=use_cls_len, executor=executor)
                     header = datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y") + '\n' + __file__
                     np.savetxt(fname, np.array((2 * lib_full.alm2cl(np.sqrt(Rpp)), 2 * lib_full.alm2cl(np.sqrt(ROO)))).transpose(),fmt=['%.8e'] * 2, header=header)
                 self.barrier()
@@ -729,12 +749,30 @@ class ffs_diagcov_alm(object):
             cl[0] *= lib_qlm.filt_func(np.arange(len(cl[0])))
             cl[1] *= lib_qlm.filt_func(np.arange(len(cl[1])))
             return cl
-        else:
+        else:  # content-addressed cache
+            _cls_default = self.cls_len if use_cls_len else self.cls_unl
+            h = {'typ': typ, 'lib_qlm': lib_qlm.hashdict(), 'lib_datalm': self.lib_datalm.hashdict(),
+                 'cls_obs': None if cls_obs is None else cls_hash(cls_obs),
+                 'cls_obs2': None if cls_obs2 is None else cls_hash(cls_obs2),
+                 'cls_weights': cls_hash(cls_weights or _cls_default), 'cls_filt': cls_hash(cls_filt or _cls_default),
+                 'cl_transf': npy_hash(self.cl_transf), 'cls_noise': cls_hash(self.cls_noise)}
+            fname = os.path.join(self.lib_dir, 'N0cache', 'N0cls_%s.npy' % dict_hash(h))
+            if os.path.exists(fname):
+                os.utime(fname, None)
+                cl = np.load(fname)
+                return cl[0], cl[1]
             Rpp, ROO = self._get_qlm_resprlm(typ, lib_qlm,
-                                             use_cls_len=use_cls_len, cls_obs=cls_obs, cls_weights=cls_weights, cls_filt=cls_filt, cls_obs2=cls_obs2)
-            return 2 * lib_qlm.alm2cl(np.sqrt(Rpp)), 2 * lib_qlm.alm2cl(np.sqrt(ROO))
-
-    def iterateN0cls(self, typ, lib_qlm, itmax, return_delcls=False, _it=0, _cpp=None):
+                                             use_cls_len=use_cls_len, cls_obs=cls_obs, cls_weights=cls_weights, cls_filt=cls_filt, cls_obs2=cls_obs2,
+                                             executor=executor)
+            cl = np.array([2 * lib_qlm.alm2cl(np.sqrt(Rpp)), 2 * lib_qlm.alm2cl(np.sqrt(ROO))])
+            if self.pbsrank == 0:
+                if not os.path.exists(os.path.dirname(fname)):
+                    os.makedirs(os.path.dirname(fname))
+                np.save(fname, cl)
+                _prune_cache(os.path.dirname(fname), _N0cache_maxbytes, keep=(fname,))
+            return cl[0], cl[1]
+
+    def iterateN0cls(self, typ, lib_qlm, itmax, return_delcls=False, _it=0, _cpp=None, _N0iter_dir=None):
         """Iterative flat-sky :math:`N^{(0)}_L` calculation to estimate the noise levels of the iterative estimator.
 
             This uses perturbative approach in Wiener-filtered displacement, consistent with box shape and mode structure.
@@ -745,6 +783,10 @@ class ffs_diagcov_alm(object):
                 itmax: Number of iterations to performs
                 return_delcls: optionally return partially delensed cmb cls as well
 
+            Note:
+                The iterations are performed in content-addressed directories, such that runs sharing any prefix of
+                iterations reuse the cached N0's and delensing biases.
+
 
         """
         N0 = self.get_N0cls(typ, lib_qlm, use_cls_len=True)[0][:lib_qlm.ellmax + 1]
@@ -764,19 +806,18 @@ class ffs_diagcov_alm(object):
         for key in self.cls_unl.keys():
             cls_unl[key] = self.cls_unl[key].copy()
         # cls_unl['pp'][0:min(len(cpp), len(cls_unl['pp']))] = (cpp * (1. - clWF))[0:min(len(cpp), len(cls_unl['pp']))]
-        new_libdir = os.path.join(self.lib_dir, '%s_N0iter' % typ, 'N0iter%04d' % (_it + 1)) if _it == 0 else \
-            self.lib_dir.replace('N0iter%04d' % _it, 'N0iter%04d' % (_it + 1))
-
-        try:
-            new_cov = ffs_diagcov_alm(new_libdir, self.lib_datalm, cls_unl, cls_delen, self.cl_transf, self.cls_noise,
-                                                              lib_skyalm=self.lib_skyalm)
-        except:
-            print("hash check failed, removing " + new_libdir)
-            shutil.rmtree(new_libdir)
-            new_cov = ffs_diagcov_alm(new_libdir, self.lib_datalm, cls_unl, cls_delen, self.cl_transf, self.cls_noise,
-                                                              lib_skyalm=self.lib_skyalm)
-
-        return new_cov.iterateN0cls(typ, lib_qlm, itmax, _it=_it + 1, return_delcls=return_delcls, _cpp=_cpp)
+        N0iter_dir = _N0iter_dir or os.path.join(self.lib_dir, '%s_N0iter' % typ)
+        h = {'lib_alm': self.lib_datalm.hashdict(), 'lib_skyalm': self.lib_skyalm.hashdict(),
+             'cls_unl': cls_hash(cls_unl), 'cls_len': cls_hash(cls_delen),
+             'cls_noise': cls_hash(self.cls_noise), 'cl_transf': npy_hash(self.cl_transf)}
+        new_libdir = os.path.join(N0iter_dir, 'N0iter_%s' % dict_hash(h))
+        new_cov = ffs_diagcov_alm(new_libdir, self.lib_datalm, cls_unl, cls_delen, self.cl_transf, self.cls_noise,
+                                  lib_skyalm=self.lib_skyalm)
+        if self.pbsrank == 0:
+            os.utime(new_libdir, None)
+            _prune_cache(N0iter_dir, _N0cache_maxbytes, keep=(new_libdir, self.lib_dir))
+        return new_cov.iterateN0cls(typ, lib_qlm, itmax, _it=_it + 1, return_delcls=return_delcls, _cpp=_cpp,
+                                    _N0iter_dir=N0iter_dir)
 
     def get_N0Pk_minimal(self, typ, lib_qlm, use_cls_len=True, cls_obs=None):
         # Same as N0cls but binning only in exactly identical frequencies.
@@ -784,7 +825,33 @@ class ffs_diagcov_alm(object):
         Rpp, ROO = self._get_qlm_resprlm(typ, lib_qlm, use_cls_len=use_cls_len, cls_obs=cls_obs)
         return lib_qlm.alm2Pk_minimal(np.sqrt(2 * Rpp)), lib_qlm.alm2Pk_minimal(np.sqrt(2 * ROO))
 
-    def get_response(self, typ, lib_qlm, cls_weights=None, cls_filt=None, cls_cmb=None, use_cls_len=True):
+    def _get_xiK(self, typ, cls, Pinv_obs, Pinv_key):
+        r"""Memoised :math:`b^2 \xi K` spectral matrices, returned as (i, j, alm) array.
+
+            Args:
+                typ: 'T', 'QU', 'TQU' for temperature-only, polarization-only or joint analysis
+                cls(dict): CMB spectra entering :math:`\xi`
+                Pinv_obs: inverse covariance spectral matrix (or :math:`\rm{Cov}^{-1}\rm{Cov}_{\rm obs}\rm{Cov}^{-1}`)
+                Pinv_key(tuple): identifies *Pinv_obs* in the memoisation key
+
+        """
+        key = (typ, cls_hash(cls, lmax=self.lib_datalm.ellmax)) + Pinv_key
+        if key in self._xiKmemo:
+            return self._xiKmemo[key]
+        xi = [[pmat.get_unlPmat_ij(typ, self.lib_datalm, cls, i, k) for k in range(len(typ))] for i in range(len(typ))]
+        ret = np.zeros((len(typ), len(typ), self.lib_datalm.alm_size), dtype=float)
+        for i in range(len(typ)):
+            for j in range(len(typ)):
+                for k in range(len(typ)):
+                    ret[i, j] += xi[i][k] * Pinv_obs[:, k, j]
+                self.lib_datalm.almxfl(ret[i, j], self.cl_transf ** 2, inplace=True)
+        if _xiKmemo_size > 0:
+            while len(self._xiKmemo) >= _xiKmemo_size:
+                del self._xiKmemo[next(iter(self._xiKmemo))]
+            self._xiKmemo[key] = ret
+        return ret
+
+    def get_response(self, typ, lib_qlm, cls_weights=None, cls_filt=None, cls_cmb=None, use_cls_len=True, executor=None):
         r"""Lensing quadratic estimator gradient and curl response functions.
 
             Args:
@@ -793,6 +860,8 @@ class ffs_diagcov_alm(object):
                 cls_weights(dict): CMB spectra used in the QE weights (those entering the numerator in the usual Okamoto & Hu formulae)
                           Defaults to *self.cls_len* if set else *self.cls_unl*
                 cls_cmb(dict): CMB spectra of the sky entering the response contractions (in principle lensed cls or grad-lensed cls)
+                executor(optional): object with a *map* method (e.g. a *concurrent.futures.ThreadPoolExecutor*)
+                                    over which the field pairs are distributed, row by row.
 
         """
         assert typ in typs, (typ, typs)
@@ -805,89 +874,53 @@ class ffs_diagcov_alm(object):
         if not cls_filt is None: t.checkpoint('Using custom Cls filt')
         if not cls_cmb is None: t.checkpoint('Using custom Cls cmb')
 
-        Pinv_obs1 = pmat.get_Pmat(typ, self.lib_datalm, _cls_filt,
+        Pinv_obs = pmat.get_Pmat(typ, self.lib_datalm, _cls_filt,
                              cls_noise=self.cls_noise, cl_transf=self.cl_transf, inverse=True)
-        Pinv_obs2 = Pinv_obs1
-
-        # xi K
-        def get_xiK(i, j, id, cls):
-            assert id in [1, 2]
-            _Pinv_obs = Pinv_obs1 if id == 1 else Pinv_obs2
-            ret = pmat.get_unlPmat_ij(typ, self.lib_datalm, cls, i, 0) * _Pinv_obs[:, 0, j]
-            for _k in range(1, len(typ)):
-                ret += pmat.get_unlPmat_ij(typ, self.lib_datalm, cls, i, _k) * _Pinv_obs[:, _k, j]
-            return self.lib_datalm.almxfl(ret, self.cl_transf ** 2)
-        # xi^w K xi^cmb
-        def get_xiwKxicmb(i, j, id):
-            assert id in [1, 2]
-            ret = get_xiK(i, 0, id, _cls_weights) * pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_cmb, 0, j)
-            for _k in range(1, len(typ)):
-                ret += get_xiK(i, _k, id, _cls_weights) * pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_cmb, _k, j)
-            return ret
-
-        ikx = self.lib_datalm.get_ikx
-        iky = self.lib_datalm.get_iky
+        Pinv_key = ('filt', cls_hash(_cls_filt, lmax=self.lib_datalm.ellmax))
         t.checkpoint("  inverse %s Pmats" % ({True: 'len', False: 'unl'}[use_cls_len]))
-        F = np.zeros(self.lib_datalm.ell_mat.shape, dtype=float)
-
-        # Calculation of (xi^cmb,b K) (xi^w,a K)
-        for i in range(len(typ)):
-            for j in range(0, len(typ)):
-                # ! Matrix not symmetric for TQU or non identical noises. But xx or yy element ok.#(2 - (i == j)) *
-                F +=   self.lib_datalm.alm2map(ikx() * get_xiK(i, j, 1, _cls_cmb)) \
-                     * self.lib_datalm.alm2map(ikx() * get_xiK(j, i, 2, _cls_weights))
-
-        Fxx = lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fxx , part 1")
-
-        for i in range(len(typ)):
-            for j in range(0, len(typ)):
-                # ! Matrix not symmetric for TQU or non identical noises. But xx or yy element ok.#(2 - (i == j)) *
-                F +=  self.lib_datalm.alm2map(iky() * get_xiK(i, j, 1, _cls_cmb)) \
-                     * self.lib_datalm.alm2map(iky() * get_xiK(j, i, 2, _cls_weights))
-        Fyy = lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fyy , part 1")
 
-        for i in range(len(typ)):
+        # xi K
+        xiK_cmb = self._get_xiK(typ, _cls_cmb, Pinv_obs, Pinv_key)
+        xiK_w = self._get_xiK(typ, _cls_weights, Pinv_obs, Pinv_key)
+        xi_cmb = [[pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_cmb, k, j) for j in range(len(typ))] for k in range(len(typ))]
+        t.checkpoint("  xi K matrices")
+
+        ikx = self.lib_datalm.get_ikx()
+        iky = self.lib_datalm.get_iky()
+        b2 = self.cl_transf[self.lib_datalm.reduced_ellmat()] ** 2
+        _maps = self.lib_datalm.alms2maps
+        _sum = lambda maps1, maps2: np.einsum('j...,j...->...', maps1, maps2)
+
+        def get_F(i):  # xx, yy and xy contributions of the i-th row of field pairs
+            F = np.empty((3,) + self.lib_datalm.ell_mat.shape, dtype=float)
+            # Calculation of (xi^cmb,b K) (xi^w,a K)
+            # ! Matrix not symmetric for TQU or non identical noises. But xx or yy element ok.
+            xmaps = _maps(ikx * xiK_cmb[i])
+            ymaps = _maps(iky * xiK_w[:, i])
+            F[2] = _sum(xmaps, ymaps)
+            F[0] = _sum(xmaps, _maps(ikx * xiK_w[:, i]))
+            del xmaps
+            F[1] = _sum(_maps(iky * xiK_cmb[i]), ymaps)
+            del ymaps
+            # Adding to that (K)(z) (xi^w,a K xi^cmb,b)(z)
+            xiwKxicmb = np.zeros_like(xiK_w[i])
             for j in range(len(typ)):
-                # ! BPBCovi Matrix not symmetric for TQU or non identical noises.
-                F += self.lib_datalm.alm2map(ikx() * get_xiK(i, j, 1, _cls_cmb)) \
-                     * self.lib_datalm.alm2map(iky() * get_xiK(j, i, 2, _cls_weights))
-        Fxy = lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fxy , part 1")
-
-        # Adding to that (K)(z) (xi^w,a K xi^cmb,b)(z)
-        tmap = lambda i, j: self.lib_datalm.alm2map(
-            self.lib_datalm.almxfl(Pinv_obs1[:, i, j], self.cl_transf ** 2))
-
-        for i in range(len(typ)):
-            for j in range(0, len(typ)):
-                F += tmap(i, j) * self.lib_datalm.alm2map(ikx() ** 2 * get_xiwKxicmb(i, j, 2))
-        Fxx += lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fxx , part 2")
-
-        for i in range(len(typ)):
-            for j in range(0, len(typ)):
-                F += tmap(i, j) * self.lib_datalm.alm2map(iky() ** 2 * get_xiwKxicmb(i, j, 2))
-        Fyy += lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fyy , part 2")
+                for k in range(len(typ)):
+                    xiwKxicmb[j] += xiK_w[i, k] * xi_cmb[k][j]
+            tmaps = _maps(b2 * Pinv_obs[:, i, :].transpose())
+            F[0] += _sum(tmaps, _maps(ikx ** 2 * xiwKxicmb))
+            F[1] += _sum(tmaps, _maps(iky ** 2 * xiwKxicmb))
+            F[2] += _sum(tmaps, _maps(iky * ikx * xiwKxicmb))
+            return F
 
-        for i in range(len(typ)):
-            for j in range(0, len(typ)):
-                F += tmap(i, j) * self.lib_datalm.alm2map(iky() * ikx() * get_xiwKxicmb(i, j, 2))
-        Fxy += lib_qlm.map2alm(F)
-        t.checkpoint("  Fxy , part 2")
+        Fxx, Fyy, Fxy = lib_qlm.maps2alms(_sum_rows(get_F, len(typ), executor=executor))
+        t.checkpoint("  Fxx , Fyy, Fxy")
 
         facunits = -1. / np.sqrt(np.prod(self.lsides))
         return np.array([lib_qlm.bin_realpart_inell(r) for r in xylms_to_phiOmegalm(lib_qlm, Fxx.real * facunits, Fyy.real * facunits, Fxy.real * facunits)])
 
     def _get_qlm_curvature(self, typ, lib_qlm,
-                           cls_weights=None, cls_filt=None, cls_obs=None, cls_obs2=None, use_cls_len=True):
+                           cls_weights=None, cls_filt=None, cls_obs=None, cls_obs2=None, use_cls_len=True, executor=None):
         """Fisher matrix for the displacement components phi and Omega (gradient and curl potentials)
 
 
@@ -910,6 +943,7 @@ class ffs_diagcov_alm(object):
         # For a standard N0 computation, this will just be cov^{-1}.
         # For RDN0 compuation, it will be cov^{-1} cov_obs cov^{-1}
         # In the case of RDN0 computation, only one of the two inverse covariance matrix is replaced.
+        Pinv_key1 = ('filt', cls_hash(_cls_filt, lmax=self.lib_datalm.ellmax))
         if cls_obs is None:
             assert cls_obs2 is None
             _lib_qlm = ell_mat.ffs_alm_pyFFTW(self.lib_datalm.ell_mat,
@@ -922,111 +956,67 @@ class ffs_diagcov_alm(object):
             Pinv_obs1 = pmat.get_Pmat(typ, self.lib_datalm, _cls_filt,
                                       cls_noise=self.cls_noise, cl_transf=self.cl_transf, inverse=True)
             Pinv_obs2 = Pinv_obs1
+            Pinv_key2 = Pinv_key1
         else:
 
             # FIXME : this will fail if lib_qlm does not have the right shape
             _lib_qlm = lib_qlm
             Covi = pmat.get_Pmat(typ, self.lib_datalm, _cls_filt, cls_noise=self.cls_noise, cl_transf=self.cl_transf,
                             inverse=True)
-            Pinv_obs1 = np.array([np.dot(a, b) for a, b in
-                                  zip(pmat.get_Pmat(typ, self.lib_datalm, _cls_obs, cls_noise=None, cl_transf=None),
-                                      Covi)])
-            Pinv_obs1 = np.array([np.dot(a, b) for a, b in zip(Covi, Pinv_obs1)])
+            Pinv_obs1 = np.matmul(Covi, np.matmul(pmat.get_Pmat(typ, self.lib_datalm, _cls_obs, cls_noise=None, cl_transf=None), Covi))
+            Pinv_key1 += ('obs', cls_hash(_cls_obs, lmax=self.lib_datalm.ellmax))
             if cls_obs2 is None:
                 Pinv_obs2 = Pinv_obs1
+                Pinv_key2 = Pinv_key1
             else:
-                Pinv_obs2 = np.array([np.dot(a, b) for a, b in
-                                      zip(pmat.get_Pmat(typ, self.lib_datalm, _cls_obs2, cls_noise=None, cl_transf=None),
-                                          Covi)])
-                Pinv_obs2 = np.array([np.dot(a, b) for a, b in zip(Covi, Pinv_obs2)])
+                Pinv_obs2 = np.matmul(Covi, np.matmul(pmat.get_Pmat(typ, self.lib_datalm, _cls_obs2, cls_noise=None, cl_transf=None), Covi))
+                Pinv_key2 = Pinv_key1[:2] + ('obs', cls_hash(_cls_obs2, lmax=self.lib_datalm.ellmax))
             del Covi
-
-        # B xi B^t Cov^{-1} (or Cov^-1 Cov_obs Cov^-1 for semi-analytical N0)
-        def get_BPBCovi(i, j, id):
-            assert id in [1, 2]
-            _Pinv_obs = Pinv_obs1 if id == 1 else Pinv_obs2
-            ret = pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_weights, i, 0) * _Pinv_obs[:, 0, j]
-            for _k in range(1, len(typ)):
-                ret += pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_weights, i, _k) * _Pinv_obs[:, _k, j]
-            return self.lib_datalm.almxfl(ret, self.cl_transf ** 2)
-
-        def get_BPBCoviP(i, j, id):
-            assert id in [1, 2]
-            ret = get_BPBCovi(i, 0, id) * pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_weights, 0, j)
-            for _k in range(1, len(typ)):
-                ret += get_BPBCovi(i, _k, id) * pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_weights, _k, j)
-            return ret
-
-        def get_BPBCovi_rot(i, j, id):
-            assert id in [1, 2]
-            _Pinv_obs = Pinv_obs1 if id == 1 else Pinv_obs2
-            ret = pmat.get_unlrotPmat_ij(typ, self.lib_datalm, _cls_weights, i, 0) * _Pinv_obs[:, 0, j]
-            for _k in range(1, len(typ)):
-                ret += pmat.get_unlrotPmat_ij(typ, self.lib_datalm, _cls_weights, i, _k) * _Pinv_obs[:, _k, j]
-            return self.lib_datalm.almxfl(ret, self.cl_transf ** 2)
-
-        ikx = self.lib_datalm.get_ikx
-        iky = self.lib_datalm.get_iky
         t.checkpoint("  inverse %s Pmats" % ({True: 'len', False: 'unl'}[use_cls_len]))
-        F = np.zeros(self.lib_datalm.ell_mat.shape, dtype=float)
-        # 2.1 GB in memory for full sky 16384 ** 2 points. Note however that we can without any loss of accuracy
-        # calculate this using a twice as sparse grid, for reasonable input parameters.
-
-        # Calculation of (db xi B Cov^{-1} B^t )_{ab}(z) (daxi B Cov^{-1} B^t)^{ba}(z)
-        for i in range(len(typ)):
-            for j in range(i, len(typ)):
-                # ! BPBCovi Matrix not symmetric for TQU or non identical noises. But xx or yy element ok.
-                F += (2 - (i == j)) * self.lib_datalm.alm2map(ikx() * get_BPBCovi(i, j, 1)) \
-                     * self.lib_datalm.alm2map(ikx() * get_BPBCovi(j, i, 2))
-        Fxx = _lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fxx , part 1")
-
-        for i in range(len(typ)):
-            for j in range(i, len(typ)):
-                # ! BPBCovi Matrix not symmetric for TQU or non identical noises. But xx or yy element ok.
-                F += (2 - (i == j)) * self.lib_datalm.alm2map(iky() * get_BPBCovi(i, j, 1)) \
-                     * self.lib_datalm.alm2map(iky() * get_BPBCovi(j, i, 2))
-        Fyy = _lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fyy , part 1")
 
-        for i in range(len(typ)):
-            for j in range(len(typ)):
-                # ! BPBCovi Matrix not symmetric for TQU or non identical noises.
-                F += self.lib_datalm.alm2map(ikx() * get_BPBCovi(i, j, 1)) \
-                     * self.lib_datalm.alm2map(iky() * get_BPBCovi(j, i, 2))
-        Fxy = _lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fxy , part 1")
-
-        # Adding to that (B Cov^-1 B^t)(z) (daxi B Cov^-1 B^t dbxi)(z)
-        # Construct Pmat:
-        #  Cl * bl ** 2 * cov^{-1} cov_obs cov^{-1} * Cl if semianalytic N0
-        #  Cl * bl ** 2 * cov^{-1} * Cl if N0
-        #  Now both spectral matrices are symmetric.
-        tmap = lambda i, j: self.lib_datalm.alm2map(
-            self.lib_datalm.almxfl(Pinv_obs1[:, i, j], (2 - (j == i)) * self.cl_transf ** 2))
-
-        for i in range(len(typ)):
-            for j in range(i, len(typ)):
-                F += tmap(i, j) * self.lib_datalm.alm2map(ikx() ** 2 * get_BPBCoviP(i, j, 2))
-        Fxx += _lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fxx , part 2")
-
-        for i in range(len(typ)):
+        # B xi B^t Cov^{-1} (or Cov^-1 Cov_obs Cov^-1 for semi-analytical N0)
+        BPBCovi1 = self._get_xiK(typ, _cls_weights, Pinv_obs1, Pinv_key1)
+        BPBCovi2 = self._get_xiK(typ, _cls_weights, Pinv_obs2, Pinv_key2)
+        xi_w = [[pmat.get_unlPmat_ij(typ, self.lib_datalm, _cls_weights, k, j) for j in range(len(typ))] for k in range(len(typ))]
+        t.checkpoint("  B xi B^t Cov^{-1} matrices")
+
+        ikx = self.lib_datalm.get_ikx()
+        iky = self.lib_datalm.get_iky()
+        b2 = self.cl_transf[self.lib_datalm.reduced_ellmat()] ** 2
+        _maps = self.lib_datalm.alms2maps
+        _sum = lambda maps1, maps2: np.einsum('j...,j...->...', maps1, maps2)
+
+        def get_F(i):  # xx, yy and xy contributions of the i-th row of field pairs
+            # 2.1 GB in memory per map for full sky 16384 ** 2 points. Note however that we can without any loss of
+            # accuracy calculate this using a twice as sparse grid, for reasonable input parameters.
+            F = np.empty((3,) + self.lib_datalm.ell_mat.shape, dtype=float)
+            w = np.array([2. - (i == j) for j in range(i, len(typ))])[:, None]  # symmetry factors of the xx and yy terms
+            # Calculation of (db xi B Cov^{-1} B^t )_{ab}(z) (daxi B Cov^{-1} B^t)^{ba}(z)
+            # ! BPBCovi Matrix not symmetric for TQU or non identical noises. But xx or yy element ok.
+            xmaps = _maps(ikx * BPBCovi1[i])
+            ymaps = _maps(iky * BPBCovi2[:, i])
+            F[2] = _sum(xmaps, ymaps)
+            F[0] = _sum(xmaps[i:], _maps(w * ikx * BPBCovi2[i:, i]))
+            del xmaps
+            F[1] = _sum(_maps(w * iky * BPBCovi1[i, i:]), ymaps[i:])
+            del ymaps
+            # Adding to that (B Cov^-1 B^t)(z) (daxi B Cov^-1 B^t dbxi)(z)
+            # Construct Pmat:
+            #  Cl * bl ** 2 * cov^{-1} cov_obs cov^{-1} * Cl if semianalytic N0
+            #  Cl * bl ** 2 * cov^{-1} * Cl if N0
+            #  Now both spectral matrices are symmetric.
+            BPBCoviP = np.zeros((len(typ) - i, self.lib_datalm.alm_size), dtype=float)
             for j in range(i, len(typ)):
-                F += tmap(i, j) * self.lib_datalm.alm2map(iky() ** 2 * get_BPBCoviP(i, j, 2))
-        Fyy += _lib_qlm.map2alm(F)
-        F *= 0
-        t.checkpoint("  Fyy , part 2")
+                for k in range(len(typ)):
+                    BPBCoviP[j - i] += BPBCovi2[i, k] * xi_w[k][j]
+            tmaps = _maps(w * b2 * Pinv_obs1[:, i, i:].transpose())
+            F[0] += _sum(tmaps, _maps(ikx ** 2 * BPBCoviP))
+            F[1] += _sum(tmaps, _maps(iky ** 2 * BPBCoviP))
+            F[2] += _sum(tmaps, _maps(iky * ikx * BPBCoviP))
+            return F
 
-        for i in range(len(typ)):
-            for j in range(i, len(typ)):
-                F += tmap(i, j) * self.lib_datalm.alm2map(iky() * ikx() * get_BPBCoviP(i, j, 2))
-        Fxy += _lib_qlm.map2alm(F)
-        t.checkpoint("  Fxy , part 2")
+        Fxx, Fyy, Fxy = _lib_qlm.maps2alms(_sum_rows(get_F, len(typ), executor=executor))
+        t.checkpoint("  Fxx , Fyy, Fxy")
 
         facunits = -2. / np.sqrt(np.prod(self.lsides))
         ret = xylms_to_phiOmegalm(_lib_qlm, Fxx.real * facunits, Fyy.real * facunits, Fxy.real * facunits)
@@ -1792,11 +1782,14 @@ class ffs_lencov_alm(ffs_diagcov_alm):
             cls_noise(dict): 't', 'q' and 'u' noise arrays
             f: deflection field, forward operation (e.g. *ffs_displacement* instance)
             fi: deflection field, backward operation (ideally the inverse f-deflection, *f.get_inverse()*)
+            precision(optional): 'double' or 'single'. With 'single', the lensing, transforms and spectral matrix
+                                 multiplications of *apply* and of the preconditioner run in float32 / complex64,
+                                 while their outputs and the conjugate-gradient residuals stay double precision.
 
 
     """
     def __init__(self, lib_dir, lib_datalm, lib_skyalm, cls_unl, cls_len, cl_transf, cls_noise, f, fi,
-                 init_rank=pbs.rank, init_barrier=pbs.barrier):
+                 init_rank=pbs.rank, init_barrier=pbs.barrier, precision='double'):
         assert lib_datalm.ell_mat.lsides == lib_skyalm.ell_mat.lsides, (lib_datalm.ell_mat.lsides, lib_skyalm.ell_mat.lsides)
 
         super(ffs_lencov_alm, self).__init__(lib_dir, lib_datalm, cls_unl, cls_len, cl_transf, cls_noise,
@@ -1814,6 +1807,9 @@ class ffs_lencov_alm(ffs_diagcov_alm):
         assert f.lsides == self.lsides and fi.lsides == self.lsides, (f.lsides, fi.lsides, self.lsides)
         self.fi = fi  # inverse displacement
         self.f = f  # displacement
+        self._skywork = threading.local()  # per-thread work buffer for the sky alms in _apply_signal
+        assert precision in ['double', 'single'], precision
+        self.precision = precision
 
     def hashdict(self):
         h = {'lib_alm': self.lib_datalm.hashdict(), 'lib_skyalm': self.lib_skyalm.hashdict()}
@@ -1840,9 +1836,12 @@ class ffs_lencov_alm(ffs_diagcov_alm):
         setattr(self, 'f', f)
         setattr(self, 'fi', fi)
 
-    def apply(self, typ, alms, use_Pool=0):
+    def apply(self, typ, alms, use_Pool=0, precision=None):
         assert alms.shape == self._datalms_shape(typ), (alms.shape, self._datalms_shape(typ))
-        ret = self._apply_signal(typ, alms, use_Pool=use_Pool)
+        if (precision or self.precision) == 'single':
+            ret = self._apply_signal(typ, alms.astype(np.complex64), use_Pool=use_Pool).astype(complex)
+        else:
+            ret = self._apply_signal(typ, alms, use_Pool=use_Pool)
         ret += self.apply_noise(typ, alms)
         return ret
 
@@ -1858,34 +1857,44 @@ class ffs_lencov_alm(ffs_diagcov_alm):
             for i in range(len(typ)):
                 ret[i] = self.lib_datalm.almxfl(ablms[i], self.cl_transf)
             return ret
-        # could do with less
         t = timer(_timed, prefix=__name__, suffix='apply_signal')
         t.checkpoint("just started")
 
-        tempalms = np.empty(self._skyalms_shape(typ), dtype=complex)
+        work = self._get_skywork(typ, dtype=alms.dtype)
         for _i in range(len(typ)):  # Lens with inverse and mult with determinant magnification.
-            tempalms[_i] = self.fi.lens_alm(self.lib_skyalm,
-                                            self._upg(self.lib_datalm.almxfl(alms[_i], self.cl_transf)),
-                                            lib_alm_out=self.lib_skyalm, mult_magn=True, use_Pool=use_Pool)
-        # NB : 7 new full sky alms for TQU in this routine - > 4 GB total for full sky lmax_sky =  6000.
+            work[_i] = self.fi.lens_alm(self.lib_skyalm,
+                                        self._upg(self.lib_datalm.almxfl(alms[_i], self.cl_transf)),
+                                        lib_alm_out=self.lib_skyalm, mult_magn=True, use_Pool=use_Pool)
+        # NB : sky alms all live in one work buffer, reused from one call (and CG iteration) to the next.
         t.checkpoint("backward lens + det magn")
 
-        skyalms = np.zeros_like(tempalms)
-        for j in range(len(typ)):
-            for i in range(len(typ)):
-                skyalms[i] += pmat.get_unlPmat_ij(typ, self.lib_skyalm, self.cls_unl, i, j) * tempalms[j]
-        del tempalms
+        pmat.apply_unlPmat_inplace(typ, self.lib_skyalm, self.cls_unl, work)
         t.checkpoint("mult with Punl mat ")
 
         for i in range(len(typ)):  # Lens with forward displacement
-            ret[i] = self._deg(self.f.lens_alm(self.lib_skyalm, skyalms[i], use_Pool=use_Pool))
+            work[i] = self.f.lens_alm(self.lib_skyalm, work[i], use_Pool=use_Pool)
+            ret[i] = self._deg(work[i])
         t.checkpoint("Forward lensing mat ")
 
         for i in range(len(typ)):
-            ret[i] = self.lib_datalm.almxfl(ret[i], self.cl_transf)
+            self.lib_datalm.almxfl(ret[i], self.cl_transf, inplace=True)
         t.checkpoint("Beams")
         return ret
 
+    def _get_skywork(self, typ, dtype=complex):
+        """Sky alms work buffer, allocated once per thread and reused by successive *_apply_signal* calls.
+
+            Concurrent calls from different threads (e.g. through executors or iterators sharing this instance)
+            each get their own buffer.
+
+        """
+        shape = self._skyalms_shape(typ)
+        work = getattr(self._skywork, 'buf', None)
+        if work is None or work.shape != shape or work.dtype != dtype:
+            work = np.empty(shape, dtype=dtype)
+            self._skywork.buf = work
+        return work
+
     def _apply_cond3(self, typ, alms, use_Pool=0):
         #(DBxiB ^ tD ^ t + N) ^ -1 \sim D ^ -t(BxiBt + N) ^ -1 D ^ -1
         assert alms.shape == self._datalms_shape(typ), (alms.shape, self._datalms_shape(typ))
@@ -1899,6 +1908,8 @@ class ffs_lencov_alm(ffs_diagcov_alm):
             ret = alms.copy()
             c3GPU(typ, self.lib_datalm, ret, self.f, self.fi, self.cls_unl, self.cl_transf, self.cls_noise)
             return ret
+        if self.precision == 'single':
+            alms = alms.astype(np.complex64)
         temp = np.empty_like(alms)  # Cond. must not change their arguments
         for i in range(len(typ)):  # D^{-1}
             temp[i] = self._deg(self.fi.lens_alm(self.lib_skyalm, self._upg(alms[i]), use_Pool=use_Pool))
@@ -1908,7 +1919,7 @@ class ffs_lencov_alm(ffs_diagcov_alm):
         ret = np.zeros_like(alms)  # (B xi B^t + N)^{-1}
         for i in range(len(typ)):
             for j in range(len(typ)):
-                ret[i] += self._get_pmati(typ, i, j) * temp[j]
+                ret[i] += self._get_pmati(typ, i, j).astype(ret.real.dtype) * temp[j]
         del temp
         t.checkpoint("Mult. w. inv Pmat")
 
@@ -1917,7 +1928,7 @@ class ffs_lencov_alm(ffs_diagcov_alm):
 
         t.checkpoint("Lens w. forward and det magn.")
 
-        return ret
+        return ret.astype(complex, copy=False)
 
     def get_iblms(self, typ, datalms, use_cls_len=False, use_Pool=0, **kwargs):
         r"""Inverse-variance filters input CMB maps
@@ -2082,7 +2093,8 @@ class ffs_lencov_alm(ffs_diagcov_alm):
         fLD = self.f.degrade(LD_shape, no_lensing)
         finvLD = self.fi.degrade(LD_shape, no_lensing)
         return ffs_lencov_alm(lib_dir, lib_datalmLD, lib_skyalmLD,
-                              self.cls_unl, self.cls_len, self.cl_transf, self.cls_noise, fLD, finvLD)
+                              self.cls_unl, self.cls_len, self.cl_transf, self.cls_noise, fLD, finvLD,
+                              precision=self.precision)
 
     def predMFpOlms(self, typ, lib_qlm, use_cls_len=False):
         """
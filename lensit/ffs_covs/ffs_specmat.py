@@ -25,6 +25,16 @@ def _rootCMBcls(cmbCls):
     return {'bb': np.sqrt(cmbCls['bb']), 'tt': ctt, 'ee': cee, 'te': cte}
 
 
+def _get_cossin_2iphi(lib_alm, lms):
+    """cos and sin of twice the mode angle, in single precision for single precision alms.
+
+    """
+    cos, sin = lib_alm.get_cossin_2iphi()
+    if np.asarray(lms).dtype == np.complex64:
+        return cos.astype(np.float32), sin.astype(np.float32)
+    return cos, sin
+
+
 def _clpinv(cl):
     ret = np.zeros_like(cl)
     ret[np.where(cl > 0.)] = 1. / cl[np.where(cl > 0.)]
@@ -74,6 +84,35 @@ def get_unlPmat_ij(typ, lib_alm, cls_cmb, i, j):
         assert 0, (typ, typs)
 
 
+def apply_unlPmat_inplace(typ, lib_alm, cls_cmb, TQUlms, blocksize=2 ** 16):
+    """
+    Multiplies in place T Q U alms with the spectral matrix P(k) (same as summing get_unlPmat_ij(i, j) * TQUlms[j]).
+    Modes are processed in blocks of size blocksize, such that only block-sized temporaries are created.
+    This assumes C_TB = 0, C_EB = 0.
+    """
+    assert typ in typs, (typ, typs)
+    assert TQUlms.shape == (len(typ), lib_alm.alm_size), (TQUlms.shape, len(typ), lib_alm.alm_size)
+    assert (not 'tb' in cls_cmb.keys() and not 'eb' in cls_cmb.keys())
+    ell = lib_alm.reduced_ellmat()
+    if typ != 'T':
+        cos, sin = lib_alm.get_cossin_2iphi()  # in mmap mode 'r' in principle.
+    for start in range(0, lib_alm.alm_size, blocksize):
+        sl = slice(start, start + blocksize)
+        fl = lambda key: cls_cmb[key][ell[sl]]
+        if typ == 'T':
+            TQUlms[0, sl] *= fl('tt')
+            continue
+        c, s = cos[sl], sin[sl]
+        Elm = c * TQUlms[-2, sl] + s * TQUlms[-1, sl]
+        Blm = fl('bb') * (-s * TQUlms[-2, sl] + c * TQUlms[-1, sl])
+        if typ == 'TQU':
+            Elm, TQUlms[0, sl] = fl('te') * TQUlms[0, sl] + fl('ee') * Elm, fl('tt') * TQUlms[0, sl] + fl('te') * Elm
+        else:
+            Elm *= fl('ee')
+        TQUlms[-2, sl] = c * Elm - s * Blm
+        TQUlms[-1, sl] = s * Elm + c * Blm
+
+
 def get_rootunlPmat_ij(typ, lib_alm, cls_cmb, i, j):
     if i < j: return get_rootunlPmat_ij(typ, lib_alm, cls_cmb, j, i)
     if typ == 'T':
@@ -523,10 +562,10 @@ def TQU2TEBlms(typ, lib_alm, TQUlms):
     if typ == 'T':
         return np.array(TQUlms).copy()
     elif typ == 'QU':
-        cos, sin = lib_alm.get_cossin_2iphi()
+        cos, sin = _get_cossin_2iphi(lib_alm, TQUlms)
         return np.array([cos * TQUlms[0] + sin * TQUlms[1], -sin * TQUlms[0] + cos * TQUlms[1]])
     elif typ == 'TQU':
-        cos, sin = lib_alm.get_cossin_2iphi()
+        cos, sin = _get_cossin_2iphi(lib_alm, TQUlms)
         return np.array([TQUlms[0], cos * TQUlms[1] + sin * TQUlms[2], -sin * TQUlms[1] + cos * TQUlms[2]])
     else:
         assert 0, (typ, typs)
@@ -546,10 +585,10 @@ def TEB2TQUlms(typ, lib_alm, TEBlms):
     if typ == 'T':
         return np.array(TEBlms).copy()
     elif typ == 'QU':
-        cos, sin = lib_alm.get_cossin_2iphi()
+        cos, sin = _get_cossin_2iphi(lib_alm, TEBlms)
         return np.array([cos * TEBlms[0] - sin * TEBlms[1], sin * TEBlms[0] + cos * TEBlms[1]])
     elif typ == 'TQU':
-        cos, sin = lib_alm.get_cossin_2iphi()
+        cos, sin = _get_cossin_2iphi(lib_alm, TEBlms)
         return np.array([TEBlms[0], cos * TEBlms[1] - sin * TEBlms[2], sin * TEBlms[1] + cos * TEBlms[2]])
 
 
@@ -14,9 +14,12 @@ except ImportError:
 from lensit.misc import map_spliter
 from lensit.misc import misc_utils as utils
 from lensit.misc import rfft2_utils
+from lensit.misc.profiler import profiled
 from lensit.misc.misc_utils import PartialDerivativePeriodic as PDP, Log2ofPowerof2, Freq, flatindices
 from lensit.pbs import pbs
 
+_lens_chunksize = 2 ** 16  # number of pixels deflected in one bicubic call by lens_map
+
 
 class ffs_displacement(object):
     r"""Flat-sky deflection-field class
@@ -97,13 +100,13 @@ class ffs_displacement(object):
 
     def get_dx(self):
         if isinstance(self.dx, str):
-            return np.load(self.dx)
+            return np.asarray(np.load(self.dx), dtype=float)  # may be stored in single precision
         else:
             return self.dx
 
     def get_dy(self):
         if isinstance(self.dy, str):
-            return np.load(self.dy)
+            return np.asarray(np.load(self.dy), dtype=float)
         else:
             return self.dy
 
@@ -138,6 +141,7 @@ class ffs_displacement(object):
         else:
             assert 0, crude
 
+    @profiled('lensing')
     def lens_map(self, m, use_Pool=0, crude=0, do_not_prefilter=False):
         """Lens the input flat-sky map, using a bicubic spline interpolation algorithm
 
@@ -153,6 +157,10 @@ class ffs_displacement(object):
 
             Returns: deflected real-space map (array)
 
+            Note:
+                single precision (float32) input maps are lensed in single precision, with float32 output,
+                while the deflected coordinates are always computed in double precision.
+
 
         """
         assert self.load_map(m).shape == self.shape, (self.load_map(m).shape, self.shape)
@@ -192,21 +200,31 @@ class ffs_displacement(object):
 
         elif use_Pool == 0 or use_Pool == 1:
             assert self.shape[0] == self.shape[1], self.shape
+            m = self.load_map(m)
+            single = m.dtype == np.float32 and hasattr(bicubic, 'deflect_sp')
+            dtype = np.float32 if single else np.float64
+            deflect = bicubic.deflect_sp if single else bicubic.deflect
             if do_not_prefilter:
-                filtmap = self.load_map(m).astype(np.float64)
+                filtmap = np.asfortranarray(m, dtype=dtype)
             else:
                 # TODO : may want to add pyFFTW here as well
-                filtmap = np.fft.rfft2(self.load_map(m))
+                filtmap = np.fft.rfft2(m.astype(dtype, copy=False))
                 w0 = 6. / (2. * np.cos(2. * np.pi * np.fft.fftfreq(filtmap.shape[0])) + 4.)
-                filtmap *= np.outer(w0, w0[0:filtmap.shape[1]])
+                filtmap *= np.outer(w0, w0[0:filtmap.shape[1]]).astype(dtype)
                 filtmap = np.fft.irfft2(filtmap, self.shape)
 
-            i = np.arange(int(np.prod(self.shape)), dtype=int)
-            # new coordinates in grid units:
-            x_gu = self.get_dx_ingridunits().flatten() + i % self.shape[1]
-            y_gu = self.get_dy_ingridunits().flatten() + i // self.shape[1]
-            del i
-            return bicubic.deflect(filtmap, x_gu , y_gu).reshape(self.shape)
+            # fortran ordered once here, else the bicubic wrapper copies it on every call:
+            filtmap = np.asfortranarray(filtmap)
+            dx, dy = self.get_dx(), self.get_dy()
+            lensed_map = np.empty(self.shape, dtype=dtype)
+            nrows = max(1, _lens_chunksize // self.shape[1])
+            for r0 in range(0, self.shape[0], nrows):
+                sl = slice(r0, min(r0 + nrows, self.shape[0]))
+                # new coordinates in grid units, only for this block of rows:
+                x_gu = dx[sl] / self.rmin[1] + np.arange(self.shape[1])[np.newaxis, :]
+                y_gu = dy[sl] / self.rmin[0] + np.arange(sl.start, sl.stop)[:, np.newaxis]
+                lensed_map[sl] = deflect(filtmap, x_gu.ravel(), y_gu.ravel()).reshape(x_gu.shape)
+            return lensed_map.astype(np.float32, copy=False) if m.dtype == np.float32 else lensed_map
 
     def lens_alm(self, lib_alm, alm, lib_alm_out=None, mult_magn=False, use_Pool=0):
         """Returns lensed harmonic coefficients from the unlensed input coefficients
@@ -237,7 +255,7 @@ class ffs_displacement(object):
 
     def mult_wmagn(self, m, inplace=False):
         if not inplace:
-            return self.get_det_magn() * m
+            return self.get_det_magn().astype(m.dtype, copy=False) * m
         else:
             m *= self.get_det_magn()
             return
@@ -266,6 +284,20 @@ class ffs_displacement(object):
             return self.lens_map(lib_alm.alm2map(lib_alm.bicubic_prefilter(alm)),
                                  use_Pool=use_Pool, do_not_prefilter=True, crude=crude)
 
+    def _calc_det_magn(self):
+        # products accumulated in place, keeping at most two gradient maps alive at a time
+        dx, dy = self.get_dx(), self.get_dy()
+        det = PDP(dx, axis=1, h=self.rmin[1], rule=self.rule)
+        det += 1.
+        temp = PDP(dy, axis=0, h=self.rmin[0], rule=self.rule)
+        temp += 1.
+        det *= temp
+        del temp
+        temp = PDP(dy, axis=1, h=self.rmin[1], rule=self.rule)
+        temp *= PDP(dx, axis=0, h=self.rmin[0], rule=self.rule)
+        det -= temp
+        return det
+
     def get_det_magn(self):
         r"""Returns magnification determinant map
 
@@ -275,21 +307,14 @@ class ffs_displacement(object):
         """
         # FIXME : bad
         if not self.cache_magn:
-            det = (PDP(self.get_dx(), axis=1, h=self.rmin[1], rule=self.rule) + 1.) \
-                  * (PDP(self.get_dy(), axis=0, h=self.rmin[0], rule=self.rule) + 1.)
-            det -= PDP(self.get_dy(), axis=1, h=self.rmin[1], rule=self.rule) * \
-                   PDP(self.get_dx(), axis=0, h=self.rmin[0], rule=self.rule)
-            return det
+            return self._calc_det_magn()
         else:
             assert self.lib_dir is not None, 'Specify lib_dir if you want to cache magn'
             fname = os.path.join(self.lib_dir, 'det_magn_%s_%s_rank%s.npy' % \
                                    (hashlib.sha1(self.get_dx()[0, 0:100]).hexdigest(),
                                     hashlib.sha1(self.get_dy()[0, 0:100]).hexdigest(), pbs.rank))
             if not os.path.exists(fname):  # and pbs.rank == 0:
-                det = (PDP(self.get_dx(), axis=1, h=self.rmin[1], rule=self.rule) + 1.) \
-                      * (PDP(self.get_dy(), axis=0, h=self.rmin[0], rule=self.rule) + 1.)
-                det -= PDP(self.get_dy(), axis=1, h=self.rmin[1], rule=self.rule) * \
-                       PDP(self.get_dx(), axis=0, h=self.rmin[0], rule=self.rule)
+                det = self._calc_det_magn()
                 print("  ffs_displacement caching ", fname)
                 np.save(fname, det)
                 del det
@@ -362,6 +387,7 @@ class ffs_displacement(object):
         else:
             assert 0, crude
 
+    @profiled('inverse')
     def get_inverse(self, NR_iter=None, use_Pool=0, crude=0, HD_res=None):
         """Builds deflection field inverse
 
@@ -150,3 +150,124 @@ class BFGS_Hessian(object):
         for idx, i in enumerate(range(np.max([0, k - self.L]), k)):
             ret = ret - self.s(i) * np.sum(self.y(i) * ret) * rho(i) + np.sqrt(rho(i)) * self.s(i) * eps[idx]
         return ret
+
+
+class fixed_step(object):
+    """Newton step length rule without line search.
+
+        Args:
+            step_length: step length, or function(it, norm_incr) returning it
+
+    """
+
+    def __init__(self, step_length=1.):
+        self.step_length = step_length
+        self.trials = []
+
+    def __call__(self, it, norm_incr, phi, dphi):
+        """Returns the step length along the search direction at iter *it*.
+
+            Args:
+                it: iteration index
+                norm_incr: norm of the full Newton increment (relative to the starting point)
+                phi: function of the step length giving the log-posterior (or a model of it)
+                dphi: its derivative
+
+        """
+        self.trials = []
+        return self.step_length(it, norm_incr) if callable(self.step_length) else self.step_length
+
+
+class wolfe_linesearch(object):
+    """Line search along the search direction, accepting steps satisfying the strong Wolfe conditions.
+
+        Follows Nocedal & Wright algorithms 3.5 and 3.6 (bracketing followed by safeguarded cubic interpolation).
+        The trial (step length, phi, dphi) evaluations of the last search are kept in *self.trials*.
+
+        Args:
+            c1: sufficient decrease parameter
+            c2: curvature condition parameter
+            step0: first trial step
+            step_max: largest step length allowed
+            maxiter: maximal number of evaluations in each of the two stages
+
+    """
+
+    def __init__(self, c1=1e-4, c2=0.9, step0=1., step_max=2., maxiter=10):
+        assert 0. < c1 < c2 < 1., (c1, c2)
+        self.c1 = c1
+        self.c2 = c2
+        self.step0 = step0
+        self.step_max = step_max
+        self.maxiter = maxiter
+        self.trials = []
+
+    def _eval(self, phi, dphi, a):
+        ret = (a, phi(a), dphi(a))
+        self.trials.append(ret)
+        return ret
+
+    @staticmethod
+    def _interpolate(lo, hi):
+        """Minimizer of the cubic interpolant, safeguarded by bisection.
+
+        """
+        (a_lo, phi_lo, dphi_lo), (a_hi, phi_hi, dphi_hi) = lo, hi
+        d1 = dphi_lo + dphi_hi - 3. * (phi_lo - phi_hi) / (a_lo - a_hi)
+        d2sq = d1 ** 2 - dphi_lo * dphi_hi
+        a = 0.5 * (a_lo + a_hi)
+        if d2sq >= 0.:
+            d2 = np.sign(a_hi - a_lo) * np.sqrt(d2sq)
+            denom = dphi_hi - dphi_lo + 2. * d2
+            if denom != 0.:
+                a = a_hi - (a_hi - a_lo) * (dphi_hi + d2 - d1) / denom
+        delta = 0.1 * abs(a_hi - a_lo)
+        if not min(a_lo, a_hi) + delta <= a <= max(a_lo, a_hi) - delta:
+            a = 0.5 * (a_lo + a_hi)
+        return a
+
+    def _zoom(self, phi, dphi, phi0, dphi0, lo, hi):
+        for i in range(self.maxiter):
+            trial = self._eval(phi, dphi, self._interpolate(lo, hi))
+            a, phi_a, dphi_a = trial
+            if phi_a > phi0 + self.c1 * a * dphi0 or phi_a >= lo[1]:
+                hi = trial
+            else:
+                if abs(dphi_a) <= -self.c2 * dphi0:
+                    return a
+                if dphi_a * (hi[0] - lo[0]) >= 0.:
+                    hi = lo
+                lo = trial
+        return lo[0]
+
+    def __call__(self, it, norm_incr, phi, dphi):
+        """Returns the step length along the search direction at iter *it*.
+
+            Args:
+                it: iteration index
+                norm_incr: norm of the full Newton increment (relative to the starting point)
+                phi: function of the step length giving the log-posterior (or a model of it)
+                dphi: its derivative
+
+        """
+        self.trials = []
+        prev = self._eval(phi, dphi, 0.)
+        phi0, dphi0 = prev[1:]
+        if dphi0 >= 0.:
+            print('wolfe_linesearch: not a descent direction (dphi %.3e), using step %s' % (dphi0, self.step0))
+            return self.step0
+        a = min(self.step0, self.step_max)
+        for i in range(self.maxiter):
+            trial = self._eval(phi, dphi, a)
+            a, phi_a, dphi_a = trial
+            if phi_a > phi0 + self.c1 * a * dphi0 or (i > 0 and phi_a >= prev[1]):
+                return self._zoom(phi, dphi, phi0, dphi0, prev, trial)
+            if abs(dphi_a) <= -self.c2 * dphi0:
+                return a
+            if dphi_a >= 0.:
+                return self._zoom(phi, dphi, phi0, dphi0, trial, prev)
+            if a >= self.step_max:
+                return a
+            prev = trial
+            a = min(2. * a, self.step_max)
+        return a
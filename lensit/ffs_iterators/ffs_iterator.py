@@ -2,8 +2,10 @@ from __future__ import print_function
 
 import glob
 import os
+import re
 import shutil
 import time
+import pickle as pk
 
 import numpy as np
 
@@ -11,14 +13,26 @@ from lensit.pbs import pbs
 from lensit.ffs_deflect import ffs_deflect
 from lensit.ffs_qlms import qlms as ql
 from lensit.ffs_covs import ffs_specmat, ffs_cov
-from lensit.misc.misc_utils import PartialDerivativePeriodic as PDP, cl_inverse
+from lensit.misc.misc_utils import PartialDerivativePeriodic as PDP, cl_inverse, npy_hash
+from lensit.misc import profiler
 from lensit.ffs_iterators import bfgs
-from lensit.qcinv import multigrid, chain_samples
+from lensit.qcinv import multigrid, chain_samples, cd_solve
 from lensit.sims import ffs_phas
 
 _types = ['T', 'QU', 'TQU']
 
 
+def _move(src, dst):
+    """os.replace, also on python 2 (where os.rename fails if *dst* exists on some platforms)
+
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        if os.path.exists(dst): os.remove(dst)
+        os.rename(src, dst)
+
+
 def prt_time(dt, label=''):
     dh = np.floor(dt / 3600.)
     dm = np.floor(np.mod(dt, 3600.) / 60.)
@@ -27,6 +41,75 @@ def prt_time(dt, label=''):
     return
 
 
+class crit_gradnorm(object):
+    """Convergence criterion on the total gradient norm, relative to the first iteration one.
+
+    """
+    def __init__(self, tol):
+        self.tol = tol
+        self.label = 'gradnorm'
+
+    def __call__(self, itlib, it, key):
+        """Returns criterion value after iteration *it* and whether it is met.
+
+        """
+        ret = itlib._calc_norm(itlib.load_total_grad(it - 1, key)) / itlib._calc_norm(itlib.load_total_grad(0, key))
+        return ret, ret < self.tol
+
+
+class crit_plmincr(object):
+    """Convergence criterion on the power of the last increment, relative to that of the estimate, in L bins.
+
+        Met if below tolerance in all bins. Never met if no bin has power (e.g. all above the lmax of the estimate).
+
+    """
+    def __init__(self, tol, ellbins=(2, 200, 500, 1000, 2000, 4000)):
+        self.tol = tol
+        self.ellbins = ellbins
+        self.label = 'plmincr'
+
+    def __call__(self, itlib, it, key):
+        plm = itlib.get_Plm(it, key)
+        cl_incr = itlib.lib_qlm.alm2cl(plm - itlib.get_Plm(it - 1, key))
+        cl_plm = itlib.lib_qlm.alm2cl(plm)
+        ratios = []
+        for lmin, lmax in zip(self.ellbins[:-1], self.ellbins[1:]):
+            if lmin > itlib.lmax_qlm or np.sum(cl_plm[lmin:lmax]) <= 0.: continue
+            ratios.append(np.sum(cl_incr[lmin:lmax]) / np.sum(cl_plm[lmin:lmax]))
+        if len(ratios) == 0:
+            return np.inf, False
+        ret = np.max(ratios)
+        return ret, ret < self.tol
+
+
+class crit_loglik(object):
+    """Convergence criterion on the change in log-posterior between iterations, relative to that of the first step.
+
+        The change from phi_{k-1} to phi_k is obtained from the total gradients at both ends (trapezoidal rule, exact for
+        a quadratic posterior). The gradient at phi_k is only built at iteration k + 1, so that after iteration *it*
+        the last available change is that of step it - 1. Never met before iteration 2.
+
+    """
+    def __init__(self, tol):
+        self.tol = tol
+        self.label = 'loglik'
+
+    @staticmethod
+    def get_change(itlib, k, key):
+        """Change in log-posterior from phi_{k-1} to phi_k (requires the total gradient at k).
+
+        """
+        rlm = itlib.lib_qlm.alm2rlm
+        g = itlib.load_total_grad(k - 1, key) + itlib.load_total_grad(k, key)
+        return 0.5 * np.sum(rlm(g) * rlm(itlib.get_Plm(k, key) - itlib.get_Plm(k - 1, key)))
+
+    def __call__(self, itlib, it, key):
+        if it < 2:
+            return np.inf, False
+        ret = np.abs(self.get_change(itlib, it - 1, key) / self.get_change(itlib, 1, key))
+        return ret, ret < self.tol
+
+
 class ffs_iterator(object):
     r"""Flat-sky iterator template class
 
@@ -40,13 +123,27 @@ class ffs_iterator(object):
             H0: initial isotropic likelihood curvature approximation (roughly, inverse lensing noise bias :math:`N^{(0)}_L`)
             cpp_prior: fiducial lensing power spectrum, used for the prior part of the posterior density.
             chain_descr: multigrid conjugate gradient inversion chain description
+            nrecycle: number of deflation vectors recycled from one Wiener-filter solve to the next (0 to disable).
+                      The basis is kept in memory only, and costs 8 * nrecycle alm arrays per key.
+            soltn_precision: 'double' or 'single', precision of the Wiener-filter solutions stored on disk as starting
+                             points of the next iteration solves. These are discarded if the filter or data change.
+            steplength: Newton step length rule along the BFGS direction (e.g. *bfgs.wolfe_linesearch()*).
+                        Defaults to the fixed step. Accepted steps are recorded in history_increment.txt,
+                        trial evaluations in history_linesearch.txt
+            f_nkeep: number of most recent displacements (and inverses) kept on disk as they are (all if None)
+            f_storage: 'float32' or 'plm', storage of the older ones: single precision, or removed altogether
+                       (displacements are regenerated from their plm by rank 0 if ever needed)
+            f_budget: total disk budget (in GB) of the displacements. Once exceeded, the oldest are removed first.
+            mchains(optional): dictionary of multigrid chains shared with other iterators using the same filter
+                               (see *get_mchain*)
 
 
     """
     def __init__(self, lib_dir, typ, filt, dat_maps, lib_qlm, Plm0, H0, cpp_prior,
                  use_Pool_lens=0, use_Pool_inverse=0, chain_descr=None, opfilt=None, soltn0=None, cache_magn=False,
                  no_deglensing=False, NR_method=100, tidy=10, verbose=True, maxcgiter=150, PBSSIZE=None, PBSRANK=None,
-                 **kwargs):
+                 nrecycle=0, soltn_precision='double', steplength=None, f_nkeep=None, f_storage='float32',
+                 f_budget=None, mchains=None, **kwargs):
 
         assert typ in _types
         assert chain_descr is not None
@@ -75,10 +172,19 @@ class ffs_iterator(object):
         self.NR_method = NR_method
 
         self.tidy = tidy
+        assert f_nkeep is None or f_nkeep >= 1, f_nkeep
+        assert f_storage in ['float32', 'plm'], f_storage
+        self.f_nkeep = f_nkeep
+        self.f_storage = f_storage
+        self.f_budget = f_budget
         self.maxiter = maxcgiter
         self.verbose = verbose
 
         self.nodeglensing = no_deglensing
+        self._mchains = {} if mchains is None else mchains  # multigrid chains reused across iterations, see get_mchain
+        # Krylov subspaces recycled across the data Wiener-filter solves of successive iterations:
+        self.deflation = {key: cd_solve.deflation_space(nvecs=nrecycle, ncollect=3 * nrecycle)
+                          for key in ['p', 'o']} if nrecycle > 0 else {}
         if self.verbose:
             print(" I see t", filt.Nlev_uKamin('t'))
             print(" I see q", filt.Nlev_uKamin('q'))
@@ -94,7 +200,10 @@ class ffs_iterator(object):
             return 0.5
 
         self.newton_step_length = newton_step_length
+        self.steplength = bfgs.fixed_step(newton_step_length) if steplength is None else steplength
         self.soltn0 = soltn0
+        assert soltn_precision in ['double', 'single'], soltn_precision
+        self.soltn_precision = soltn_precision
 
         f_id = ffs_deflect.ffs_id_displacement(filt.lib_skyalm.shape, filt.lib_skyalm.lsides)
         if not hasattr(filt, 'f') or not hasattr(filt, 'fi'):
@@ -106,9 +215,6 @@ class ffs_iterator(object):
             if not os.path.exists(self.lib_dir): os.makedirs(self.lib_dir)
         self.barrier()
 
-        #FIXME
-        #self.soltn_cond = np.all([np.all(self.filt.get_mask(_t) == 1.) for _t in self.type])
-        self.soltn_cond = False
         print('ffs iterator : This is %s trying to setup %s' % (self.PBSRANK, lib_dir))
         # Lensed covariance matrix library :
         # We will redefine the displacement at each iteration step
@@ -122,6 +228,7 @@ class ffs_iterator(object):
                 os.makedirs(self.lib_dir + '/MAPlms')
             if not os.path.exists(self.lib_dir + '/cghistories'):
                 os.makedirs(self.lib_dir + '/cghistories')
+            self._check_soltns()
 
         # pre_calculation of qlm_norms with rank 0:
         if self.PBSRANK == 0 and \
@@ -175,19 +282,24 @@ class ffs_iterator(object):
         else:
             assert self.load_qlm(alm).ndim == 1 and self.load_qlm(alm).size == self.lib_qlm.alm_size
             print('rank %s caching ' % self.PBSRANK + fname)
-            self.lib_qlm.write_alm(fname, self.load_qlm(alm))
+            with profiler.phase('io'):
+                self.lib_qlm.write_alm(fname, self.load_qlm(alm))
             return
 
     def load_qlm(self, fname):
-        return self.lib_qlm.read_alm(fname) if isinstance(fname, str) else fname
+        if not isinstance(fname, str): return fname
+        with profiler.phase('io'):
+            return self.lib_qlm.read_alm(fname)
 
     def cache_rlm(self, fname, rlm):
         assert rlm.ndim == 1 and rlm.size == 2 * self.lib_qlm.alm_size, (rlm.ndim, rlm.size)
         print('rank %s caching ' % self.PBSRANK, fname)
-        np.save(fname, rlm)
+        with profiler.phase('io'):
+            np.save(fname, rlm)
 
     def load_rlm(self, fname):
-        rlm = np.load(fname)
+        with profiler.phase('io'):
+            rlm = np.load(fname)
         assert rlm.ndim == 1 and rlm.size == 2 * self.lib_qlm.alm_size, (rlm.ndim, rlm.size)
         return rlm
 
@@ -249,12 +361,95 @@ class ffs_iterator(object):
         fname_dy = os.path.join(self.lib_dir,  'finv_%s_it%03d_dy.npy' % (key.lower(), it))
         return fname_dx, fname_dy
 
+    def _get_f_its(self, key):
+        """Iterations with displacement arrays on disk.
+
+        """
+        pattern = re.compile(r'f_%s_it(\d+)_dx\.npy$' % key.lower())
+        matches = [pattern.match(fn) for fn in os.listdir(self.lib_dir)]
+        return sorted([int(m.group(1)) for m in matches if m is not None])
+
+    def _get_f_diskusage(self, it, key):
+        """Disk usage in GB of the displacement and inverse displacement at iteration *it*.
+
+        """
+        ret = 0
+        for fname in self._getfnames_f(key, it) + self._getfnames_finv(key, it):
+            if os.path.exists(fname): ret += os.path.getsize(fname)
+        for lib_dir in [os.path.join(self.lib_dir, 'f_%04d_libdir' % it),
+                        os.path.join(self.lib_dir, 'finv_%04d_libdir' % it)]:
+            for root, dirs, files in os.walk(lib_dir):
+                ret += sum([os.path.getsize(os.path.join(root, fn)) for fn in files])
+        return ret / 1024. ** 3
+
+    def _store_f(self, it, key, storage):
+        """Converts the displacement and inverse at iteration *it* on disk to single precision, or removes them.
+
+        """
+        assert self.PBSRANK == 0, 'NO MPI METHOD'
+        for fname in self._getfnames_f(key, it) + self._getfnames_finv(key, it):
+            if not os.path.exists(fname): continue
+            if storage == 'float32':
+                d = np.load(fname, mmap_mode='r')
+                if d.dtype != np.float32:
+                    with open(fname + '.tmp', 'wb') as file:
+                        np.save(file, d.astype(np.float32))
+                    _move(fname + '.tmp', fname)
+            else:
+                os.remove(fname)
+        if storage == 'plm':
+            for lib_dir in [os.path.join(self.lib_dir, 'f_%04d_libdir' % it),
+                            os.path.join(self.lib_dir, 'finv_%04d_libdir' % it)]:
+                if os.path.exists(lib_dir): shutil.rmtree(lib_dir)
+
+    def _apply_f_storage(self, key):
+        """Applies the storage policy (*f_nkeep*, *f_storage*, *f_budget*) to the displacements on disk.
+
+            The most recent displacement is never touched.
+
+        """
+        assert self.PBSRANK == 0, 'NO MPI METHOD'
+        its = self._get_f_its(key)
+        if self.f_nkeep is not None:
+            for it in its[:-self.f_nkeep]:
+                self._store_f(it, key, self.f_storage)
+            if self.f_storage == 'plm': its = its[-self.f_nkeep:]
+        if self.f_budget is not None:
+            usage = [self._get_f_diskusage(it, key) for it in its]
+            total = np.sum(usage)
+            for it, size in zip(its[:-1], usage[:-1]):
+                if total <= self.f_budget: break
+                print('rank %s removing displacement it. %s (%.2f GB on disk above budget)' % (
+                    self.PBSRANK, it, total - self.f_budget))
+                self._store_f(it, key, 'plm')
+                total -= size
+            if total > self.f_budget:
+                print('rank %s: displacements use %.2f GB, above budget of %.2f GB' % (self.PBSRANK, total, self.f_budget))
+
     def _calc_ffinv(self, it, key):
         """Calculates displacement at iter and its inverse. Only mpi rank 0 can do this.
 
+            Timings are logged in cghistories/history_ffinv.txt
+
         """
         assert self.PBSRANK == 0, 'NO MPI METHOD'
         if it < 0: return
+        t0 = time.time()
+        self._calc_f(it, key)
+        t1 = time.time()
+        self._calc_finv(it, key)
+        t2 = time.time()
+        print('rank %s displacement it. %s: %.2fs, inverse %.2fs' % (self.PBSRANK, it, t1 - t0, t2 - t1))
+        with open(os.path.join(self.lib_dir, 'cghistories', 'history_ffinv.txt'), 'a') as file:
+            file.write('%04d %s %.3f %.3f \n' % (it, key.lower(), t1 - t0, t2 - t1))
+            file.close()
+        return
+
+    def _calc_f(self, it, key):
+        """Calculates displacement at iter. Only mpi rank 0 can do this.
+
+        """
+        assert self.PBSRANK == 0, 'NO MPI METHOD'
         assert key.lower() in ['p', 'o'], key  # potential or curl potential.
         fname_dx, fname_dy = self._getfnames_f(key, it)
 
@@ -277,20 +472,28 @@ class ffs_iterator(object):
                 np.save(fname_dx, dx)
                 np.save(fname_dy, dy)
             del dx, dy
-        lib_dir = os.path.join(self.lib_dir, 'f_%04d_libdir' % it)
-        if not os.path.exists(lib_dir): os.makedirs(lib_dir)
+        for lib_dir in [os.path.join(self.lib_dir, 'f_%04d_libdir' % it),
+                        os.path.join(self.lib_dir, 'finv_%04d_libdir' % it)]:
+            if not os.path.exists(lib_dir): os.makedirs(lib_dir)
+
+    def _calc_finv(self, it, key):
+        """Calculates the inverse displacement at iter. Only mpi rank 0 can do this.
+
+            The arrays are written under temporary names and then moved, so their presence on disk means completion.
+
+        """
+        assert self.PBSRANK == 0, 'NO MPI METHOD'
         fname_invdx, fname_invdy = self._getfnames_finv(key, it)
         if not os.path.exists(fname_invdx) or not os.path.exists(fname_invdy):
             f = self._load_f(it, key)
             print('rank %s inverting displacement it. %s for key %s' % (self.PBSRANK, it, key))
             f_inv = f.get_inverse(use_Pool=self.use_Pool_inverse)
-            np.save(fname_invdx, f_inv.get_dx())
-            np.save(fname_invdy, f_inv.get_dy())
-        lib_dir = os.path.join(self.lib_dir, 'finv_%04d_libdir' % it)
-        if not os.path.exists(lib_dir): os.makedirs(lib_dir)
+            for fname, d in zip([fname_invdy, fname_invdx], [f_inv.get_dy(), f_inv.get_dx()]):
+                with open(fname + '.tmp', 'wb') as file:
+                    np.save(file, d)
+                _move(fname + '.tmp', fname)
         assert os.path.exists(fname_invdx), fname_invdx
         assert os.path.exists(fname_invdy), fname_invdy
-        return
 
     def _load_f(self, it, key):
         """Loads current displacement solution at iteration iter
@@ -298,6 +501,8 @@ class ffs_iterator(object):
         """
         fname_dx, fname_dy = self._getfnames_f(key, it)
         lib_dir = os.path.join(self.lib_dir,  'f_%04d_libdir' % it)
+        if self.PBSRANK == 0 and not (os.path.exists(fname_dx) and os.path.exists(fname_dy)):
+            self._calc_f(it, key)  # may have been removed by the storage policy
         assert os.path.exists(fname_dx), fname_dx
         assert os.path.exists(fname_dx), fname_dy
         assert os.path.exists(lib_dir), lib_dir
@@ -310,27 +515,73 @@ class ffs_iterator(object):
         """
         fname_invdx, fname_invdy = self._getfnames_finv(key, it)
         lib_dir = os.path.join(self.lib_dir, 'finv_%04d_libdir' % it)
+        if self.PBSRANK == 0 and not (os.path.exists(fname_invdx) and os.path.exists(fname_invdy)):
+            self._calc_f(it, key)  # may have been removed by the storage policy
+            self._calc_finv(it, key)
         assert os.path.exists(fname_invdx), fname_invdx
         assert os.path.exists(fname_invdx), fname_invdy
         assert os.path.exists(lib_dir), lib_dir
         return ffs_deflect.ffs_displacement(fname_invdx, fname_invdy, self.lsides,
                                             verbose=(self.PBSRANK == 0), lib_dir=lib_dir, cache_magn=self.cache_magn)
 
-    def load_soltn(self, it, key):
+    def soltns_hashdict(self):
+        """Filter and data the cached Wiener-filter solutions are consistent with.
+
+            The displacement is not part of it, solutions are reused from one iteration to the next.
+
+        """
+        dat = self.get_datmaps()
+        return {'filt': self.cov.hashdict(), 'dat': npy_hash(dat, astype=np.complex64 if np.iscomplexobj(dat) else np.float32),
+                'type': self.type, 'opfilt': self.opfilt.__name__}
+
+    def _check_soltns(self):
+        """Removes the cached Wiener-filter solutions if they were obtained with another filter or data.
+
+        """
+        lib_dir = os.path.join(self.lib_dir, 'soltns')
+        fn_hash = os.path.join(lib_dir, 'soltns_hash.pk')
+        if os.path.exists(fn_hash) and pk.load(open(fn_hash, 'rb')) != self.soltns_hashdict():
+            print('ffs iterator : filter or data changed, resetting Wiener-filter solutions in ' + lib_dir)
+            shutil.rmtree(lib_dir)
+        if not os.path.exists(lib_dir):
+            os.makedirs(lib_dir)
+        if not os.path.exists(fn_hash):
+            pk.dump(self.soltns_hashdict(), open(fn_hash, 'wb'), protocol=2)
+
+    def _getfname_soltn(self, key, idx=-1, tag=''):
+        lab = 'dat' if idx < 0 else 'sim%04d' % idx
+        return os.path.join(self.lib_dir, 'soltns', 'soltn_%s_%s%s.npy' % (key.lower(), lab, tag))
+
+    def load_soltn(self, it, key, idx=-1, tag=''):
+        """Starting point of the Wiener-filter solve of the data (idx < 0) or of MC sim *idx* at iteration *it*.
+
+            This is the last solution cached for the same filter and data if any, *soltn0* or zero otherwise.
+
+        """
         assert key.lower() in ['p', 'o']
-        for i in np.arange(it, -1, -1):
-            fname = os.path.join(self.lib_dir, 'MAPlms/Mlik_%s_it%s.npy' % (key.lower(), i))
-            if os.path.exists(fname):
-                print("rank %s loading " % pbs.rank + fname)
-                return np.load(fname)
-        if self.soltn0 is not None: return np.load(self.soltn0)[:self.opfilt.TEBlen(self.type)]
+        fname = self._getfname_soltn(key, idx=idx, tag=tag)
+        if os.path.exists(fname):
+            print("rank %s loading " % self.PBSRANK + fname)
+            with profiler.phase('io'):
+                return np.load(fname).astype(complex)
+        if self.soltn0 is not None and idx < 0: return np.load(self.soltn0)[:self.opfilt.TEBlen(self.type)]
         return np.zeros((self.opfilt.TEBlen(self.type), self.cov.lib_skyalm.alm_size), dtype=complex)
 
+    def cache_soltn(self, soltn, key, idx=-1, tag=''):
+        """Stores a Wiener-filter solution as starting point for the next iteration.
+
+        """
+        assert key.lower() in ['p', 'o']
+        dtype = np.complex64 if self.soltn_precision == 'single' else complex
+        with profiler.phase('io'):
+            np.save(self._getfname_soltn(key, idx=idx, tag=tag), soltn.astype(dtype))
+
     def _cache_tebwf(self, TEBMAP, it, key):
         assert key.lower() in ['p', 'o']
         fname = os.path.join(self.lib_dir,  'MAPlms/Mlik_%s_it%s.npy' % (key.lower(), it))
         print("rank %s caching " % pbs.rank + fname)
-        np.save(fname, TEBMAP)
+        with profiler.phase('io'):
+            np.save(fname, TEBMAP)
 
     def get_gradPpri(self, it, key, cache_only=False):
         """Builds prior gradient at iteration *it*
@@ -348,6 +599,21 @@ class ffs_iterator(object):
         self.cache_qlm(fname, grad, pbs_rank=0)
         return None if cache_only else self.load_qlm(fname)
 
+    def get_mchain(self, it, key, cov=None, chain_descr=None):
+        """Multigrid chain for the solves of iteration *it*, reused from the previous iterations where possible.
+
+            Setup times and the time saved with respect to a fresh chain are logged in cghistories/history_mchain.txt
+
+        """
+        mchain = multigrid.get_chain(self._mchains, self.opfilt, self.type,
+                                     self.chain_descr if chain_descr is None else chain_descr,
+                                     self.cov if cov is None else cov, no_deglensing=self.nodeglensing)
+        with open(os.path.join(self.lib_dir, 'cghistories', 'history_mchain_rank%s.txt' % self.PBSRANK), 'a') as file:
+            file.write('%04d %s %.3f %.3f \n' % (it, key.lower(), mchain.last_setup_time,
+                                                  max(mchain.setup_time - mchain.last_setup_time, 0.)))
+            file.close()
+        return mchain
+
     def _mlik2rest_tqumlik(self, TQUMlik, it, key):
         """Produces B^t Ni (data - B D Mlik) in TQU space, that is fed into the qlm estimator.
 
@@ -480,6 +746,48 @@ class ffs_iterator(object):
                           os.path.join(self.lib_dir,  'Hessian', 'rlm_sn_%s_%s.npy' % (k, key)), k)
         return BFGS_H
 
+    def get_linemodel(self, it, key, gradn, incr):
+        """Cheap model of the log-posterior along the search direction, as function of the step length.
+
+            The likelihood term is modelled by its gradient and the isotropic curvature, the prior term is exact.
+            The model is only built on the first evaluation of the returned functions.
+
+            Args:
+                it: current iteration level (the direction starts from phi_{it-1})
+                key: 'p' or 'o'
+                gradn: total gradient at it - 1 (alm array)
+                incr: search direction (rlm array)
+
+            Returns:
+                log-posterior (up to a constant) and its derivative, as functions of the step length
+
+        """
+        terms = []
+
+        def get_terms():  # built on first evaluation only, step rules without line search never need it
+            if len(terms) == 0:
+                prior = cl_inverse(self.cl_pp[:self.lmax_qlm + 1] if key.lower() == 'p' else self.cl_oo[:self.lmax_qlm + 1])
+                prior_H0 = prior.copy()
+                prior_H0[0] *= 0.5
+                curv_lik = np.maximum(cl_inverse(self.get_H0(key)) - prior_H0, 0.)
+                s = self.lib_qlm.rlm2alm(incr)
+                x = self.get_Plm(it - 1, key)
+                dot = lambda alm1, alm2: np.sum(self.lib_qlm.alm2rlm(alm1) * self.lib_qlm.alm2rlm(alm2))
+                gpri_s = dot(self.lib_qlm.almxfl(x, prior), s)
+                terms.extend([dot(gradn, s) - gpri_s, dot(self.lib_qlm.almxfl(s, curv_lik), s),
+                              gpri_s, dot(self.lib_qlm.almxfl(s, prior), s)])
+            return terms
+
+        def phi(a):
+            glik_s, slik_s, gpri_s, spri_s = get_terms()
+            return a * glik_s + 0.5 * a ** 2 * slik_s + a * gpri_s + 0.5 * a ** 2 * spri_s
+
+        def dphi(a):
+            glik_s, slik_s, gpri_s, spri_s = get_terms()
+            return glik_s + a * slik_s + gpri_s + a * spri_s
+
+        return phi, dphi
+
     def build_incr(self, it, key, gradn):
         """Search direction
 
@@ -514,7 +822,13 @@ class ffs_iterator(object):
             t0 = time.time()
             incr = BFGS.get_mHkgk(self.lib_qlm.alm2rlm(gradn), k)
             norm_inc = self._calc_norm(self.lib_qlm.rlm2alm(incr)) / self._calc_norm(self.get_Plm(0, key))
-            step = self.newton_step_length(it, norm_inc)
+            phi, dphi = self.get_linemodel(it, key, gradn, incr)
+            step = self.steplength(it, norm_inc, phi, dphi)
+            if len(self.steplength.trials) > 0:
+                with open(os.path.join(self.lib_dir, 'history_linesearch.txt'), 'a') as file:
+                    for trial in self.steplength.trials:
+                        file.write('%03d %s %.6f %.12e %.12e \n' % ((it, key.lower()) + tuple(trial)))
+                    file.close()
             self.cache_rlm(sk_fname,incr * step)
             prt_time(time.time() - t0, label=' Exec. time for descent direction calculation')
         assert os.path.exists(sk_fname), sk_fname
@@ -534,14 +848,18 @@ class ffs_iterator(object):
         # Calculation in // of lik and det term :
         ti = time.time()
         if self.PBSRANK == 0:  # Single processes routines :
-            self._calc_ffinv(it - 1, key)
-            self.get_gradPpri(it, key, cache_only=True)
+            with profiler.phase('displacement'):
+                self._calc_ffinv(it - 1, key)
+            with profiler.phase('gradpri'):
+                self.get_gradPpri(it, key, cache_only=True)
         self.barrier()
         # Calculation of the likelihood term, involving the det term over MCs :
-        irrelevant = self.calc_gradplikpdet(it, key)
+        with profiler.phase('gradlik'):
+            irrelevant = self.calc_gradplikpdet(it, key)
         self.barrier()  # Everything should be on disk now.
         if self.PBSRANK == 0:
-            incr,steplength = self.build_incr(it, key, self.load_total_grad(it - 1, key))
+            with profiler.phase('bfgs'):
+                incr,steplength = self.build_incr(it, key, self.load_total_grad(it - 1, key))
             self.cache_qlm(plm_fname, self.get_Plm(it - 1, key) + incr, pbs_rank=0)
 
             # Saves some info about increment norm and exec. time :
@@ -572,10 +890,55 @@ class ffs_iterator(object):
                 if os.path.exists(os.path.join(self.lib_dir, 'finv_%04d_libdir' % (it - 1))):
                     shutil.rmtree(os.path.join(self.lib_dir, 'finv_%04d_libdir' % (it - 1)))
                     if self.verbose: print("Removed :", os.path.join(self.lib_dir, 'finv_%04d_libdir' % (it - 1)))
+            with profiler.phase('io'):
+                self._apply_f_storage(key)
 
+        # One profiling record per iteration and process:
+        profiler.dump(os.path.join(self.lib_dir, 'cghistories', 'profile_rank%s.jsonl' % pbs.rank),
+                      it=it, key=key.lower(), rank=pbs.rank, time_iter=time.time() - ti)
         self.barrier()
         return None if cache_only else self.load_qlm(plm_fname)
 
+    def iterate_until(self, criteria, max_iter, key='p'):
+        """Performs iterations until one of the convergence criteria is met, or *max_iter* iterations are done.
+
+            Criteria values and the stopping reason are recorded in history_convergence.txt
+
+            Args:
+                criteria: list of convergence criteria (e.g. *crit_gradnorm(0.01)*)
+                max_iter: maximal iteration index
+                key: 'p' or 'o'
+
+            Returns:
+                iteration index and reason for stopping
+
+        """
+        fname = os.path.join(self.lib_dir, 'history_convergence.txt')
+        for it in range(max_iter + 1):
+            self.iterate(it, key, cache_only=True)
+            if it == 0: continue
+            results = [crit(self, it, key) for crit in criteria]
+            met = [crit.label for crit, (val, ok) in zip(criteria, results) if ok]
+            if self.PBSRANK == 0:
+                with open(fname, 'a') as file:
+                    file.write('%03d %s ' % (it, key.lower()) +
+                               ' '.join(['%s %.6e' % (crit.label, val) for crit, (val, ok) in zip(criteria, results)])
+                               + ' \n')
+                    file.close()
+            if len(met) > 0:
+                reason = 'converged (%s)' % ', '.join(met)
+                break
+        else:
+            reason = 'max_iter reached'
+        if self.PBSRANK == 0:
+            print('++ ffs iterator: stopped at iteration %s, %s' % (it, reason))
+            with open(fname, 'a') as file:
+                file.write('# %03d %s stopped: %s \n' % (it, key.lower(), reason))
+                file.close()
+        self.barrier()
+        self.stop_reason = reason
+        return it, reason
+
 
 class ffs_iterator_cstMF(ffs_iterator):
     r"""Iterator instance, that uses fixed, input mean-field at each step.
@@ -613,14 +976,12 @@ class ffs_iterator_cstMF(ffs_iterator):
         # Identical MF here
         self.cache_qlm(fname_detterm, self.load_qlm(self.MF_qlms))
         self.cov.set_ffi(self._load_f(it - 1, key), self._load_finv(it - 1, key))
-        mchain = multigrid.multigrid_chain(self.opfilt, self.type, self.chain_descr, self.cov,
-                                                    no_deglensing=self.nodeglensing)
-        # FIXME : The solution input is not working properly sometimes. We give it up for now.
-        # FIXME  don't manage to find the right d0 to input for a given sol ?!!
-        soltn = self.load_soltn(it, key).copy() * self.soltn_cond
+        mchain = self.get_mchain(it, key)
+        soltn = self.load_soltn(it, key)
         self.opfilt._type = self.type
-        mchain.solve(soltn, self.get_datmaps(), finiop='MLIK')
+        mchain.solve(soltn, self.get_datmaps(), finiop='MLIK', deflation=self.deflation.get(key.lower()))
         self._cache_tebwf(soltn, it - 1, key)
+        self.cache_soltn(soltn, key)
         # soltn = self.opfilt.MLIK2BINV(soltn,self.cov,self.get_datmaps())
         # grad = - ql.get_qlms(self.type, self.cov.lib_skyalm, soltn, self.cov.cls, self.lib_qlm,
         #                     use_Pool=self.use_Pool, f=self.cov.f)[{'p': 0, 'o': 1}[key.lower()]]
@@ -646,12 +1007,14 @@ class ffs_iterator_pertMF(ffs_iterator):
             Plm0: Starting point for the iterative search. alm array consistent with *lib_qlm*
             H0: initial isotropic likelihood curvature approximation (roughly, inverse lensing noise bias :math:`N^{(0)}_L`)
             cpp_prior: fiducial lensing power spectrum, used for the prior part of the posterior density.
+            isocov(optional): isotropic covariance instance for the mean-field response, e.g. that of another iterator
+                              with the same filter (built from *filt* by default)
 
 
     """
 
     def __init__(self, lib_dir, typ, filt, dat_maps, lib_qlm, Plm0, H0, cpp_prior,
-                 init_rank=pbs.rank, init_barrier=pbs.barrier, **kwargs):
+                 init_rank=pbs.rank, init_barrier=pbs.barrier, isocov=None, **kwargs):
         super(ffs_iterator_pertMF, self).__init__(lib_dir, typ, filt, dat_maps, lib_qlm, Plm0, H0, cpp_prior,
                                                   PBSSIZE=1, PBSRANK=0,  # so that all proc. act independently
                                                   **kwargs)
@@ -660,18 +1023,24 @@ class ffs_iterator_pertMF(ffs_iterator):
         #cls_noise = {'t': (filt.Nlev_uKamin('t') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_sky_ivf + 1),
         #             'q': (filt.Nlev_uKamin('q') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_sky_ivf + 1),
         #             'u': (filt.Nlev_uKamin('u') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_sky_ivf + 1)}
-        lmax_ivf = filt.lib_datalm.ellmax
-        iso_libdat = filt.lib_datalm
-        cls_noise = {'t': (filt.Nlev_uKamin('t') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_ivf + 1),
-                     'q': (filt.Nlev_uKamin('q') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_ivf + 1),
-                     'u': (filt.Nlev_uKamin('u') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_ivf + 1)}
-        self.isocov = ffs_cov.ffs_diagcov_alm(os.path.join(lib_dir, 'isocov'),
-                                              iso_libdat, filt.cls, filt.cls, filt.cl_transf, cls_noise,
-                                              lib_skyalm=filt.lib_skyalm, init_rank=init_rank,
-                                              init_barrier=init_barrier)
+        if isocov is None:
+            lmax_ivf = filt.lib_datalm.ellmax
+            iso_libdat = filt.lib_datalm
+            cls_noise = {'t': (filt.Nlev_uKamin('t') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_ivf + 1),
+                         'q': (filt.Nlev_uKamin('q') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_ivf + 1),
+                         'u': (filt.Nlev_uKamin('u') / 60. / 180. * np.pi) ** 2 * np.ones(lmax_ivf + 1)}
+            isocov = ffs_cov.ffs_diagcov_alm(os.path.join(lib_dir, 'isocov'),
+                                             iso_libdat, filt.cls, filt.cls, filt.cl_transf, cls_noise,
+                                             lib_skyalm=filt.lib_skyalm, init_rank=init_rank,
+                                             init_barrier=init_barrier)
+        self.isocov = isocov
+        self._mfresp = {}
 
     def get_mfresp(self, key):
-        return self.isocov.get_mfresplms(self.type, self.lib_qlm, use_cls_len=False)[{'p': 0, 'o': 1}[key.lower()]]
+        if key.lower() not in self._mfresp:  # isotropic, identical at all iterations
+            self._mfresp[key.lower()] = \
+                self.isocov.get_mfresplms(self.type, self.lib_qlm, use_cls_len=False)[{'p': 0, 'o': 1}[key.lower()]]
+        return self._mfresp[key.lower()]
 
     def calc_gradplikpdet(self, it, key):
         assert key.lower() in ['p', 'o'], key  # potential or curl potential.
@@ -685,14 +1054,12 @@ class ffs_iterator_pertMF(ffs_iterator):
         # Identical MF here
         self.cache_qlm(fname_detterm, self.load_qlm(self.get_mfresp(key.lower()) * self.get_Plm(it - 1, key.lower())))
         self.cov.set_ffi(self._load_f(it - 1, key), self._load_finv(it - 1, key))
-        mchain = multigrid.multigrid_chain(self.opfilt, self.type, self.chain_descr, self.cov,
-                                           no_deglensing=self.nodeglensing)
-        # FIXME : The solution input is not working properly sometimes. We give it up for now.
-        # FIXME  don't manage to find the right d0 to input for a given sol ?!!
-        soltn = self.load_soltn(it, key).copy() * self.soltn_cond
+        mchain = self.get_mchain(it, key)
+        soltn = self.load_soltn(it, key)
         self.opfilt._type = self.type
-        mchain.solve(soltn, self.get_datmaps(), finiop='MLIK')
+        mchain.solve(soltn, self.get_datmaps(), finiop='MLIK', deflation=self.deflation.get(key.lower()))
         self._cache_tebwf(soltn, it - 1, key)
+        self.cache_soltn(soltn, key)
         TQUMlik = self.opfilt.soltn2TQUMlik(soltn, self.cov)
         ResTQUMlik = self._mlik2rest_tqumlik(TQUMlik, it, key)
         grad = - ql.get_qlms_wl(self.type, self.cov.lib_skyalm, TQUMlik, ResTQUMlik, self.lib_qlm,
@@ -728,8 +1095,17 @@ class ffs_iterator_simMF(ffs_iterator):
         self.nsims = nsims
         self.same_seeds = kwargs.pop('same_seeds', False)
         self.subtract_phi0 = kwargs.pop('subtract_phi0', True)
+        # Sims still running after this many seconds once the queue is empty are given to idle ranks as well:
+        self.queue_timeout = kwargs.pop('queue_timeout', None)
+        self._chain_descr_iso = None
         self.barrier()
 
+    def _get_chain_descr_iso(self):
+        if self._chain_descr_iso is None:
+            self._chain_descr_iso = chain_samples.get_isomgchain(
+                self.cov.lib_skyalm.ellmax, self.cov.lib_datalm.shape, iter_max=self.maxiter)
+        return self._chain_descr_iso
+
     def build_pha(self, it):
         """Builds sims for the mean-field evaluation at iter *it*
 
@@ -781,39 +1157,47 @@ class ffs_iterator_simMF(ffs_iterator):
                     jobs.append(idx)
         self.opfilt._type = self.type
         # By setting the chain outside the main loop we avoid potential MPI barriers
-        # in degrading the lib_alm libraries:
-        mchain = multigrid.multigrid_chain(self.opfilt, self.type, self.chain_descr, self.cov,
-                                                    no_deglensing=self.nodeglensing)
-        for i in range(self.PBSRANK, len(jobs), self.PBSSIZE):
-            idx = jobs[i]
-            print("rank %s, doing mc det. gradients idx %s, job %s in %s at iter level %s:" \
-                  % (self.PBSRANK, idx, i, len(jobs), it))
+        # in degrading the lib_alm libraries. The displacement is passed to the chain before each solve.
+        mchain = self.get_mchain(it, key)
+        # The sims are handed out to the ranks on demand, in chunks sharing the batched FFTs of the MF estimates.
+        # The data is done by rank 0, which holds the recycled Krylov subspace of the data solves.
+        sims = [idx for idx in jobs if idx >= 0]
+        batches = [sims[i:i + ql.nsims_chunk] for i in range(0, len(sims), ql.nsims_chunk)]
+        queue = pbs.taskqueue(batches, master_tasks=[[-1]] * (-1 in jobs), timeout=self.queue_timeout,
+                              rank=self.PBSRANK, size=self.PBSSIZE)
+        for idxs in queue:
+            print("rank %s, doing mc det. gradients idx %s, %s jobs at iter level %s:" \
+                  % (self.PBSRANK, idxs, len(jobs), it))
             ti = time.time()
 
-            if idx >= 0:  # sim
-                grad_fname = os.path.join(self.lib_dir, 'mf_it%03d/g%s_%04d.npy' % (it - 1, key.lower(), idx))
-                self.cov.set_ffi(self._load_f(it - 1, key), self._load_finv(it - 1, key))
+            if idxs[0] >= 0:  # sims
+                mchain.set_ffi(self._load_f(it - 1, key), self._load_finv(it - 1, key))
                 MFest = ql.MFestimator(self.cov, self.opfilt, mchain, self.lib_qlm,
                                        pix_pha=pix_pha, cmb_pha=cmb_pha, use_Pool=self.use_Pool)
-                grad = MFest.get_MFqlms(self.type, self.MFkey, idx)[{'p': 0, 'o': 1}[key.lower()]]
+                # Previous solutions are only useful starting points if the sims are the same at each iteration
+                soltns = [self.load_soltn(it, key, idx=idx) for idx in idxs] if self.same_seeds else None
+                grads = MFest.get_MFqlms(self.type, self.MFkey, idxs, soltn=soltns)[:, {'p': 0, 'o': 1}[key.lower()]]
+                for idx, soltn in zip(idxs, soltns or []):
+                    self.cache_soltn(soltn, key, idx=idx)
                 if self.subtract_phi0:
                     isofilt = self.cov.turn2isofilt()
-                    chain_descr_iso = chain_samples.get_isomgchain(
-                        self.cov.lib_skyalm.ellmax, self.cov.lib_datalm.shape, iter_max=self.maxiter)
-                    mchain_iso = multigrid.multigrid_chain(
-                        self.opfilt, self.type, chain_descr_iso, isofilt, no_deglensing=self.nodeglensing)
+                    mchain_iso = self.get_mchain(it, key, cov=isofilt, chain_descr=self._get_chain_descr_iso())
                     MFest = ql.MFestimator(isofilt, self.opfilt, mchain_iso, self.lib_qlm,
                                            pix_pha=pix_pha, cmb_pha=cmb_pha, use_Pool=self.use_Pool)
-                    grad -= MFest.get_MFqlms(self.type, self.MFkey, idx)[{'p': 0, 'o': 1}[key.lower()]]
-                self.cache_qlm(grad_fname, grad, pbs_rank=self.PBSRANK)
+                    soltns = [self.load_soltn(it, key, idx=idx, tag='_iso') for idx in idxs] if self.same_seeds else None
+                    grads -= MFest.get_MFqlms(self.type, self.MFkey, idxs, soltn=soltns)[:, {'p': 0, 'o': 1}[key.lower()]]
+                    for idx, soltn in zip(idxs, soltns or []):
+                        self.cache_soltn(soltn, key, idx=idx, tag='_iso')
+                for idx, grad in zip(idxs, grads):
+                    grad_fname = os.path.join(self.lib_dir, 'mf_it%03d/g%s_%04d.npy' % (it - 1, key.lower(), idx))
+                    self.cache_qlm(grad_fname, grad, pbs_rank=self.PBSRANK)
             else:
                 # This is the data.
-                # FIXME : The solution input is not working properly sometimes. We give it up for now.
-                # FIXME  don't manage to find the right d0 to input for a given sol ?!!
-                self.cov.set_ffi(self._load_f(it - 1, key), self._load_finv(it - 1, key))
-                soltn = self.load_soltn(it, key).copy() * self.soltn_cond
-                mchain.solve(soltn, self.get_datmaps(), finiop='MLIK')
+                mchain.set_ffi(self._load_f(it - 1, key), self._load_finv(it - 1, key))
+                soltn = self.load_soltn(it, key)
+                mchain.solve(soltn, self.get_datmaps(), finiop='MLIK', deflation=self.deflation.get(key.lower()))
                 self._cache_tebwf(soltn, it - 1, key)
+                self.cache_soltn(soltn, key)
                 TQUMlik = self.opfilt.soltn2TQUMlik(soltn, self.cov)
                 ResTQUMlik = self._mlik2rest_tqumlik(TQUMlik, it, key)
                 grad = - ql.get_qlms_wl(self.type, self.cov.lib_skyalm, TQUMlik, ResTQUMlik, self.lib_qlm,
@@ -821,17 +1205,24 @@ class ffs_iterator_simMF(ffs_iterator):
                     {'p': 0, 'o': 1}[key.lower()]]
                 self.cache_qlm(fname_likterm, grad, pbs_rank=self.PBSRANK)
 
-            print("%s it. %s sim %s, rank %s cg status  " % (key.lower(), it, idx, self.PBSRANK))
+            print("%s it. %s sim %s, rank %s cg status  " % (key.lower(), it, idxs, self.PBSRANK))
             # It does not help to cache both grad_O and grad_P as they do not follow the trajectory in plm space.
             # Saves some info about current iteration :
-            if idx == -1:  # Saves some info about iteration times etc.
+            if idxs[0] == -1:  # Saves some info about iteration times etc.
                 with open(os.path.join(self.lib_dir, 'cghistories','history_dat.txt'), 'a') as file:
                     file.write('%04d %.3f \n' % (it, time.time() - ti))
                     file.close()
-            else:
-                with open(os.path.join(self.lib_dir, 'cghistories', 'history_sim%04d.txt' % idx), 'a') as file:
-                    file.write('%04d %.3f \n' % (it, time.time() - ti))
-                    file.close()
+            else:  # chunk time shared evenly between its sims
+                for idx in idxs:
+                    with open(os.path.join(self.lib_dir, 'cghistories', 'history_sim%04d.txt' % idx), 'a') as file:
+                        file.write('%04d %.3f \n' % (it, (time.time() - ti) / len(idxs)))
+                        file.close()
+        if self.PBSRANK == 0 and len(jobs) > 0:
+            print('%s it. %s queue utilisation:\n' % (key.lower(), it) + queue.report())
+            with open(os.path.join(self.lib_dir, 'cghistories', 'history_queue.txt'), 'a') as file:
+                for r, (ntasks, busy, wall) in sorted(queue.utilisation().items()):
+                    file.write('%04d %s %s %s %.3f %.3f \n' % (it, key.lower(), r, ntasks, busy, wall))
+                file.close()
         self.barrier()
         if self.PBSRANK == 0:
             # Collecting terms and caching det term.
@@ -866,3 +1257,91 @@ class ffs_iterator_simMF(ffs_iterator):
                     self.PBSRANK, len(files_to_remove)), os.path.join(self.lib_dir, 'mf_it%03d'%(it - 1)))
                 for file in files_to_remove: os.remove(file)
         self.barrier()
+
+
+class ffs_iterator_multi(object):
+    r"""Iterative reconstructions of several independent data maps, advanced in lockstep.
+
+        The iterators must have identical filtering and multigrid chain descriptions; they share the filter instance
+        and the multigrid chains (with their preconditioners), as well as the isotropic covariance and mean-field
+        response for *ffs_iterator_pertMF*. Each map keeps its own lib_dir, Wiener-filter solutions and BFGS history.
+
+        This only saves the setup work repeated across maps: since each map has its own displacement, the conjugate
+        gradient solves and the quadratic estimates still run map by map. *from_dat_maps* builds the shared objects
+        once, with the first iterator, and hands them to the others as they are created.
+
+        Args:
+            itlibs: list of iterator instances (e.g. *ffs_iterator_pertMF*), one per data map, with distinct lib_dirs
+
+        Usage:
+            >>> itlib = ffs_iterator_multi.from_dat_maps(lib_dir, 'QU', filt, dats, lib_qlm, plm0s, H0, cpp_prior,
+            >>>                                          chain_descr=chain_descr, opfilt=opfilt)
+            >>> for it in range(10): itlib.iterate(it, 'p')
+
+    """
+    def __init__(self, itlibs):
+        assert len(itlibs) > 0
+        itlib0 = itlibs[0]
+        assert len(set([itlib.lib_dir for itlib in itlibs])) == len(itlibs), 'lib_dirs must be distinct'
+        for itlib in itlibs[1:]:
+            assert type(itlib) == type(itlib0), (type(itlib), type(itlib0))
+            assert itlib.type == itlib0.type and itlib.opfilt is itlib0.opfilt
+            assert itlib.chain_descr is itlib0.chain_descr, 'chain descriptions must be the same object'
+            assert itlib.cov.hashdict() == itlib0.cov.hashdict(), 'filters must be identical'
+            assert itlib.lib_qlm.hashdict() == itlib0.lib_qlm.hashdict()
+            # Each iterator sets its own displacement before using the filter:
+            itlib.cov = itlib0.cov
+            itlib._mchains = itlib0._mchains
+            if hasattr(itlib, 'isocov'):
+                itlib.isocov = itlib0.isocov
+                itlib._mfresp = itlib0._mfresp
+        self.itlibs = itlibs
+        self.nmaps = len(itlibs)
+
+    @classmethod
+    def from_dat_maps(cls, lib_dir, typ, filt, dat_maps, lib_qlm, Plm0s, H0, cpp_prior, itclass=None, **kwargs):
+        """Builds the iterators of each data map in lib_dir/map%04d, sharing the setup of the first one
+
+            Args:
+                dat_maps: list of data maps (or paths to maps), one per iterator
+                Plm0s: list of starting points, one per iterator
+                itclass: iterator class (defaults to *ffs_iterator_pertMF*)
+                kwargs: passed on to all iterators
+
+        """
+        assert len(dat_maps) == len(Plm0s), (len(dat_maps), len(Plm0s))
+        itclass = itclass or ffs_iterator_pertMF
+        get_lib_dir = lambda i: os.path.join(lib_dir, 'map%04d' % i)
+        itlib0 = itclass(get_lib_dir(0), typ, filt, dat_maps[0], lib_qlm, Plm0s[0], H0, cpp_prior, **kwargs)
+        shared = {'mchains': itlib0._mchains}
+        if hasattr(itlib0, 'isocov'):
+            shared['isocov'] = itlib0.isocov
+        kwargs.update(shared)
+        itlibs = [itlib0] + [itclass(get_lib_dir(i), typ, itlib0.cov, dat_maps[i], lib_qlm, Plm0s[i], H0, cpp_prior,
+                                     **kwargs) for i in range(1, len(dat_maps))]
+        return cls(itlibs)
+
+    def iterate(self, it, key, cache_only=False):
+        """Performs iteration *it* for all maps
+
+            Returns:
+                array of the maps *it* + 1 estimates (or None if *cache_only* is set)
+
+        """
+        for i, itlib in enumerate(self.itlibs):
+            print('++ ffs_iterator_multi: map %s of %s, iteration %s' % (i, self.nmaps, it))
+            itlib.iterate(it, key, cache_only=True)
+        return None if cache_only else self.get_Plm(it, key)
+
+    def get_Plm(self, it, key):
+        """Loads the solutions at iteration *it* of all maps
+
+        """
+        return np.array([itlib.get_Plm(it, key) for itlib in self.itlibs])
+
+    def how_many_iter_done(self, key):
+        """Returns the number of points calculated for all maps.
+
+        """
+        return min([itlib.how_many_iter_done(key) for itlib in self.itlibs])
+
@@ -13,13 +13,62 @@ from __future__ import print_function
 import numpy as np
 
 from lensit.misc.misc_utils import timer
+from lensit.misc.profiler import profiled
 from lensit.ffs_deflect.ffs_deflect import ffs_id_displacement
 from lensit.ffs_covs import ffs_specmat as SM
 
 verbose = False
 typs = ['T', 'QU', 'TQU']
+nsims_chunk = 8  # maximal number of simulations sharing the batched FFTs of stacked qlm estimates
 
 
+def _alms2lenmaps(f, lib_alm, alms, use_Pool=0):
+    """Deflected position-space maps of a stack of alm arrays, with a single batched inverse FFT.
+
+    """
+    if isinstance(f, ffs_id_displacement):
+        return lib_alm.alms2maps(alms)
+    if use_Pool < 0:
+        return np.array([f.alm2lenmap(lib_alm, _alm, use_Pool=use_Pool) for _alm in alms])
+    assert lib_alm.ell_mat.shape == f.shape, (lib_alm.ell_mat.shape, f.shape)
+    maps = lib_alm.alms2maps(alms * lib_alm.bicubic_prefilter(np.ones(lib_alm.alm_size, dtype=complex)))
+    for _i in range(len(maps)):
+        maps[_i] = f.lens_map(maps[_i], use_Pool=use_Pool, do_not_prefilter=True)
+    return maps
+
+
+def _cartgrads2qlms(lib_qlm, lefts, rights, f=None, subtract_zeromode=False):
+    """Gradient and curl estimates from the left maps and right gradient maps of a stack of simulations.
+
+        Args:
+            lefts: (nsims, len(typ)) + shape array of maps
+            rights: (2, nsims, len(typ)) + shape array of maps, x-gradients first, y-gradients second
+            f(optional): multiplies the cartesian gradients with its magnification determinant if set
+
+        Returns:
+            (nsims, 2, lib_qlm.alm_size) array of gradient and curl estimates
+
+    """
+    nsims = lefts.shape[0]
+    retd = np.einsum('si...,asi...->as...', lefts, rights)  # retdx, retdy
+    if f is not None:
+        retd *= f.get_det_magn()
+    if subtract_zeromode:
+        for _s in range(nsims):
+            zro_x = np.sum(retd[0, _s])
+            zro_y = np.sum(retd[1, _s])
+            retd[0, _s, 0, 0] -= zro_x
+            retd[1, _s, 0, 0] -= zro_y
+    retdx, retdy = lib_qlm.maps2alms(retd.reshape((2 * nsims,) + retd.shape[2:])).reshape((2, nsims, lib_qlm.alm_size))
+    return np.array([- retdx * lib_qlm.get_ikx() - retdy * lib_qlm.get_iky(),
+                     retdx * lib_qlm.get_iky() - retdy * lib_qlm.get_ikx()]).swapaxes(0, 1)
+
+
+def _chunks(nsims):
+    return [slice(_i, min(_i + nsims_chunk, nsims)) for _i in range(0, nsims, nsims_chunk)]
+
+
+@profiled('qe')
 def get_qlms_wl(typ, lib_sky, TQU_Mlik, ResTQU_Mlik, lib_qlm, f=None,lib_sky2 =None, subtract_zeromode=False, use_Pool=0, **kwargs):
     """
     Stand alone qlm estimator starting from lib_sky and unlensed Cls
@@ -45,48 +94,46 @@ def get_qlms_wl(typ, lib_sky, TQU_Mlik, ResTQU_Mlik, lib_qlm, f=None,lib_sky2 =N
 
     We can get something without having to lens any weird maps through
     ( B^t Ni (data - B D Xmap))(z)    (D ika Xmap)(z)
+
+    TQU_Mlik and ResTQU_Mlik may also be stacks of shape (nsims, len(typ), alm_size), in which case
+    the output has shape (nsims, 2, qlm_size) and the simulations share batched FFTs, nsims_chunk at a time.
     """
     lib_sky2 = lib_sky if lib_sky2 is None else lib_sky
     if typ in ['EE','EB','BE','BB']:
+        if np.ndim(TQU_Mlik) == 3:
+            return np.array([get_qlms_wl(typ, lib_sky, _M, _R, lib_qlm, f=f, use_Pool=use_Pool, lib_sky2=lib_sky2)
+                             for _M, _R in zip(TQU_Mlik, ResTQU_Mlik)])
         TEB_Mlik = lib_sky.QUlms2EBalms(TQU_Mlik)
         TEB_Res = lib_sky.QUlms2EBalms(ResTQU_Mlik)
         TEB_Mlik[{'E':1,'B':0}[typ[0]]] *= 0.
         TEB_Res[{'E':1,'B':0}[typ[1]]] *= 0.
         return get_qlms_wl('QU',lib_sky,lib_sky.EBlms2QUalms(TEB_Mlik),lib_sky2.EBlms2QUalms(TEB_Res),lib_qlm,
                            f = f,use_Pool=use_Pool,lib_sky2 = lib_sky2)
-
-    assert len(TQU_Mlik) == len(typ) and len(ResTQU_Mlik) == len(typ)
+    if np.ndim(TQU_Mlik) == 3:
+        assert len(TQU_Mlik) == len(ResTQU_Mlik), (len(TQU_Mlik), len(ResTQU_Mlik))
+        return np.concatenate([_get_qlms_wl_stack(typ, lib_sky, TQU_Mlik[sl], ResTQU_Mlik[sl], lib_qlm, f, lib_sky2,
+                                                  subtract_zeromode=subtract_zeromode, use_Pool=use_Pool)
+                               for sl in _chunks(len(TQU_Mlik))])
+    return _get_qlms_wl_stack(typ, lib_sky, np.array([TQU_Mlik]), np.array([ResTQU_Mlik]), lib_qlm, f, lib_sky2,
+                              subtract_zeromode=subtract_zeromode, use_Pool=use_Pool)[0]
+
+
+def _get_qlms_wl_stack(typ, lib_sky, TQU_Mliks, ResTQU_Mliks, lib_qlm, f, lib_sky2, subtract_zeromode=False, use_Pool=0):
+    nsims = len(TQU_Mliks)
+    assert TQU_Mliks.shape[1] == len(typ) and ResTQU_Mliks.shape[1] == len(typ)
     t = timer(verbose, prefix=__name__)
     if f is None: f = ffs_id_displacement(lib_sky.shape, lib_sky.lsides)
 
-    def left(id):
-        assert id in range(len(typ)), (id, typ)
-        return lib_sky.alm2map(ResTQU_Mlik[id])
-
-    def Right(S_id, axis):
-        assert S_id in range(len(typ)), (S_id, typ)
-        assert axis in [0, 1]
-        kfunc = lib_sky2.get_ikx if axis == 1 else lib_sky2.get_iky
-        return f.alm2lenmap(lib_sky2, TQU_Mlik[S_id] * kfunc(), use_Pool=use_Pool)
-
-    retdx = left(0) * Right(0, 1)
-    for _i in range(1, len(typ)): retdx += left(_i) * Right(_i, 1)
-    t.checkpoint("get_likgrad::Cart. gr. x done. (%s map(s) lensed, %s fft(s)) " % (len(typ), 2 * len(typ) + 1))
-
-    retdy = left(0) * Right(0, 0)
-    for _i in range(1, len(typ)): retdy += left(_i) * Right(_i, 0)
-    t.checkpoint("get_likgrad::Cart. gr. y done. (%s map(s) lensed, %s fft(s)) " % (len(typ), 2 * len(typ) + 1))
+    # Residual maps, and lensed gradients of the Mlik maps along x (axis 1) and y (axis 0) :
+    lefts = lib_sky.alms2maps(ResTQU_Mliks.reshape(nsims * len(typ), -1)).reshape((nsims, len(typ)) + lib_sky.shape)
+    rights = np.array([TQU_Mliks * lib_sky2.get_ikx(), TQU_Mliks * lib_sky2.get_iky()])
+    rights = _alms2lenmaps(f, lib_sky2, rights.reshape(2 * nsims * len(typ), -1), use_Pool=use_Pool)
+    t.checkpoint("get_likgrad::Cart. gr. maps done. (%s map(s) lensed, %s fft(s)) " % (2 * nsims * len(typ), 3 * nsims * len(typ)))
 
-    if subtract_zeromode:
-        zro_x = np.sum(retdx)
-        zro_y = np.sum(retdy)
-        print('zero mode:', zro_x,zro_y)
-        retdx[0, 0] -= zro_x
-        retdy[0, 0] -= zro_y
-    retdx = lib_qlm.map2alm(retdx)
-    retdy = lib_qlm.map2alm(retdy)
-    return np.array([- retdx * lib_qlm.get_ikx() - retdy * lib_qlm.get_iky(),
-                       retdx * lib_qlm.get_iky() - retdy * lib_qlm.get_ikx()])  # N0  * output is normalized qest
+    ret = _cartgrads2qlms(lib_qlm, lefts, rights.reshape((2, nsims, len(typ)) + lib_sky.shape),
+                          subtract_zeromode=subtract_zeromode)
+    t.checkpoint("get_likgrad::Cart. gr. x and y done. (%s fft(s)) " % (2 * nsims))
+    return ret  # N0  * output is normalized qest
 
 
 def _Mlik2ResTQUMlik_diag(field, ninv_filt, TQUMlik, data, f, fi):
@@ -207,16 +254,44 @@ class MFestimator:
     def npix(self):
         return self.ninv_filt.npix
 
+    @profiled('mf')
     def get_MFqlms(self, typ, MFkey, idx, soltn=None):
+        """Mean-field simulation gradient and curl estimates.
+
+            *idx* may be a list of simulation indices, in which case an array of shape (len(idx), 2, qlm_size) is returned.
+            The CG solves are performed one at a time, but the simulations then share batched FFTs, nsims_chunk at a time.
+            *soltn* are the CG starting points (one per simulation if *idx* is a list), updated in place with the solutions.
+
+        """
         lib_sky = self.ninv_filt.lib_skyalm
-        lib_dat = self.ninv_filt.lib_datalm
-        assert lib_sky.lsides == lib_dat.lsides
-        self.opfilt.typ = typ
+        idxs = np.atleast_1d(idx)
+        soltns = [None] * len(idxs) if soltn is None else ([soltn] if np.ndim(idx) == 0 else soltn)
+        assert len(soltns) == len(idxs), (len(soltns), len(idxs))
         if hasattr(self.ninv_filt, 'f'):
             print("******* I am using displacement for ninvfilt in MFest")
         else:
             print("******* Using id displacement in MFest")
         f = getattr(self.ninv_filt, 'f', ffs_id_displacement(lib_sky.shape, lib_sky.lsides))
+        ret = []
+        for sl in _chunks(len(idxs)):
+            legs = [self._get_MFlegs(typ, MFkey, _idx, soltn=_soltn) for _idx, _soltn in zip(idxs[sl], soltns[sl])]
+            lefts = np.array([_l for _l, _r in legs])
+            Rlms = np.array([_r for _l, _r in legs])
+            rights = _alms2lenmaps(f, lib_sky, np.array([Rlms * lib_sky.get_ikx(), Rlms * lib_sky.get_iky()]).reshape(-1, lib_sky.alm_size),
+                                   use_Pool=self.use_Pool)
+            ret.append(_cartgrads2qlms(self.lib_qlm, lefts, rights.reshape((2,) + lefts.shape)))
+            del legs, lefts, Rlms, rights
+        ret = np.concatenate(ret)  # N0  * output is normalized qest
+        return ret if np.ndim(idx) > 0 else ret[0]
+
+    def _get_MFlegs(self, typ, MFkey, idx, soltn=None):
+        """Left maps and the alms of the right maps (to be deflected gradients) of the MF estimate for one simulation.
+
+        """
+        lib_sky = self.ninv_filt.lib_skyalm
+        lib_dat = self.ninv_filt.lib_datalm
+        assert lib_sky.lsides == lib_dat.lsides
+        self.opfilt.typ = typ
         if MFkey == 12:
             # B^t M^t X (x) (D ika P D^t B^t Covi X )(x). Second term are just the deflected gradients of the recontructed
             assert self.pix_pha is not None
@@ -232,10 +307,8 @@ class MFestimator:
                 _alm = lib_sky.udgrade(lib_dat, lib_dat.map2alm(phas[id]))
                 return lib_sky.alm2map(lib_sky.almxfl(_alm, norm * self.ninv_filt.cl_transf))
 
-            def Right(id, ax):
-                assert ax in [0, 1], ax
-                kfunc = lib_sky.get_ikx if ax == 1 else lib_sky.get_iky
-                return f.alm2lenmap(lib_sky, TQUMlik[id] * kfunc(), use_Pool=self.use_Pool)
+            def Rlm(id):
+                return TQUMlik[id]
         elif MFkey == 2:
             # X unit variance random phases dat map shaped
             # X (x) (D ika P D^t B^t Covi B X )(x). Second term are just the deflected gradients of the recontructed
@@ -254,23 +327,14 @@ class MFestimator:
             def Left(id):
                 return phas[id]
 
-            def Right(id, ax):
-                assert ax in [0, 1], ax
-                kfunc = lib_sky.get_ikx if ax == 1 else lib_sky.get_iky
-                return f.alm2lenmap(lib_sky, norm * soltn[id] * kfunc(), use_Pool=self.use_Pool)
+            def Rlm(id):
+                return norm * soltn[id]
         elif MFkey == 22:
             # D ika b X (x) (B^t Covi B D P 1/b X )(x). TEB phas
             assert 0
         else:
-            assert 'not implemented'
-        retdx = Left(0) * Right(0, 1)
-        for i in range(1, len(typ)): retdx += Left(i) * Right(i, 1)
-        retdx = self.lib_qlm.map2alm(retdx)
-        retdy = Left(0) * Right(0, 0)
-        for i in range(1, len(typ)): retdy += Left(i) * Right(i, 0)
-        retdy = self.lib_qlm.map2alm(retdy)
-        return np.array([- retdx * self.lib_qlm.get_ikx() - retdy * self.lib_qlm.get_iky(),
-                         retdx * self.lib_qlm.get_iky() - retdy * self.lib_qlm.get_ikx()])  # N0  * output is normalized qest
+            assert 0, 'not implemented'
+        return np.array([Left(i) for i in range(len(typ))]), np.array([Rlm(i) for i in range(len(typ))])
 
 
 def get_MFqlms(typ, MFkey, lib_dat, lib_sky, pix_phas, TQUMlik_pha, cl_transf, lib_qlm, f=None, use_Pool=0):
@@ -286,10 +350,8 @@ def get_MFqlms(typ, MFkey, lib_dat, lib_sky, pix_phas, TQUMlik_pha, cl_transf, l
             _alm = lib_sky.udgrade(lib_dat, lib_dat.map2alm(pix_phas[id]))
             return lib_sky.alm2map(lib_sky.almxfl(_alm, norm * cl_transf))
 
-        def Right(id, ax):
-            assert ax in [0, 1], ax
-            kfunc = lib_sky.get_ikx if ax == 1 else lib_sky.get_iky
-            return f.alm2lenmap(lib_sky, TQUMlik_pha[id] * kfunc(), use_Pool=use_Pool)
+        def Rlm(id):
+            return TQUMlik_pha[id]
     elif MFkey == 2:
         # X unit variance random phases dat map shaped
         # X (x) (D ika P D^t B^t Covi B X )(x). Second term are just the deflected gradients of the recontructed
@@ -300,10 +362,8 @@ def get_MFqlms(typ, MFkey, lib_dat, lib_sky, pix_phas, TQUMlik_pha, cl_transf, l
         def Left(id):
             return pix_phas[id]
 
-        def Right(id, ax):
-            assert ax in [0, 1], ax
-            kfunc = lib_sky.get_ikx if ax == 1 else lib_sky.get_iky
-            return f.alm2lenmap(lib_sky, norm * TQUMlik_pha[id] * kfunc(), use_Pool=use_Pool)
+        def Rlm(id):
+            return norm * TQUMlik_pha[id]
     elif MFkey == 22:
         # FIXME : need TEB pha
         # X unit variance TEB sky-shaped.
@@ -319,20 +379,14 @@ def get_MFqlms(typ, MFkey, lib_dat, lib_sky, pix_phas, TQUMlik_pha, cl_transf, l
         def Left(id):
             return pix_phas[id]
 
-        def Right(id, ax):
-            assert ax in [0, 1], ax
-            kfunc = lib_sky.get_ikx if ax == 1 else lib_sky.get_iky
-            return f.alm2lenmap(lib_sky, lib_sky.almxfl(TQUMlik_pha[id] * kfunc(), cl_transf * norm), use_Pool=use_Pool)
+        def Rlm(id):
+            return lib_sky.almxfl(TQUMlik_pha[id], cl_transf * norm)
     else:
         assert 0, 'not implemented'
-    retdx = Left(0) * Right(0, 1)
-    for i in range(1, len(typ)): retdx += Left(i) * Right(i, 1)
-    retdx = lib_qlm.map2alm(retdx)
-    retdy = Left(0) * Right(0, 0)
-    for i in range(1, len(typ)): retdy += Left(i) * Right(i, 0)
-    retdy = lib_qlm.map2alm(retdy)
-    return np.array([- retdx * lib_qlm.get_ikx() - retdy * lib_qlm.get_iky(),
-                     retdx * lib_qlm.get_iky() - retdy * lib_qlm.get_ikx()])  # N0  * output is unnormalized qest
+    lefts = np.array([[Left(i) for i in range(len(typ))]])
+    Rlms = np.array([Rlm(i) for i in range(len(typ))])
+    rights = _alms2lenmaps(f, lib_sky, np.concatenate([Rlms * lib_sky.get_ikx(), Rlms * lib_sky.get_iky()]), use_Pool=use_Pool)
+    return _cartgrads2qlms(lib_qlm, lefts, rights.reshape((2,) + lefts.shape))[0]  # N0  * output is unnormalized qest
 
 
 def get_qlms(typ, lib_sky, Res_TEBlms, cls_unl, lib_qlm, Res_TEBlms2=None, f=None, use_Pool=0, **kwargs):
@@ -363,43 +417,48 @@ def get_qlms(typ, lib_sky, Res_TEBlms, cls_unl, lib_qlm, Res_TEBlms2=None, f=Non
 
     We can get something without having to lens any weird maps through
     ( B^t Ni (data - B D Xmap))(z)    (D Xmap)(z)
+
+    Res_TEBlms (and Res_TEBlms2) may also be stacks of shape (nsims, len(typ), alm_size), see *get_qlms_wl*.
     """
     _Res_TEBlms2 = Res_TEBlms if Res_TEBlms2 is None else Res_TEBlms2
-    assert len(Res_TEBlms) == len(typ) and len(_Res_TEBlms2) == len(typ)
-    t = timer(verbose, prefix=__name__)
     if f is not None: print(" qlms.py :: consider using get_qlms_wl for qlms with lensing, to avoid lensing noisy maps")
     if f is None: f = ffs_id_displacement(lib_sky.shape, lib_sky.lsides)
+    if np.ndim(Res_TEBlms) == 3:
+        assert len(Res_TEBlms) == len(_Res_TEBlms2), (len(Res_TEBlms), len(_Res_TEBlms2))
+        return np.concatenate([_get_qlms_stack(typ, lib_sky, Res_TEBlms[sl], _Res_TEBlms2[sl], cls_unl, lib_qlm, f,
+                                               use_Pool=use_Pool) for sl in _chunks(len(Res_TEBlms))])
+    return _get_qlms_stack(typ, lib_sky, np.array([Res_TEBlms]), np.array([_Res_TEBlms2]), cls_unl, lib_qlm, f,
+                           use_Pool=use_Pool)[0]
 
-    TQUmlik = SM.TEB2TQUlms(typ, lib_sky, SM.apply_TEBmat(typ, lib_sky, cls_unl, _Res_TEBlms2))
-
-    def left(S_id):
-        assert S_id in range(len(typ)), (S_id, typ)
-        return f.alm2lenmap(lib_sky, SM.get_SlmfromTEBlms(typ, lib_sky, Res_TEBlms, typ[S_id]), use_Pool=use_Pool)
-
-    def Right(S_id, axis):
-        assert S_id in range(len(typ)), (S_id, typ)
-        assert axis in [0, 1]
-        kfunc = lib_sky.get_ikx if axis == 1 else lib_sky.get_iky
-        return f.alm2lenmap(lib_sky, TQUmlik[S_id] * kfunc(), use_Pool=use_Pool)
 
-    retdx = left(0) * Right(0, 1)
-    for _i in range(1, len(typ)): retdx += left(_i) * Right(_i, 1)
-    retdx = lib_qlm.map2alm(f.mult_wmagn(retdx))
-    t.checkpoint("get_likgrad::Cart. gr. x done. (%s map(s) lensed, %s fft(s)) " % (2 * len(typ), 2 * len(typ) + 1))
+def _get_qlms_stack(typ, lib_sky, Res_TEBlms, Res_TEBlms2, cls_unl, lib_qlm, f, use_Pool=0):
+    nsims = len(Res_TEBlms)
+    assert Res_TEBlms.shape[1] == len(typ) and Res_TEBlms2.shape[1] == len(typ)
+    t = timer(verbose, prefix=__name__)
 
-    retdy = left(0) * Right(0, 0)
-    for _i in range(1, len(typ)): retdy += left(_i) * Right(_i, 0)
-    retdy = lib_qlm.map2alm(f.mult_wmagn(retdy))
-    t.checkpoint("get_likgrad::Cart. gr. y done. (%s map(s) lensed, %s fft(s)) " % (2 * len(typ), 2 * len(typ) + 1))
+    TQUmliks = np.array([SM.TEB2TQUlms(typ, lib_sky, SM.apply_TEBmat(typ, lib_sky, cls_unl, _R)) for _R in Res_TEBlms2])
+    Slms = np.array([[SM.get_SlmfromTEBlms(typ, lib_sky, _R, _S) for _S in typ] for _R in Res_TEBlms])
+    lefts = _alms2lenmaps(f, lib_sky, Slms.reshape(nsims * len(typ), -1), use_Pool=use_Pool)
+    rights = np.array([TQUmliks * lib_sky.get_ikx(), TQUmliks * lib_sky.get_iky()])
+    rights = _alms2lenmaps(f, lib_sky, rights.reshape(2 * nsims * len(typ), -1), use_Pool=use_Pool)
+    t.checkpoint("get_likgrad::Cart. gr. maps done. (%s map(s) lensed, %s fft(s)) " % (3 * nsims * len(typ), 3 * nsims * len(typ)))
 
-    return np.array([- retdx * lib_qlm.get_ikx() - retdy * lib_qlm.get_iky(),
-                     retdx * lib_qlm.get_iky() - retdy * lib_qlm.get_ikx()])  # N0  * output is normalized qest
+    ret = _cartgrads2qlms(lib_qlm, lefts.reshape((nsims, len(typ)) + lib_sky.shape),
+                          rights.reshape((2, nsims, len(typ)) + lib_sky.shape), f=f)
+    t.checkpoint("get_likgrad::Cart. gr. x and y done. (%s fft(s)) " % (2 * nsims))
+    return ret  # N0  * output is normalized qest
 
 
-def get_response_flexible(lib_tlm, lib_elm, lib_blm, cls, cls_transf, cls_noise, lib_qlm, isoN0s = True):
+def get_response_flexible(lib_tlm, lib_elm, lib_blm, cls, cls_transf, cls_noise, lib_qlm, isoN0s = True,
+                          maxbytes=2 ** 28, executor=None):
         """
         N0 calc, allowing for abritrary aniso filtering.
         -(xi,a K) (xi,b K) - (K)ab (xi,a K xi,b) with K = B^t Covi B
+
+        The 3x3 matrices are tabulated in closed form as function of multipole, and the (T, Q, U) field pairs are
+        convolved in groups with batched FFTs, each group holding less than about *maxbytes* of maps
+        (but at least a dozen of them).
+        Groups can be distributed with *executor.map* (e.g. a thread pool), in which case the bound holds per group.
         """
         assert lib_tlm.ell_mat == lib_elm.ell_mat and lib_tlm.ell_mat == lib_blm.ell_mat
         assert 'tt' in cls_noise.keys() and 'ee' in cls_noise.keys() and 'bb' in cls_noise.keys()
@@ -421,118 +480,119 @@ def get_response_flexible(lib_tlm, lib_elm, lib_blm, cls, cls_transf, cls_noise,
         if lib_elm.ellmax > 0: t_cls['e'][:lib_elm.ellmax + 1] *= (lib_elm.get_Nell() > 0)
         if lib_blm.ellmax > 0: t_cls['b'][:lib_blm.ellmax + 1] *= (lib_blm.get_Nell() > 0)
 
-        K_almmap = np.zeros((ellmat.rshape[0],ellmat.rshape[1],3,3),dtype = float)
-        K_almmap[:,:,0, 0] = Ki_cls['tt'][ellmat()] * lib_tlm._cond()
-        K_almmap[:,:,1, 1] = Ki_cls['ee'][ellmat()] * lib_elm._cond()
-        K_almmap[:,:,2, 2] = Ki_cls['bb'][ellmat()] * lib_blm._cond()
-        K_almmap[:,:,0, 1] = Ki_cls['te'][ellmat()] * lib_tlm._cond()* lib_elm._cond()
-        K_almmap[:,:,1, 0] = Ki_cls['te'][ellmat()] * lib_tlm._cond()* lib_elm._cond()
-        if np.__version__ >= '1.14':
-            K_almmap = np.linalg.pinv(K_almmap) # B^t Covi B
-        else:
-            for l1 in range(ellmat.rshape[0]):
-                for l2 in range(ellmat.rshape[1]):
-                    K_almmap[l1,l2,:,:] = np.linalg.pinv(K_almmap[l1,l2,:,:])
-        K_almmap[:, :, 0, 0] *= t_cls['t'][ellmat()] ** 2
-        K_almmap[:, :, 1, 1] *= t_cls['e'][ellmat()] ** 2
-        K_almmap[:, :, 0, 1] *= t_cls['t'][ellmat()] * t_cls['e'][ellmat()]
-        K_almmap[:, :, 1, 0] *= t_cls['e'][ellmat()] * t_cls['t'][ellmat()]
-        K_almmap[:, :, 2, 2] *= t_cls['b'][ellmat()] ** 2
-
-        xiK_almmap = np.zeros((ellmat.rshape[0],ellmat.rshape[1],3,3),dtype = float)
-        xiK_almmap[:, :, 0, 0] = w_cls['tt'][ellmat()] * K_almmap[:, :, 0, 0] + w_cls['te'][ellmat()] * K_almmap[:, :, 1, 0]
-        xiK_almmap[:, :, 1, 1] = w_cls['te'][ellmat()] * K_almmap[:, :, 0, 1] + w_cls['ee'][ellmat()] * K_almmap[:, :, 1, 1]
-        xiK_almmap[:, :, 2, 2] = w_cls['bb'][ellmat()] * K_almmap[:, :, 2, 2]
-        xiK_almmap[:, :, 0, 1] = w_cls['tt'][ellmat()] * K_almmap[:, :, 0, 1] + w_cls['te'][ellmat()] * K_almmap[:, :, 1, 1]
-        xiK_almmap[:, :, 1, 0] = w_cls['te'][ellmat()] * K_almmap[:, :, 0, 0] + w_cls['ee'][ellmat()] * K_almmap[:, :, 1, 0]
-
-        xiKxi_almmap = np.zeros((ellmat.rshape[0],ellmat.rshape[1],3,3),dtype = float)
-        xiKxi_almmap[:, :, 0, 0] = w_cls['tt'][ellmat()] * xiK_almmap[:, :, 0, 0] + w_cls['te'][ellmat()] * xiK_almmap[:, :, 0, 1]
-        xiKxi_almmap[:, :, 1, 1] = w_cls['te'][ellmat()] * xiK_almmap[:, :, 1, 0] + w_cls['ee'][ellmat()] * xiK_almmap[:, :, 1, 1]
-        xiKxi_almmap[:, :, 2, 2] = w_cls['bb'][ellmat()] * xiK_almmap[:, :, 2, 2]
-        xiKxi_almmap[:, :, 0, 1] = w_cls['ee'][ellmat()] * xiK_almmap[:, :, 0, 1] + w_cls['te'][ellmat()] * xiK_almmap[:, :, 0, 0]
-        xiKxi_almmap[:, :, 1, 0] = w_cls['tt'][ellmat()] * xiK_almmap[:, :, 1, 0] + w_cls['te'][ellmat()] * xiK_almmap[:, :, 1, 1]
-        cos,sin = ellmat.get_cossin_2iphi_mat()
-
-        def apply_RSX(almmap,iS,iX):
-            """ T Q U = (1 0 0
-                         0 c  -s
-                        0 s c)    T E B"""
-            if iS == 0:
-                return almmap.copy() if iX == 0 else np.zeros_like(almmap)
-            elif iS == 1:
-                if iX == 1:
-                    return cos * almmap
-                elif iX == 2:
-                    return -sin * almmap
-                else :
-                    return np.zeros_like(almmap)
-            elif iS == 2:
-                if iX == 1:
-                    return sin * almmap
-                elif iX == 2:
-                    return cos * almmap
-                else :
-                    return np.zeros_like(almmap)
+        # The matrices depend on the pixel only through its multipole and which of the T, E and B filters pass it.
+        # Their (00, 01, 10, 11, 22) TEB elements are tabulated for the 8 filter combinations, as function of ell:
+        nell = ellmat.ellmax + 1
+        ct, ce, cb = [((np.arange(8) >> _k) & 1)[:, np.newaxis] for _k in range(3)]
+        P00, P01, P11, P22 = _pinv_TEB(Ki_cls['tt'] * ct, Ki_cls['te'] * ct * ce, Ki_cls['ee'] * ce, Ki_cls['bb'] * cb)
+        K = (P00 * t_cls['t'] ** 2, P01 * t_cls['t'] * t_cls['e'], P01 * t_cls['t'] * t_cls['e'],
+             P11 * t_cls['e'] ** 2, P22 * t_cls['b'] ** 2)  # B^t Covi B
+        wtt, wte, wee, wbb = [w_cls[k] for k in ['tt', 'te', 'ee', 'bb']]
+        xiK = (wtt * K[0] + wte * K[2], wtt * K[1] + wte * K[3], wte * K[0] + wee * K[2], wte * K[1] + wee * K[3],
+               wbb * K[4])
+        xiKxi = (xiK[0] * wtt + xiK[1] * wte, xiK[0] * wte + xiK[1] * wee,
+                 xiK[2] * wtt + xiK[3] * wte, xiK[2] * wte + xiK[3] * wee, xiK[4] * wbb)
+        tables = np.array([K, xiK, xiKxi]).reshape((3, 5, 8 * nell))
+        idx = (lib_tlm._cond() + 2 * lib_elm._cond() + 4 * lib_blm._cond()) * nell + ellmat()
+        e2iphi = ellmat.get_e2iphi_mat()
+        kx = ellmat.get_kx_mat()[0]
+        ky = ellmat.get_ky_mat()[:, 0]
+        nrows = max(1, 2 ** 16 // ellmat.rshape[1])
+
+        def get_TQU(m, iS, jS, sl):
+            """ (R M R^t)_{iS jS} on rows sl of the rfft grid, with T Q U = R T E B and R = (1 0 0, 0 c -s, 0 s c) """
+            M = lambda e: tables[m, e][idx[sl]]  # 00, 01, 10, 11, 22
+            if (iS, jS) == (0, 0): return M(0)
+            cos, sin = e2iphi[sl].real, e2iphi[sl].imag
+            if iS == 0: return (cos if jS == 1 else sin) * M(1)
+            if jS == 0: return (cos if iS == 1 else sin) * M(2)
+            if iS != jS: return cos * sin * (M(3) - M(4))
+            return cos ** 2 * M(3) + sin ** 2 * M(4) if iS == 1 else sin ** 2 * M(3) + cos ** 2 * M(4)
+
+        def get_units(iS, jS):
+            """ groups of at most four rfft maps (matrix, i, j, powers of ikx and iky), with their products
+                (map a, map b, F component, weight). K and xiKxi being symmetric, (jS, iS) is folded into (iS, jS)"""
+            w = 1. if iS == jS else 2.
+            if iS == jS:
+                xis = ([(1, iS, iS, 1, 0), (1, iS, iS, 0, 1)], [(0, 0, 0, 1.), (1, 1, 1, 1.), (0, 1, 2, 1.)])
             else:
-                assert 0
-
-        def TEB2TQU(iS,jS,TEBmat):
-            """ R_sx R_ty Y Pxy """
-            assert TEBmat.shape == (ellmat.rshape[0],ellmat.rshape[1],3,3)
-            ret = np.zeros(ellmat.rshape)
-            for iX in range(3):
-                for jX in range(3):
-                    ret += apply_RSX(apply_RSX(TEBmat[:,:,iX,jX],iS,iX),jS,jX)
-            return ret
-        # turn TEB to TQU:
-        xiK = np.zeros_like(xiK_almmap)
-        for iS in range(3):
-            for jS in range(3):
-                xiK[:,:,iS,jS] = TEB2TQU(iS,jS,xiK_almmap)
-        del xiK_almmap
-
-        xiKxi = np.zeros_like(xiKxi_almmap)
-        for iS in range(3):
-            for jS in range(3):
-                xiKxi[:, :, iS, jS] = TEB2TQU(iS, jS, xiKxi_almmap)
-        del xiKxi_almmap
-
-        K = np.zeros_like(K_almmap)
-        for iS in range(3):
-            for jS in range(3):
-                K[:, :, iS, jS] = TEB2TQU(iS, jS, K_almmap)
-        del K_almmap
-
-        Fxx = np.zeros(ellmat.shape, dtype=float)
-        Fyy = np.zeros(ellmat.shape, dtype=float)
-        Fxy = np.zeros(ellmat.shape, dtype=float)
-        Fyx = np.zeros(ellmat.shape, dtype=float)
-
-        _2map = lambda almmap:np.fft.irfft2(almmap.astype(complex))
-        ikx = lambda :ellmat.get_ikx_mat()
-        iky = lambda: ellmat.get_iky_mat()
-
-        #-(xi, a K)(xi, b K) - (K)(xi, a  K xi, b)
-        for iS in range(3):
-            for jS in range(3):
-                Fxx += _2map(xiK[:,:,iS,jS] * ikx()) * _2map(xiK[:,:,jS,iS] * ikx())
-                Fyy += _2map(xiK[:,:,iS,jS] * iky()) * _2map(xiK[:,:,jS,iS] * iky())
-                Fxy += _2map(xiK[:,:,iS,jS] * ikx()) * _2map(xiK[:,:,jS,iS] * iky())
-                Fyx += _2map(xiK[:,:,iS,jS] * iky()) * _2map(xiK[:,:,jS,iS] * ikx())
-
-                Fxx += _2map(K[:, :, iS, jS]) * _2map(xiKxi[:, :, jS, iS] * ikx() * ikx())
-                Fyy += _2map(K[:, :, iS, jS]) * _2map(xiKxi[:, :, jS, iS] * iky() * iky())
-                Fxy += _2map(K[:, :, iS, jS]) * _2map(xiKxi[:, :, jS, iS] * ikx() * iky())
-                Fyx += _2map(K[:, :, iS, jS]) * _2map(xiKxi[:, :, jS, iS] * iky() * ikx())
-
+                xis = ([(1, iS, jS, 1, 0), (1, iS, jS, 0, 1), (1, jS, iS, 1, 0), (1, jS, iS, 0, 1)],
+                       [(0, 2, 0, 2.), (1, 3, 1, 2.), (0, 3, 2, 1.), (2, 1, 2, 1.)])
+            Ks = ([(0, iS, jS, 0, 0), (2, iS, jS, 2, 0), (2, iS, jS, 0, 2), (2, iS, jS, 1, 1)],
+                  [(0, 1, 0, w), (0, 2, 1, w), (0, 3, 2, w)])
+            return [xis, Ks]
+
+        #-(xi, a K)(xi, b K) - (K)(xi, a  K xi, b):
+        def get_F(units):
+            legs = [leg for unit in units for leg in unit[0]]
+            maps = np.empty((len(legs),) + ellmat.shape, dtype=float)
+            for l0 in range(0, len(legs), nbatch):  # batched FFTs
+                batch = legs[l0:l0 + nbatch]
+                rffts = np.empty((len(batch),) + ellmat.rshape, dtype=complex)
+                for r0 in range(0, ellmat.rshape[0], nrows):
+                    sl = slice(r0, min(r0 + nrows, ellmat.rshape[0]))
+                    ikx = 1j * kx[np.newaxis, :]
+                    iky = 1j * ky[sl, np.newaxis]
+                    for _n, (m, i, j, px, py) in enumerate(batch):
+                        rffts[_n, sl] = get_TQU(m, i, j, sl) * ikx ** px * iky ** py
+                maps[l0:l0 + nbatch] = np.fft.irfft2(rffts, ellmat.shape)
+                del rffts
+            F = np.zeros((3,) + ellmat.shape, dtype=float)  # xx, yy, xy
+            _n = 0
+            for unit_legs, prods in units:
+                for a, b, comp, w in prods:
+                    F[comp] += w * maps[_n + a] * maps[_n + b]
+                _n += len(unit_legs)
+            return F
+
+        units = [unit for pair in [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)] for unit in get_units(*pair)]
+        # Number of maps fitting in maxbytes, less about 5 for F, the multipole and phase matrices.
+        # A unit holds up to four maps, each costing three more (rfft input, intermediate and output) in a batched FFT:
+        nmaps = int(maxbytes // (8 * np.prod(ellmat.shape))) - 5
+        nunits = max(1, nmaps // 16)
+        nbatch = max(1, min(4 * nunits, (nmaps - 4 * nunits) // 3))
+        groups = [units[_i:_i + nunits] for _i in range(0, len(units), nunits)]
+        F = None
+        for _F in (map(get_F, groups) if executor is None else executor.map(get_F, groups)):
+            if F is None:
+                F = _F
+            else:
+                F += _F
         fac = 1. / np.sqrt(np.prod(ellmat.lsides)) * lib_tlm.fac_alm2rfft ** 2
-        Fxx = lib_qlm.map2alm(Fxx)
-        Fyy = lib_qlm.map2alm(Fyy)
-        Fxy = lib_qlm.map2alm(Fxy)
-        Fyx = lib_qlm.map2alm(Fyx)
+        Fxx, Fyy, Fxy = [lib_qlm.map2alm(_F) for _F in F]
+        del F
         ikx = lambda : lib_qlm.get_ikx()
         iky = lambda : lib_qlm.get_iky()
         assert isoN0s,'implement this (non anisotropic N0 2d cls)' #this affects only the following line:
-        return (fac*lib_qlm.bin_realpart_inell(Fxx * ikx() ** 2 + Fyy * iky() ** 2 + (Fxy + Fyx) * ikx() * iky()),
-                fac * lib_qlm.bin_realpart_inell( (Fxx * iky() ** 2 + Fyy * ikx() ** 2 - (Fxy + Fyx) * ikx() * iky())))
\ No newline at end of file
+        return (fac*lib_qlm.bin_realpart_inell(Fxx * ikx() ** 2 + Fyy * iky() ** 2 + 2. * Fxy * ikx() * iky()),
+                fac * lib_qlm.bin_realpart_inell( (Fxx * iky() ** 2 + Fyy * ikx() ** 2 - 2. * Fxy * ikx() * iky())))
+
+
+def _pinv_TEB(a, c, d, b, rcond=1e-15):
+    """Closed-form pseudo-inverses of the symmetric matrices ((a c 0) (c d 0) (0 0 b)), element-wise.
+
+        Eigenvalues below rcond times the largest are discarded, as in *np.linalg.pinv*.
+
+        Returns:
+            the (0, 0), (0, 1), (1, 1) and (2, 2) elements of the pseudo-inverses
+
+    """
+    m = 0.5 * (a + d)
+    r = np.sqrt(0.25 * (a - d) ** 2 + c ** 2)
+    l1, l2 = m + r, m - r
+    cut = rcond * np.maximum(np.maximum(np.abs(l1), np.abs(l2)), np.abs(b))
+    k1, k2 = np.abs(l1) > cut, np.abs(l2) > cut
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = a * d - c * c
+        full = k1 & k2
+        P00 = np.where(full, d / det, 0.)
+        P01 = np.where(full, -c / det, 0.)
+        P11 = np.where(full, a / det, 0.)
+        # rank one: 1 / l_k times the projector (M - l_other) / (l_k - l_other) onto the kept eigenvector
+        for keep, lk, lo in [(k1 & ~k2, l1, l2), (k2 & ~k1, l2, l1)]:
+            den = lk * (lk - lo)
+            P00 += np.where(keep, (a - lo) / den, 0.)
+            P01 += np.where(keep, c / den, 0.)
+            P11 += np.where(keep, (d - lo) / den, 0.)
+        P22 = np.where(np.abs(b) > cut, 1. / b, 0.)
+    return P00, P01, P11, P22
@@ -3,8 +3,10 @@ from __future__ import print_function
 import numpy as np
 
 from lensit.misc.misc_utils import enumerate_progress
+from lensit.ffs_covs.ell_mat import ffs_alm_pyFFTW
 
-def get_dcllendclunl_pert(_type, ell_mat,lmaxlen,lmaxunl,clpp):
+def get_dcllendclunl_pert(_type, ell_mat, lmaxlen, lmaxunl, clpp, lenbins=None, unlbins=None, executor=None,
+                          maxbytes=2 ** 28):
     """
     e.g. for the BB-EE part:
     MBB = M[0*M.shape[0]/3:1*M.shape[0]/3,M.shape[1]/3:2 * M.shape[1]/3]
@@ -15,18 +17,28 @@ def get_dcllendclunl_pert(_type, ell_mat,lmaxlen,lmaxunl,clpp):
     Based on: dC_llen^{A'B'} / dC^{AB}_lunl
        = R^{A'X}_llen R^{B'Y}_llenR ^{AX}_lunl R^{BY}_lunl * Sig^{ab}(len -unl) * (i ellunl_a i ellunl_b)
        with a bin over m', sum over m
+
+    The rows are calculated in batches with stacked FFTs. In polarization, the spin-2 structure is carried by
+    cos 4phi and sin 4phi only, so that three FFT convolutions per row serve all of EE, BB and EB.
+
     :param _type: 'T', 'QU' or 'TQU'
     :param ell_mat: ell_mat instance, containing info on patch size and resolution and flat-sky ell structure.
     :param lmaxlen:  calculates the matrix up to lensed Cls lmax lmaxlen
     :param lmaxunl:  calculates the matrix up to unlensed Cls lmax lmaxlen
     :param clpp: lensing potential spectrum cl
+    :param lenbins: (nbins, lmaxlen + 1) binning matrix of the lensed side (e.g. misc_utils.get_binmat).
+                    The binned rows are calculated directly, the full matrix is never built.
+                    Defaults to all multipoles present on the grid.
+    :param unlbins: (nbins, lmaxunl + 1) binning matrix of the unlensed side
+    :param executor: spreads the blocks of rows with executor.map if set (e.g. a concurrent.futures executor)
+    :param maxbytes: approximate memory budget of the map stacks of a block of rows
     :returns dC_llen / dCl_unl
     """
     if lmaxlen > lmaxunl:
         print(" this routine best for lmaxlen <= lmaxunl")
     assert _type in ['T', 'QU', 'TQU'], _type
     #FIXME: lmax ?
-    libalm = ell_mat.ffs_alm_pyFFTW(ell_mat, filt_func=lambda ell: ell >= 0)
+    libalm = ffs_alm_pyFFTW(ell_mat, filt_func=lambda ell: ell >= 0, flags_init=('FFTW_ESTIMATE',))
     _clpp = np.zeros(libalm.ellmax + 1)
     _clpp[:min(len(clpp),len(_clpp))]= clpp[:min(len(clpp),len(_clpp))]
 
@@ -38,67 +50,63 @@ def get_dcllendclunl_pert(_type, ell_mat,lmaxlen,lmaxunl,clpp):
     sigxy -= sigxy[0,0]
 
     fac = 1. / np.sqrt(np.prod(libalm.lsides))
-    Nell = libalm.get_Nell()[:max(lmaxlen,lmaxunl) + 1]
-    elllen, = Nell[:lmaxlen + 1].nonzero()
-    ellunl, = Nell[:lmaxunl + 1].nonzero()
+    Nell, lenbins, unlbins = _get_Nellbins(libalm, lmaxlen, lmaxunl, lenbins, unlbins)
     ikx2 = libalm.get_ikx() ** 2
     iky2 = libalm.get_iky() ** 2
     i2kxy = 2 * libalm.get_ikx() * libalm.get_iky()
 
+    def sigconv(alms):
+        ones = libalm.alms2maps(alms)
+        ret = ikx2 * libalm.maps2alms(sigxx * ones)
+        ret += iky2 * libalm.maps2alms(sigyy * ones)
+        ret += i2kxy * libalm.maps2alms(sigxy * ones)
+        return ret
+
     if _type == 'T': # returns dC_llen^TT / dC_lunl^TT (tranposed)
-        M = np.zeros((len(elllen), len(ellunl)), dtype=float)
-        cl = np.zeros(libalm.ellmax + 1, dtype=float)
-        for i, l in enumerate_progress(elllen, label='filling %s der. matrix up to %s' % (_type, lmaxlen)):
-            cl[l] = 1. / Nell[l]
-            ones = libalm.alm2map(libalm.almxfl(np.ones(libalm.alm_size,dtype = complex),cl))
-            alm = ikx2 * libalm.map2alm(sigxx * ones) \
-                + iky2 * libalm.map2alm(sigyy * ones) \
-                + i2kxy * libalm.map2alm(sigxy * ones)
-            M[i,:] = libalm.bin_realpart_inell(alm)[ellunl] * Nell[ellunl]
-            cl[l] = 0.
+        def get_rows(w):
+            return [np.dot(libalm.bin_realparts_inell(sigconv(w), ellmax=lmaxunl) * Nell[:lmaxunl + 1], unlbins.T)]
+        nrowmaps = 8
 
     elif _type == 'QU':  # # returns dC_llen^(EE,BB,EB) / dC_lunl^(EE,BB,EB) (tranposed)
         # At least EE-BB part seems to work ok, although the output BB is not as smooth as it maybe should be.
-        clmat = np.zeros((2, 2, libalm.ellmax + 1), dtype=float)
-        XYlms = np.zeros((2, 2, libalm.alm_size), dtype=complex)
-        M = np.zeros((3 * len(elllen), 3 * len(ellunl)), dtype=float)
         c, s = libalm.get_cossin_2iphi()
-        for i, l in enumerate_progress(elllen, label='filling %s der. matrix up to %s' % (_type, lmaxlen)):
-            for iA, ab in enumerate([(0, 0), (1, 1), (0, 1)]):
-                a, b = ab
-                clmat[a, b, l] =  1. / Nell[l]  # EE, BB or EB part
-                clmat[b, a, l] =  1. / Nell[l]
-                for iX,jX in [(0,0),(1,1),(0,1)]:
-                    QUmap =  libalm.alm2map(_EBcls2QUPmatij(libalm, clmat, iX, jX, c=c, s=s))
-                    XYlms[iX, jX] =  libalm.map2alm(sigxx * QUmap) * ikx2
-                    XYlms[iX, jX] += libalm.map2alm(sigyy * QUmap) * iky2
-                    XYlms[iX, jX] += libalm.map2alm(sigxy * QUmap) * i2kxy
-                XYlms[1,0] = XYlms[0,1]
-                retmat = _QUPmats2EBcls(libalm, XYlms, c=c, s=s)
-                M[iA * M.shape[0] // 3 + i,0 * M.shape[1] // 3:1 * M.shape[1] // 3] = retmat[0, 0, ellunl] * Nell[ellunl]
-                M[iA * M.shape[0] // 3 + i,1 * M.shape[1] // 3:2 * M.shape[1] // 3] = retmat[1, 1, ellunl] * Nell[ellunl]
-                M[iA * M.shape[0] // 3 + i,2 * M.shape[1] // 3:3 * M.shape[1] // 3] = retmat[0, 1, ellunl] * Nell[ellunl]
-                clmat[a, b, l] = 0.
-                clmat[b, a, l] = 0.
+        c4, s4 = c ** 2 - s ** 2, 2 * c * s
+        binned = lambda alms: np.dot(libalm.bin_realparts_inell(alms, ellmax=lmaxunl) * Nell[:lmaxunl + 1], unlbins.T)
+
+        def get_rows(w):
+            F1 = sigconv(w)
+            R1 = binned(F1)
+            del F1
+            FC = sigconv(w * c4)
+            FS = sigconv(w * s4)
+            Rcc = binned(c4 * FC + s4 * FS)
+            Rcs = binned(c4 * FS - s4 * FC)
+            del FC, FS
+            # rows EE, BB, EB, columns EE | BB | EB
+            return [np.hstack([0.5 * (R1 + Rcc), 0.5 * (R1 - Rcc), 0.5 * Rcs]),
+                    np.hstack([0.5 * (R1 - Rcc), 0.5 * (R1 + Rcc), -0.5 * Rcs]),
+                    np.hstack([-Rcs, Rcs, Rcc])]
+        nrowmaps = 20
     else:
         assert 0, '%s not implemented' % _type
-    return M * fac
+    return _fill_rows(libalm, get_rows, lenbins, Nell, nrowmaps, maxbytes, executor) * fac
 
-def get_dcllendclphi_pert(_type, ell_mat, lmaxlen, lmaxunl, cl_unl, BBonly = False):
+def get_dcllendclphi_pert(_type, ell_mat, lmaxlen, lmaxunl, cl_unl, BBonly = False, lenbins=None, unlbins=None,
+                          executor=None, maxbytes=2 ** 28):
     """
     It seems to work OK even if again thigs are not smooth, presumably because of non-smooth Nell beahvior.
+
+    See get_dcllendclunl_pert for the binning, executor and maxbytes arguments.
     """
     #FIXME: disgusting piece of code.
     if lmaxlen > lmaxunl:
         print(" this routine best for lmaxlen <= lmaxunl")
     assert _type in ['T', 'QU', 'TQU'], _type
     #FIXME: lmax ?
-    libalm = ell_mat.ffs_alm_pyFFTW(ell_mat, filt_func=lambda ell: ell >= 0)
+    libalm = ffs_alm_pyFFTW(ell_mat, filt_func=lambda ell: ell >= 0, flags_init=('FFTW_ESTIMATE',))
 
     fac = 1. / np.sqrt(np.prod(libalm.lsides))
-    Nell = libalm.get_Nell()[:max(lmaxlen,lmaxunl) + 1]
-    elllen, = Nell[:lmaxlen + 1].nonzero()
-    ellunl, = Nell[:lmaxunl + 1].nonzero()
+    Nell, lenbins, unlbins = _get_Nellbins(libalm, lmaxlen, lmaxunl, lenbins, unlbins)
     ikx = libalm.get_ikx
     iky = libalm.get_iky
     ikx2 = ikx() ** 2
@@ -106,98 +114,124 @@ def get_dcllendclphi_pert(_type, ell_mat, lmaxlen, lmaxunl, cl_unl, BBonly = Fal
     i2kxy = 2. * ikx() * iky()
 
     if _type == 'T': # returns dC_llen^TT / dC_lunl^TT (tranposed)
-        _cltt = np.zeros(libalm.ellmax + 1)
-        _cltt[:min(len(cl_unl['tt']), len(_cltt))] = cl_unl['tt'][:min(len(cl_unl['tt']), len(_cltt))]
         assert 0,'this is garbage'
-        M = np.zeros((len(elllen), len(ellunl)), dtype=float)
-        cl = np.zeros(libalm.ellmax + 1, dtype=float)
-        Cxx = libalm.alm2map(libalm.almxfl(ikx2, _cltt))
-        Cyy = libalm.alm2map(libalm.almxfl(iky2, _cltt))
-        Cxy = libalm.alm2map(libalm.almxfl(iky() * ikx(), _cltt))
-        for i, l in li.misc.misc_utils.enumerate_progress(elllen, label='filling %s der. matrix up to %s' % (_type, lmaxlen)):
-            cl[l] = 1. / Nell[l]
-            ones = libalm.alm2map(libalm.almxfl(np.ones(libalm.alm_size,dtype = complex),cl))
-            alm = np.zeros(libalm.alm_size,dtype = complex)
-            for kfac,_C in zip([ikx2,iky2,i2kxy],[Cxx,Cyy,Cxy]):
-                qlm = libalm.map2alm(_C * ones)
-                alm += kfac * (qlm -qlm[0])
-            M[i,:] = libalm.bin_realpart_inell(alm)[ellunl] * Nell[ellunl]
-            cl[l] = 0.
 
     elif _type == 'QU':  # # returns dC_llen^(EE,BB,EB) / dC_lunl^pp (tranposed)
         # At least EE-BB part seems to work ok, although the output BB is not as smooth as it maybe should be.
-        M = np.zeros((3 * len(elllen) if not BBonly else len(elllen), len(ellunl)), dtype=float)
         c, s = libalm.get_cossin_2iphi()
         TEBcls = np.zeros((2,2,libalm.ellmax + 1))
         TEBcls[0, 0, :min(len(cl_unl['ee']), libalm.ellmax + 1)] = cl_unl['ee'][:min(len(cl_unl['ee']),libalm.ellmax + 1)]
         TEBcls[1, 1, :min(len(cl_unl['bb']), libalm.ellmax + 1)] = cl_unl['bb'][:min(len(cl_unl['bb']), libalm.ellmax + 1)]
         if 'eb' in cl_unl.keys():
-            TEBcls[0, 1, :min(len(cl_unl['ee']), libalm.ellmax + 1)] = cl_unl['bb'][min(len(cl_unl['bb']), libalm.ellmax + 1)]
+            TEBcls[0, 1, :min(len(cl_unl['eb']), libalm.ellmax + 1)] = cl_unl['eb'][:min(len(cl_unl['eb']), libalm.ellmax + 1)]
             TEBcls[1, 0] = TEBcls[0,1]
 
-        Cxx = np.zeros((2,2,libalm.shape[0],libalm.shape[1]))
-        Cxy = np.zeros((2,2,libalm.shape[0],libalm.shape[1]))
-        Cyy = np.zeros((2,2,libalm.shape[0],libalm.shape[1]))
-        for iX,jX in [(0, 0), (1, 1), (0, 1)]:
-            Cxx[iX, jX] = libalm.alm2map(ikx2 * _EBcls2QUPmatij(libalm,TEBcls,iX,jX))
-            Cyy[iX, jX] = libalm.alm2map(iky2 * _EBcls2QUPmatij(libalm, TEBcls, iX, jX))
-            Cxy[iX, jX] = libalm.alm2map(ikx() * iky() * _EBcls2QUPmatij(libalm, TEBcls, iX, jX))
-        clmat = np.zeros((2, 2, libalm.ellmax + 1), dtype=float)
-        for i, l in enumerate_progress(elllen, label='filling %s der. matrix up to %s' % (_type, lmaxlen)):
-            for iA, (a,b) in enumerate([(0, 0), (1, 1), (0, 1)] if not BBonly else [(1,1)]):
-                clmat[a, b, l] =  1. / Nell[l]  # EE, BB or EB part
-                clmat[b, a, l] =  1. / Nell[l]
-                plms = np.zeros(libalm.alm_size, dtype=complex)
-                for iX,jX in [(0,0),(1,1),(0,1)]:
-                    ones = libalm.alm2map(_EBcls2QUPmatij(libalm, clmat, iX, jX, c=c, s=s))
-
-                    QUlm =  libalm.map2alm(Cxx[iX,jX] * ones)
-                    plms +=  ikx2 * (QUlm - QUlm[0])
-
-                    QUlm =  libalm.map2alm(Cyy[iX,jX] * ones)
-                    plms +=  iky2 * (QUlm - QUlm[0])
-
-                    QUlm =  libalm.map2alm(Cxy[iX,jX] * ones)
-                    plms += i2kxy * (QUlm - QUlm[0])
-                M[iA * M.shape[0] // 3 + i if not BBonly else i ,:] = libalm.bin_realpart_inell(plms)[ellunl] * Nell[ellunl]
-                clmat[a, b, l] = 0.
-                clmat[b, a, l] = 0.
+        Cxx = np.zeros((3,libalm.shape[0],libalm.shape[1]))
+        Cxy = np.zeros((3,libalm.shape[0],libalm.shape[1]))
+        Cyy = np.zeros((3,libalm.shape[0],libalm.shape[1]))
+        for iXY, (iX,jX) in enumerate([(0, 0), (1, 1), (0, 1)]):
+            Cxx[iXY] = libalm.alm2map(ikx2 * _EBcls2QUPmatij(libalm,TEBcls,iX,jX))
+            Cyy[iXY] = libalm.alm2map(iky2 * _EBcls2QUPmatij(libalm, TEBcls, iX, jX))
+            Cxy[iXY] = libalm.alm2map(ikx() * iky() * _EBcls2QUPmatij(libalm, TEBcls, iX, jX))
+        c4, s4 = c ** 2 - s ** 2, 2 * c * s
+        # QQ, UU and QU unit spectral matrices of EE, BB and EB in terms of w, w cos 4phi and w sin 4phi:
+        QUmats = [[(0.5, 0.5, 0.), (0.5, -0.5, 0.), (0., 0., 0.5)],
+                  [(0.5, -0.5, 0.), (0.5, 0.5, 0.), (0., 0., -0.5)],
+                  [(0., 0., -1.), (0., 0., 1.), (0., 1., 0.)]]
+
+        def get_rows(w):
+            u1, uc, us = [libalm.alms2maps(_w) for _w in [w, w * c4, w * s4]]
+            ret = []
+            for iA in ([0, 1, 2] if not BBonly else [1]):
+                plms = np.zeros(w.shape, dtype=complex)
+                for kfac, _C in zip([ikx2, iky2, i2kxy], [Cxx, Cyy, Cxy]):
+                    tmap = np.zeros(u1.shape, dtype=float)
+                    for iXY, (a1, ac, as_) in enumerate(QUmats[iA]):
+                        for a, u in zip([a1, ac, as_], [u1, uc, us]):
+                            if a != 0.:
+                                tmap += (a * _C[iXY]) * u
+                    QUlm = libalm.maps2alms(tmap)
+                    del tmap
+                    plms += kfac * (QUlm - QUlm[:, 0:1])
+                ret.append(np.dot(libalm.bin_realparts_inell(plms, ellmax=lmaxunl) * Nell[:lmaxunl + 1], unlbins.T))
+            return ret
+        nrowmaps = 12
     else:
         assert 0, '%s not implemented' % _type
-    return M * fac
+    return _fill_rows(libalm, get_rows, lenbins, Nell, nrowmaps, maxbytes, executor) * fac
 
-def build_BBcov_pert(ellmat, lmaxBB, cl_unl, clBBobs, lmax_unl=6000):
+def build_BBcov_pert(ellmat, lmaxBB, cl_unl, clBBobs, lmax_unl=6000, BBbins=None, executor=None):
     """Approximation to the BB covariance matrix.
 
+        If set, BBbins is a (nbins, lmaxBB + 1) binning matrix and the covariance of the binned BB is returned.
+
     """
-    Nell = ellmat.get_Nell()[:max(lmax_unl,lmaxBB) + 1]
+    Nell = np.zeros(max(lmax_unl, lmaxBB) + 1)
+    _Nell = ellmat.get_Nell()[:max(lmax_unl,lmaxBB) + 1]
+    Nell[:len(_Nell)] = _Nell
     elllen, = Nell[:lmaxBB + 1].nonzero()
     ellunl, = Nell[:lmax_unl + 1].nonzero()
+    if BBbins is None: BBbins = np.eye(lmaxBB + 1)[elllen]
 
     # Gaussian part:
-    covG = np.diag(2. * clBBobs[elllen] ** 2 / Nell[elllen])
+    _covG = np.zeros(lmaxBB + 1)
+    _covG[elllen] = 2. * clBBobs[elllen] ** 2 / Nell[elllen]
+    covG = np.dot(BBbins * _covG, BBbins.T)
     # sum_lunl dB/dphi_l covphi dB/dphi_l
 
-    dBdp = get_dcllendclphi_pert('QU',ellmat,lmaxBB,lmax_unl,cl_unl,BBonly=True)
-    covp = np.zeros( (len(elllen),len(elllen)),dtype = float)
+    dBdp = get_dcllendclphi_pert('QU',ellmat,lmaxBB,lmax_unl,cl_unl,BBonly=True, lenbins=BBbins, executor=executor)
     covpG = 2. * cl_unl['pp'][ellunl] ** 2 / Nell[ellunl]
-    for i,l1 in enumerate_progress(elllen,label = 'filling dBdphi part of Cov matrix'):
-        for j,l2 in enumerate(elllen):
-            covp[i,j] = np.sum(covpG * dBdp[i] * dBdp[j])
+    covp = np.dot(dBdp * covpG, dBdp.T)
     del dBdp
     # sum_lunl dB/dE_l covE dB/dE_l
-    dBdE = get_dcllendclunl_pert('QU',ellmat,lmaxBB,lmax_unl,cl_unl['pp'])
-    dBdE = dBdE[dBdE.shape[0]/3:2 * dBdE.shape[0]/3,0:dBdE.shape[1]/3]
-    covE = np.zeros( (len(elllen),len(elllen)),dtype = float)
+    dBdE = get_dcllendclunl_pert('QU',ellmat,lmaxBB,lmax_unl,cl_unl['pp'], lenbins=BBbins, executor=executor)
+    dBdE = dBdE[dBdE.shape[0]//3:2 * dBdE.shape[0]//3,0:dBdE.shape[1]//3]
     covEG = 2. * cl_unl['ee'][ellunl] ** 2 / Nell[ellunl]
-    for i,l1 in enumerate_progress(elllen,label = 'filling dBdE part of Cov matrix'):
-        for j,l2 in enumerate(elllen):
-            covE[i,j] = np.sum(covEG * dBdE[i] * dBdE[j])
+    covE = np.dot(dBdE * covEG, dBdE.T)
     del dBdE
 
     return covG,covE,covp
 
 
+def _get_Nellbins(libalm, lmaxlen, lmaxunl, lenbins, unlbins):
+    """Mode counts up to max(lmaxlen, lmaxunl), and default binning matrices (all multipoles present)
+
+    """
+    Nell = np.zeros(max(lmaxlen, lmaxunl) + 1)
+    _Nell = libalm.get_Nell()[:max(lmaxlen, lmaxunl) + 1]
+    Nell[:len(_Nell)] = _Nell
+    if lenbins is None: lenbins = np.eye(lmaxlen + 1)[Nell[:lmaxlen + 1].nonzero()]
+    if unlbins is None: unlbins = np.eye(lmaxunl + 1)[Nell[:lmaxunl + 1].nonzero()]
+    assert lenbins.shape[1] == lmaxlen + 1, (lenbins.shape, lmaxlen)
+    assert unlbins.shape[1] == lmaxunl + 1, (unlbins.shape, lmaxunl)
+    return Nell, lenbins, unlbins
+
+
+def _fill_rows(libalm, get_rows, lenbins, Nell, nrowmaps, maxbytes, executor):
+    """Builds the matrix rows from the unit (1 / Nell) input spectra of the lensed-side bins, per blocks of rows
+
+        get_rows takes a (nrows, alm_size) stack of 2d mode weights and returns a list of (nrows, ncols) arrays,
+        one per input spectrum. These are stacked vertically.
+
+    """
+    iNell = np.zeros(libalm.ellmax + 1)
+    ii = np.where(Nell[:min(len(Nell), libalm.ellmax + 1)] > 0)[0]
+    iNell[ii] = 1. / Nell[ii]
+    _lenbins = np.zeros((lenbins.shape[0], libalm.ellmax + 1))
+    _lenbins[:, :min(lenbins.shape[1], libalm.ellmax + 1)] = lenbins[:, :libalm.ellmax + 1]
+    _lenbins *= iNell
+    ells = libalm.reduced_ellmat()
+    nbatch = max(1, maxbytes // (nrowmaps * 8 * int(np.prod(libalm.shape))))
+    blocks = [_lenbins[i:i + nbatch] for i in range(0, _lenbins.shape[0], nbatch)]
+    label = 'filling der. matrix, %s blocks of %s rows' % (len(blocks), nbatch)
+    get_block = lambda block: get_rows(block[:, ells].astype(complex))
+    if executor is None:
+        rows = [get_block(block) for i, block in enumerate_progress(blocks, label=label)]
+    else:
+        rows = list(executor.map(get_block, blocks))
+    return np.vstack([np.vstack([r[iA] for r in rows]) for iA in range(len(rows[0]))])
+
+
 def _EBcls2QUPmatij(lib_alm, TEBcls, i, j, c=None, s=None):
     """Turns E,B spectra into Q,U spectral matrices according to
 
@@ -58,6 +58,13 @@ def cls_hash(cls, lmax=None, astype=np.float32):
 def npy_hash(npy_array, astype=np.float32):
     return hashlib.sha1(np.copy(npy_array.astype(astype), order='C')).hexdigest()
 
+def dict_hash(hdict):
+    """sha1 hex digest of a (possibly nested) dictionary of hashes, independent of the keys ordering
+
+    """
+    items = sorted((k, dict_hash(v) if isinstance(v, dict) else v) for k, v in hdict.items())
+    return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
 def cl_inverse(cl):
     """Array pseudo-inverse
 
@@ -280,6 +287,25 @@ def binned(Cl, nzell, bins_l, bins_u, w=lambda ell: np.ones(len(ell), dtype=floa
         return ret
     return ret, err
 
+
+def get_binmat(lmax, nzell, edges=None, w=None, meanorsum='mean', full=False):
+    """Returns the (nbins, lmax + 1) matrix performing the binning of *binned* as a linear map.
+
+    Without edges this is the identity, restricted to the multipoles *nzell* unless *full* is set.
+    """
+    assert meanorsum in ['mean', 'sum'], meanorsum
+    if edges is None:
+        return np.eye(lmax + 1)[slice(0, lmax + 1) if full else nzell]
+    if w is None: w = lambda ell: np.ones(len(ell), dtype=float)
+    bu = edges[1:] - 1
+    bu[-1] += 1
+    ret = np.zeros((len(bu), lmax + 1), dtype=float)
+    for ib, (bl, _bu) in enumerate(zip(edges[:-1], bu)):
+        ells = nzell[np.where((nzell >= bl) & (nzell <= _bu))]
+        ret[ib, ells] = w(ells) / (len(ells) if meanorsum == 'mean' else 1.)
+    return ret
+
+
 class binner:
     def __init__(self, bins_l, bins_r):
         """Binning routines. Left and right inclusive.
@@ -341,8 +367,13 @@ def PartialDerivativePeriodic(arr, axis, h=1., rule='4pts'):
         weights = 0
         assert 0, rule + " not implemented"
 
-    grad = np.roll(arr, idc[0], axis=axis) * weights[0]
-    for i, w in zip(idc[1:], weights[1:]): grad += np.roll(arr, i, axis=axis) * w
+    grad = np.roll(arr, idc[0], axis=axis)
+    grad *= weights[0]
+    for i, w in zip(idc[1:], weights[1:]):
+        temp = np.roll(arr, i, axis=axis)
+        temp *= w
+        grad += temp
+        del temp
     return grad
 
 
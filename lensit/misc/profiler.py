@@ -0,0 +1,188 @@
+"""Hierarchical profiling of named phases (wall time, cpu time, call counts and memory).
+
+    Phases are entered with the *phase* context manager, or the *profiled* function decorator. Nested phases are
+    recorded under slash-separated paths ('gradlik/cg/lensing'), per thread. *dump* appends the records collected
+    since the last dump as a single JSON line to a file, e.g. one per iteration and mpi rank.
+
+    Memory is recorded as 'peak_rss_so_far_mb', the peak resident set size of the process since its start, taken at
+    the end of the phase. This bounds the memory the phase used from above; it is not the usage of the phase itself.
+
+    Set *enabled* to False to disable all profiling.
+
+    Summary table of one or several such files:
+
+        python -m lensit.misc.profiler_summary lib_dir/cghistories/profile_rank*.jsonl
+
+
+"""
+from __future__ import print_function
+
+import sys
+import json
+import time
+import threading
+import functools
+
+try:
+    import resource
+except ImportError:  # not on unix
+    resource = None
+
+enabled = True
+
+_process_time = getattr(time, 'process_time', None) or time.clock  # python 2: time.clock is the process cpu time
+
+_records = {}  # phase path: [count, wall time, cpu time, peak rss of the process so far]
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_maxrss():
+    """Peak resident set size of the process since its start in MB (None if not available)
+
+    """
+    if resource is None: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.
+
+
+class _phase(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'): _local.stack = []
+        _local.stack.append(self.name)
+        self.path = '/'.join(_local.stack)
+        self.t0 = time.time()
+        self.c0 = _process_time()  # process-wide: includes the cpu time of other threads and of pyfftw
+        return self
+
+    def __exit__(self, *args):
+        dt = time.time() - self.t0
+        dc = _process_time() - self.c0
+        rss = get_maxrss()
+        _local.stack.pop()
+        with _lock:
+            rec = _records.setdefault(self.path, [0, 0., 0., None])
+            rec[0] += 1
+            rec[1] += dt
+            rec[2] += dc
+            rec[3] = rss if rec[3] is None else max(rec[3], rss)
+
+
+class _nophase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_nophase_instance = _nophase()
+
+
+def phase(name):
+    """Context manager recording a phase with this name, nested under the current phases of the thread.
+
+    """
+    return _phase(name) if enabled else _nophase_instance
+
+
+def profiled(name):
+    """Function decorator recording each call as a phase with this name.
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_records(reset=False):
+    """Returns the records collected so far as a dictionary phase path: dict
+
+    """
+    with _lock:
+        ret = {path: {'count': rec[0], 'wall': rec[1], 'cpu': rec[2], 'peak_rss_so_far_mb': rec[3]}
+               for path, rec in _records.items()}
+        if reset: _records.clear()
+    return ret
+
+
+def dump(fname, **meta):
+    """Appends the records collected since the last dump as a JSON line to *fname*, and resets them.
+
+        Args:
+            fname: path to the output JSON-lines file
+            meta: additional entries of the record (e.g. it=it, key=key, rank=rank)
+
+    """
+    records = get_records(reset=True)
+    if not enabled or len(records) == 0: return
+    line = dict(meta)
+    line['time'] = time.time()
+    line['peak_rss_so_far_mb'] = get_maxrss()
+    line['phases'] = records
+    with open(fname, 'a') as file:
+        file.write(json.dumps(line) + '\n')
+        file.close()
+
+
+def load(fnames):
+    """Loads the records of a list of JSON-lines files.
+
+    """
+    ret = []
+    for fname in fnames:
+        with open(fname, 'r') as file:
+            ret += [json.loads(line) for line in file if line.strip()]
+    return ret
+
+
+def aggregate(records):
+    """Aggregates phase records over iterations and ranks
+
+        Returns:
+            dictionary phase path: dict with total count, total wall and cpu times, maximal wall time in a record,
+            and peak memory of the process so far
+
+    """
+    ret = {}
+    for record in records:
+        for path, rec in record['phases'].items():
+            agg = ret.setdefault(path, {'count': 0, 'wall': 0., 'cpu': 0., 'wall_max': 0.,
+                                        'peak_rss_so_far_mb': None})
+            agg['count'] += rec['count']
+            agg['wall'] += rec['wall']
+            agg['cpu'] += rec['cpu']
+            agg['wall_max'] = max(agg['wall_max'], rec['wall'])
+            rss, agg_rss = rec['peak_rss_so_far_mb'], agg['peak_rss_so_far_mb']
+            if rss is not None:
+                agg['peak_rss_so_far_mb'] = rss if agg_rss is None else max(agg_rss, rss)
+    return ret
+
+
+def summary(records):
+    """Summary table of phase records, as a string.
+
+    """
+    agg = aggregate(records)
+    nrec = len(records)
+    ranks = set([record.get('rank', 0) for record in records])
+    lines = ['%s records, %s ranks' % (nrec, len(ranks)),
+             '%-40s %8s %12s %12s %12s %8s %10s' % ('phase', 'calls', 'wall [s]', 'per rec. [s]', 'max rec. [s]',
+                                                    'cpu/wall', 'peak rss [MB]')]
+    for path in sorted(agg.keys()):
+        a = agg[path]
+        lines.append('%-40s %8d %12.2f %12.2f %12.2f %8.2f %10s' % (
+            '  ' * path.count('/') + path.split('/')[-1], a['count'], a['wall'], a['wall'] / max(nrec, 1),
+            a['wall_max'], a['cpu'] / max(a['wall'], 1e-10),
+            '-' if a['peak_rss_so_far_mb'] is None else '%.0f' % a['peak_rss_so_far_mb']))
+    return '\n'.join(lines)
+
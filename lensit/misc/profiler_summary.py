@@ -0,0 +1,18 @@
+"""Prints the summary table of profiling records written by *lensit.misc.profiler.dump*
+
+    Usage:
+        python -m lensit.misc.profiler_summary file1.jsonl [file2.jsonl ...]
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+
+from lensit.misc import profiler
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    print(profiler.summary(profiler.load([fname for fname in sys.argv[1:] if os.path.exists(fname)])))
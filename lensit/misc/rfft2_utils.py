@@ -103,7 +103,7 @@ def supersample(LD_map, HD_shape):
 
 def degrade(HD_map, LD_shape):
     if np.all(HD_map.shape <= LD_shape): return HD_map.copy()
-    fac0, fac1 = (HD_map.shape[0] / LD_shape[0], HD_map.shape[1] / LD_shape[1])
+    fac0, fac1 = (HD_map.shape[0] // LD_shape[0], HD_map.shape[1] // LD_shape[1])
     assert fac0 * LD_shape[0] == HD_map.shape[0] and fac1 * LD_shape[1] == HD_map.shape[1], (
         (fac0, fac1), LD_shape, HD_map.shape)
 
@@ -138,7 +138,7 @@ def udgrade_rfft2(rfft2map, shape, norm=False):
 
 
 def _degrade_rfft2(rfft2map, LDshape):
-    ret = np.zeros((LDshape[0], LDshape[0] // 2 + 1), dtype=complex)
+    ret = np.zeros((LDshape[0], LDshape[0] // 2 + 1), dtype=np.result_type(rfft2map.dtype, np.complex64))
     ret[0:LDshape[0] // 2 + 1, :] = rfft2map[0:LDshape[0] // 2 + 1, 0:ret.shape[1]]
     ret[LDshape[0] // 2::] = rfft2map[rfft2map.shape[0] - LDshape[0] // 2:, 0:ret.shape[1]]
     # Corrections for pure reals and (-k) = k* :
@@ -148,7 +148,7 @@ def _degrade_rfft2(rfft2map, LDshape):
 
 
 def _upgrade_rfft2(rfft2map, HDshape):
-    ret = np.zeros((HDshape[0], HDshape[0] / 2 + 1), dtype=complex)
+    ret = np.zeros((HDshape[0], HDshape[0] // 2 + 1), dtype=np.result_type(rfft2map.dtype, np.complex64))
     # positive 0axis frequencies : (including N/2 + 1, which is pure real.
     ret[0:rfft2map.shape[0] // 2 + 1, 0:rfft2map.shape[1]] = rfft2map[0:rfft2map.shape[0] // 2 + 1, 0:rfft2map.shape[1]]
     # Negative 0axis freq.
@@ -5,8 +5,12 @@
 from __future__ import print_function
 import os
 import sys
+import time
+import threading
+from collections import deque
 
 verbose = False
+comm = None
 if 'SLURM_SUBMIT_DIR' in os.environ.keys():
     try:
         from mpi4py import MPI
@@ -14,6 +18,7 @@ if 'SLURM_SUBMIT_DIR' in os.environ.keys():
         size = MPI.COMM_WORLD.Get_size()
         barrier = MPI.COMM_WORLD.Barrier
         finalize = MPI.Finalize
+        comm = MPI.COMM_WORLD
         if verbose:
             print('pbs.py : setup OK, rank %s in %s' % (rank, size))
     except:
@@ -25,11 +30,13 @@ elif 'NERSC_HOST' not in os.environ.keys():
         size = MPI.COMM_WORLD.Get_size()
         barrier = MPI.COMM_WORLD.Barrier
         finalize = MPI.Finalize
+        comm = MPI.COMM_WORLD
     except:
         rank = 0
         size = 1
         barrier = lambda: -1
         finalize = lambda: -1
+        comm = None
         if verbose: print('pbs.py : This looks like invocation on login nodes')
 
 else:
@@ -37,4 +44,199 @@ else:
     size = 1
     barrier = lambda: -1
     finalize = lambda: -1
+    comm = None
     if verbose: print('pbs.py : This looks like invocation on login nodes')
+
+_TAG_REQ = 7301
+_TAG_TASK = 7302
+_nqueues = 0  # number of task queues created so far, identifying the messages of each queue
+_WAIT = object()  # no task yet, but another rank might still stall with its own
+
+
+class taskqueue(object):
+    """Dynamic master/worker distribution of a list of tasks over the mpi ranks.
+
+        Tasks are handed out on demand, so that slow ranks simply do fewer tasks. Rank 0 serves the queue from a
+        background thread while processing tasks itself; the other ranks request tasks with point-to-point messages.
+        A rank leaving the loop before the queue is exhausted (exception or break) has its current task requeued.
+        Without mpi, or with a single rank, this is a plain local queue.
+
+        The serving thread needs MPI_THREAD_MULTIPLE. With a lower thread support level, the tasks are instead
+        distributed statically in round-robin (rank r doing tasks r, r + size...), without requeuing nor timeout.
+
+        Args:
+            tasks: list of (picklable) tasks
+            master_tasks: tasks processed by rank 0 before the shared ones (e.g. to reuse some of its state)
+            timeout(optional): once the queue is empty, the task of a rank holding it for longer than this (in seconds)
+                               is handed once to another idle rank. Idle ranks wait for this as long as other
+                               ranks hold tasks. The stalled rank is then considered gone: it gets no further
+                               task, and the queue does not wait for it. Tasks must be safe to process twice.
+            rank: mpi rank (defaults to pbs.rank)
+            size: number of mpi ranks (defaults to pbs.size)
+
+        Usage:
+            >>> queue = taskqueue(tasks)
+            >>> for task in queue: do(task)
+            >>> print(queue.report())
+
+        All ranks must create their task queues in the same order.
+
+    """
+    def __init__(self, tasks, master_tasks=(), timeout=None, rank=None, size=None):
+        global _nqueues
+        _nqueues += 1
+        self._qid = _nqueues
+        # Own mpi tags, so that the requests of a queue are never received by the master loop of another one
+        self._tag_req = _TAG_REQ + 2 * (self._qid % 1000)
+        self._tag_task = self._tag_req + 1
+        self.rank = globals()['rank'] if rank is None else rank
+        self.size = globals()['size'] if size is None else size
+        self.mpi = self.size > 1 and comm is not None
+        self.static = self.mpi and MPI.Query_thread() < MPI.THREAD_MULTIPLE
+        if self.static:  # plain local queue of this rank's share of the tasks
+            if self.rank == 0: print('pbs.taskqueue: no MPI_THREAD_MULTIPLE support, distributing the tasks statically')
+            tasks = list(tasks)[self.rank::self.size]
+            self.mpi = False
+        self.timeout = timeout
+        self._pending = deque(tasks)
+        self._master = deque(master_tasks)
+        self._assigned = {}  # rank: (task, start time)
+        self._gone = set()  # stalled ranks whose task was handed to another one
+        self._finished = set()  # ranks done with the queue
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {}  # rank: (number of tasks, busy time, wall time)
+        self._t0 = time.time()
+        if self.mpi and self.rank == 0:
+            self._thread = threading.Thread(target=self._serve)
+            self._thread.start()
+
+    def _next(self, rank):
+        with self._lock:
+            self._assigned.pop(rank, None)  # done with its previous task
+            task = None
+            if rank in self._gone:  # its task was handed to another rank already
+                pass
+            elif len(self._pending) > 0:
+                task = self._pending.popleft()
+            elif self.timeout is not None:  # hands the longest running task once to this rank if stalled
+                now = time.time()
+                stalled = sorted([(t_start, r) for r, (t, t_start) in self._assigned.items()
+                                  if now - t_start > self.timeout])
+                if len(stalled) > 0:
+                    r = stalled[0][1]
+                    task = self._assigned.pop(r)[0]
+                    if r != 0: self._gone.add(r)
+                    print('pbs.taskqueue: rank %s stalled, handing its task to rank %s' % (r, rank))
+            if task is not None:
+                self._assigned[rank] = (task, time.time())
+            elif self.timeout is not None and rank not in self._gone and len(self._assigned) > 0:
+                return _WAIT
+            return task
+
+    def _leave(self, rank):
+        with self._lock:
+            if rank in self._assigned:
+                task = self._assigned.pop(rank)[0]
+                if task not in self._pending:
+                    print('pbs.taskqueue: rank %s left, requeuing its task' % rank)
+                    self._pending.appendleft(task)
+
+    def _nactive(self):
+        with self._lock:
+            return self.size - 1 - len((self._finished | self._gone) - {0})
+
+    def _serve(self):
+        """Master loop, answering the task requests of the other ranks until they are all done or gone.
+
+        """
+        status = MPI.Status()
+        waiting = []  # idle ranks not answered yet
+        while self._nactive() > 0:
+            for src in list(waiting):
+                task = self._next(src)
+                if task is not _WAIT:
+                    waiting.remove(src)
+                    self._answer(src, task)
+            if not comm.Iprobe(source=MPI.ANY_SOURCE, tag=self._tag_req, status=status):
+                time.sleep(0.01)  # not blocking on recv, which busy-waits with most mpi implementations
+                continue
+            src = status.Get_source()
+            qid, kind, stats = comm.recv(source=src, tag=self._tag_req)
+            if qid != self._qid: continue  # late message to a previous queue sharing the tags
+            self._stats[src] = stats
+            if kind == 'leave':
+                self._leave(src)
+                self._answer(src, None, send=False)
+                continue
+            task = self._next(src)
+            if task is _WAIT:
+                waiting.append(src)
+            else:
+                self._answer(src, task)
+        # Releases stalled ranks that might still be alive (small messages, sent eagerly in practice)
+        requests = [comm.isend((self._qid, None), dest=r, tag=self._tag_task) for r in self._gone - self._finished - {0}]
+        for request in requests:
+            request.wait()
+
+    def _answer(self, src, task, send=True):
+        if send:
+            comm.send((self._qid, task), dest=src, tag=self._tag_task)
+        if task is None:
+            with self._lock:
+                self._finished.add(src)
+                self._gone.discard(src)
+
+    def _request(self, stats):
+        comm.send((self._qid, 'next', stats), dest=0, tag=self._tag_req)
+        while True:
+            qid, task = comm.recv(source=0, tag=self._tag_task)
+            if qid == self._qid: return task
+
+    def __iter__(self):
+        ntasks, busy, done = 0, 0., False
+        try:
+            while True:
+                if self.rank == 0 and len(self._master) > 0:
+                    task = self._master.popleft()
+                elif not self.mpi or self.rank == 0:
+                    task = self._next(self.rank)
+                    while task is _WAIT:
+                        time.sleep(0.01)
+                        task = self._next(self.rank)
+                else:
+                    task = self._request((ntasks, busy, time.time() - self._t0))
+                if task is None:
+                    done = True
+                    break
+                ti = time.time()
+                yield task
+                busy += time.time() - ti
+                ntasks += 1
+        finally:
+            if self.mpi and self.rank > 0 and not done:
+                comm.send((self._qid, 'leave', (ntasks, busy, time.time() - self._t0)), dest=0,
+                          tag=self._tag_req)
+            elif not done:
+                self._leave(self.rank)
+            self._stats[self.rank] = (ntasks, busy, time.time() - self._t0)
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+
+    def utilisation(self):
+        """Returns rank: (number of tasks, busy time, wall time) of the ranks known to this one (all of them on rank 0)
+
+        """
+        return dict(self._stats)
+
+    def report(self):
+        """Per-rank utilisation summary.
+
+        """
+        lines = []
+        for r in sorted(self._stats.keys()):
+            ntasks, busy, wall = self._stats[r]
+            lines.append('rank %s: %s tasks, busy %.2fs in %.2fs (%.0f%%)' % (r, ntasks, busy, wall,
+                                                                         100. * busy / max(wall, 1e-10)))
+        return '\n'.join(lines)
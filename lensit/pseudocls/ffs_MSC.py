@@ -3,7 +3,7 @@ import os
 import hashlib
 import numpy as np, healpy as hp
 
-from lensit.misc.misc_utils import binned, enumerate_progress
+from lensit.misc.misc_utils import binned, get_binmat, enumerate_progress
 from lensit.ffs_covs import ell_mat, ffs_specmat
 
 
@@ -47,36 +47,26 @@ class MSC_T:
         self.apomask = apomask
         self.lib_alm = ell_mat.ffs_alm_pyFFTW(lib_datalm.ell_mat, filt_func=lambda ell: ell <= lmax)
         lmax = self.lib_alm.ellmax  # !this might actually differ very slightly from lmax for small patches
-        fname = cache_dir + '/lmax%s' % lmax + hashlib.sha1(apomask).hexdigest()
         shape_p = len(pedges) - 1 if pedges is not None else lmax + 1
         shape_t = len(tedges) - 1 if tedges is not None else lmax + 1
+        if wp is None: wp = lambda ell: np.ones(len(ell), dtype=float)
+        if wt is None: wt = lambda ell: np.ones(len(ell), dtype=float)
 
-        if pedges is not None: fname + '_p' + hashlib.sha1(pedges).hexdigest()
-        if wp is not None: fname + '_wp' + hashlib.sha1(wp(np.arange(lmax + 1))).hexdigest()
-        if tedges is not None: fname + '_t' + hashlib.sha1(tedges).hexdigest()
-        if wt is not None: fname + '_wt' + hashlib.sha1(wt(np.arange(lmax + 1))).hexdigest()
+        fname = cache_dir + '/lmax%s' % lmax + hashlib.sha1(apomask).hexdigest()
+        if pedges is not None:
+            fname += '_p' + hashlib.sha1(np.array(pedges)).hexdigest()
+            fname += '_wp' + hashlib.sha1(wp(np.arange(lmax + 1))).hexdigest()
+        if tedges is not None:
+            fname += '_t' + hashlib.sha1(np.array(tedges)).hexdigest()
+            fname += '_wt' + hashlib.sha1(wt(np.arange(lmax + 1))).hexdigest()
         fname += '.npy'
         if not os.path.exists(fname):
             if not os.path.exists(cache_dir): os.makedirs(cache_dir)
-            M = get_MSCdense('T', self.lib_alm, apomask, lmax, full=pedges is not None or tedges is not None)
-            if tedges is not None:
-                print("Binning coupling matrix Cl side")
-                ii, = np.where(self.lib_alm.get_Nell()[:lmax + 1] > 0)
-                if wt is None: wt = lambda ell: np.ones(len(ell), dtype=float)
-                wti = lambda ell: 1. / wt(ell)
-                bu = tedges[1:] - 1
-                bu[-1] += 1
-                M = np.array([binned(m, ii, tedges[:-1], bu, w=wti, meanorsum='sum') for m in M])
-            if pedges is not None:
-                print("Binning coupling matrix pCl side")
-                if wp is None: wp = lambda ell: np.ones(len(ell), dtype=float)
-                ii, = np.where(self.lib_alm.get_Nell()[:lmax + 1] > 0)
-                bu = pedges[1:] - 1
-                bu[-1] += 1
-                _M = np.zeros((len(bu), M.shape[1]))
-                for i in range(M.shape[1]):
-                    _M[:, i] = binned(M[:, i], ii, pedges[:-1], bu, w=wp)
-                M = _M
+            full = pedges is not None or tedges is not None
+            ii, = np.where(self.lib_alm.get_Nell()[:lmax + 1] > 0)
+            pbins = get_binmat(lmax, ii, pedges, w=wp, full=full)
+            tbins = get_binmat(lmax, ii, tedges, w=lambda ell: 1. / wt(ell), meanorsum='sum', full=full)
+            M = get_MSCbinned('T', self.lib_alm, apomask, lmax, pbins=pbins, tbins=tbins)
             np.save(fname, self._invM(M) if M.shape[0] == M.shape[1] else M)
             print("Cached ", fname)
 
@@ -151,49 +141,27 @@ class MSC_P:
         shape_p = np.array([len(p) - 1 if p is not None else lmax + 1 for p in pedgess])
         shape_t = np.array([len(t) - 1 if t is not None else lmax + 1 for t in tedgess])
 
+        wps = [wp or (lambda ell: np.ones(len(ell), dtype=float)) for wp in wps]
+        wts = [wt or (lambda ell: np.ones(len(ell), dtype=float)) for wt in wts]
+
         fname = cache_dir + '/lmax%s' % lmax + hashlib.sha1(apomask).hexdigest()
         for iA, (pedges, wp) in enumerate(zip(pedgess, wps)):
-            if pedges is not None: fname + '_p%s' % iA + hashlib.sha1(pedges).hexdigest()
-            if wp is not None: fname + '_wp%s' % iA + hashlib.sha1(wp(np.arange(lmax + 1))).hexdigest()
+            if pedges is not None:
+                fname += '_p%s' % iA + hashlib.sha1(np.array(pedges)).hexdigest()
+                fname += '_wp%s' % iA + hashlib.sha1(wp(np.arange(lmax + 1))).hexdigest()
         for iA, (tedges, wt) in enumerate(zip(tedgess, wts)):
-            if tedges is not None: fname + '_t%s' % iA + hashlib.sha1(tedges).hexdigest()
-            if wt is not None: fname + '_wt%s' % iA + hashlib.sha1(wt(np.arange(lmax + 1))).hexdigest()
+            if tedges is not None:
+                fname += '_t%s' % iA + hashlib.sha1(np.array(tedges)).hexdigest()
+                fname += '_wt%s' % iA + hashlib.sha1(wt(np.arange(lmax + 1))).hexdigest()
         fname += '.npy'
         if not os.path.exists(fname):
             if not os.path.exists(cache_dir): os.makedirs(cache_dir)
-            M = get_MSCdense('QU', self.lib_alm, apomask, lmax, full=self.wbins)
-            if self.wbins:
-                assert M.shape == (3 * (lmax + 1), 3 * (lmax + 1)), M.shape
-                _M = np.zeros((M.shape[0], np.sum(shape_t)), dtype=float)
-                ii, = np.where(self.lib_alm.get_Nell()[:lmax + 1] > 0)
-                print(shape_p, shape_t)
-                for iA, (lab, tedges, wt) in enumerate(zip(['EE', 'BB', 'EB'], tedgess, wts)):
-                    slice_t = slice(np.sum(shape_t[:iA]), np.sum(shape_t[:iA + 1]))
-                    if tedges is not None:
-                        print("Binning coupling matrix Cl side, %s" % lab)
-                        if wt is None: wt = lambda ell: np.ones(len(ell), dtype=float)
-                        wti = lambda ell: 1. / wt(ell)
-                        bu = tedges[1:] - 1
-                        bu[-1] += 1
-                        for l in np.concatenate([ii, ii + 1 * (lmax + 1), ii + 2 * (lmax + 1)]):
-                            _M[l, slice_t] = binned(M[l, iA * (lmax + 1):(iA + 1) * (lmax + 1)], ii, tedges[:-1], bu,
-                                                    w=wti, meanorsum='sum')
-                    else:
-                        _M[:, slice_t] = M[:, slice_t]
-                M = _M.copy()
-                _M = np.zeros((np.sum(shape_t), M.shape[1]), dtype=float)
-                for iA, (lab, pedges, wp) in enumerate(zip(['EE', 'BB', 'EB'], pedgess, wps)):
-                    slice_p = slice(np.sum(shape_p[:iA]), np.sum(shape_p[:iA + 1]))
-                    if pedges is not None:
-                        print("Binning coupling matrix pCl side, %s" % lab)
-                        if wp is None: wp = lambda ell: np.ones(len(ell), dtype=float)
-                        bu = pedges[1:] - 1
-                        bu[-1] += 1
-                        for ib in range(M.shape[1]):
-                            _M[slice_p, ib] = binned(M[iA * (lmax + 1):(iA + 1) * (lmax + 1), ib], ii, pedges[:-1], bu, w=wp)
-                    else:
-                        _M[slice_p, :] = M[slice_p, :]
-                M = _M.copy()
+            ii, = np.where(self.lib_alm.get_Nell()[:lmax + 1] > 0)
+            pbins = [get_binmat(lmax, ii, pedges, w=wp, full=self.wbins) for pedges, wp in zip(pedgess, wps)]
+            tbins = [get_binmat(lmax, ii, tedges, w=lambda ell, wt=wt: 1. / wt(ell), meanorsum='sum', full=self.wbins)
+                     for tedges, wt in zip(tedgess, wts)]
+            M = get_MSCbinned('QU', self.lib_alm, apomask, lmax, pbins=pbins, tbins=tbins)
+            assert M.shape == (np.sum(shape_p), np.sum(shape_t)), (M.shape, shape_p, shape_t)
             np.save(fname, self._invM(M) if M.shape[0] == M.shape[1] else M)
             print("Cached ", fname)
 
@@ -353,6 +321,82 @@ def get_MSCdense(_type, lib_datalm, mask, lmax, full=False):
     return M * fac
 
 
+def get_MSCbinned(_type, lib_datalm, mask, lmax, pbins=None, tbins=None, maxbytes=2 ** 28):
+    """Returns the binned cut-sky coupling matrix Pbins M Tbins^t, with M as in get_MSCdense.
+
+    The mask power |W_k|^2 is computed once on the 2d grid, and each column is the convolution of |W_k|^2
+    with the 2d mode weights of one Cl-side bin (batched 2D FFTs), binned in ell on the pCl side.
+    The cost thus scales with the number of Cl-side bins rather than with lmax.
+
+    For polarization (EE BB EB) the spin-2 coupling follows from the cos and sin 2phi kernels: with
+    C = cos 4phi and S = sin 4phi, only the three convolutions of the weights w, w C and w S are needed per bin.
+
+    Args:
+        pbins: (nbins, lmax + 1) binning matrix of the pseudo-Cl side (see *get_binmat*), one per spectrum for QU.
+               Defaults to the multipoles present on the grid, as get_MSCdense(full=False)
+        tbins: same for the Cl side
+        maxbytes: memory budget for the stacks of maps in the batched FFTs
+
+    """
+    assert _type in ['T', 'QU'], _type
+    libalm = ell_mat.ffs_alm_pyFFTW(lib_datalm.ell_mat, filt_func=lambda ell: ell <= 2 * lmax,
+                                    flags_init=('FFTW_ESTIMATE',))  # batched plans are not reused
+    ii, = np.where(libalm.get_Nell()[:lmax + 1] > 0)
+    nspec = 1 if _type == 'T' else 3
+    if pbins is None: pbins = get_binmat(lmax, ii)
+    if tbins is None: tbins = get_binmat(lmax, ii)
+    if not isinstance(pbins, (list, tuple)): pbins = [pbins] * nspec
+    if not isinstance(tbins, (list, tuple)): tbins = [tbins] * nspec
+    assert len(pbins) == nspec and len(tbins) == nspec, (len(pbins), len(tbins))
+    for b in list(pbins) + list(tbins): assert b.shape[1] == lmax + 1, (b.shape, lmax)
+
+    Bx = libalm.alm2map(np.abs(libalm.map2alm(mask)) ** 2)
+    fac = 1. / np.sqrt(np.prod(libalm.lsides))
+    ells = libalm.reduced_ellmat()
+
+    if _type == 'T':
+        kernels = [None]
+    else:
+        c, s = libalm.get_cossin_2iphi()
+        kernels = [None, c ** 2 - s ** 2, 2 * c * s]  # w, w cos 4phi, w sin 4phi
+
+    nbatch = max(1, maxbytes // (8 * 3 * int(np.prod(libalm.shape))))
+    Ms = [[None] * nspec for _ in range(nspec)]
+    for jA in range(nspec):
+        tb = np.zeros((tbins[jA].shape[0], libalm.ellmax + 1), dtype=float)
+        tb[:, :lmax + 1] = tbins[jA]
+        R = {}
+        for i0 in range(0, tb.shape[0], nbatch):
+            w = tb[i0:i0 + nbatch, ells]  # 2d mode weights of the Cl-side bins
+            for iK, K in enumerate(kernels):
+                maps = libalm.alms2maps(w if K is None else w * K)
+                maps *= Bx
+                F = libalm.maps2alms(maps)
+                del maps
+                if K is None:
+                    R.setdefault((iK, 0), []).append(libalm.bin_realparts_inell(F, ellmax=lmax))
+                else:
+                    for iK2, K2 in enumerate(kernels[1:]):
+                        R.setdefault((iK, iK2 + 1), []).append(libalm.bin_realparts_inell(F * K2, ellmax=lmax))
+                del F
+        R = {k: np.concatenate(v).T for k, v in R.items()}  # (lmax + 1, ntbins)
+        if _type == 'T':
+            Ms[0][0] = np.dot(pbins[0], R[(0, 0)])
+            continue
+        R1 = R[(0, 0)]
+        Rcc = R[(1, 1)] + R[(2, 2)]  # C F_C + S F_S
+        Rcs = R[(2, 1)] - R[(1, 2)]  # C F_S - S F_C
+        if jA == 0:  # EE column
+            cols = [0.5 * (R1 + Rcc), 0.5 * (R1 - Rcc), 0.5 * Rcs]
+        elif jA == 1:  # BB column
+            cols = [0.5 * (R1 - Rcc), 0.5 * (R1 + Rcc), -0.5 * Rcs]
+        else:  # EB column
+            cols = [-Rcs, Rcs, Rcc]
+        for iA in range(nspec):
+            Ms[iA][jA] = np.dot(pbins[iA], cols[iA])
+    return np.block(Ms) * fac
+
+
 def _EBcls2QUPmatij(lib_alm, TEBcls, i, j, c=None, s=None):
     """
     Turns E,B spectra into Q,U spectral matrices according to
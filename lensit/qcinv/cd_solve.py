@@ -33,7 +33,121 @@ class cache_mem(dict):
             del self[key]
 
 
-def cd_solve(x, b, fwd_op, pre_ops, dot_op, criterion, tr, cache=cache_mem(), roundoff=25):
+class deflation_space(object):
+    """Krylov subspace recycled between successive solves with slowly varying forward operations.
+
+        At the end of each solve the harmonic Ritz vectors of the forward operation with smallest harmonic Ritz
+        values are extracted from the span of the current basis and of the first *ncollect* search directions.
+        On the next solve this basis W deflates the initial residual, x += W (W^t A W)^{-1} W^t r,
+        and augments the preconditioner M as P^t M P + W E^{-1} W^t, with E = W^t A W and P = 1 - A W E^{-1} W^t
+        (balancing preconditioner, symmetric positive definite even if A W is not exact).
+
+        Keeps 2 (nvecs + ncollect) vectors in memory.
+
+        Args:
+            nvecs: number of deflation vectors kept between solves
+            ncollect: number of search directions of each solve entering the harmonic Ritz extraction
+            refresh: if set, A W is recalculated with each new forward operation (nvecs forward operations).
+                     Otherwise A W from the previous solve is used in the preconditioner, which costs a single
+                     forward operation for the exact initial residual deflation.
+
+    """
+
+    def __init__(self, nvecs=8, ncollect=24, refresh=False):
+        assert nvecs <= ncollect, (nvecs, ncollect)
+        self.nvecs = nvecs
+        self.ncollect = ncollect
+        self.refresh = refresh
+        self.W = []
+        self.AW = []
+        self.Einv = None
+        self._Z = []
+        self._AZ = []
+
+    def __len__(self):
+        return len(self.W)
+
+    def reset(self):
+        self.__init__(nvecs=self.nvecs, ncollect=self.ncollect, refresh=self.refresh)
+
+    def prepare(self, fwd_op, dot_op):
+        """Prepares the deflation space for a new solve with forward operation fwd_op.
+
+        """
+        self._Z, self._AZ = [], []
+        self._fwd_op = fwd_op
+        if len(self.W) == 0: return
+        if self.refresh: self.AW = [fwd_op(w) for w in self.W]
+        E = np.array([[dot_op(w, aw) for aw in self.AW] for w in self.W])
+        self.Einv = np.linalg.inv(0.5 * (E + E.T))
+
+    @staticmethod
+    def _lincomb(vecs, coeffs):
+        ret = np.zeros_like(vecs[0])
+        for vec, c in zip(vecs, coeffs):
+            ret += vec * c
+        return ret
+
+    def _coarse(self, vecs, residual, dot_op):
+        return self._lincomb(self.W, np.dot(self.Einv, [dot_op(v, residual) for v in vecs]))
+
+    def deflate(self, x, residual, dot_op):
+        """Galerkin correction of x and residual on the deflation space (in place), so that W^t r = 0.
+
+        """
+        if len(self.W) == 0: return
+        if self.refresh:
+            coeffs = np.dot(self.Einv, [dot_op(w, residual) for w in self.W])
+            for w, aw, c in zip(self.W, self.AW, coeffs):
+                x += w * c
+                residual -= aw * c
+        else:
+            dx = self._coarse(self.W, residual, dot_op)
+            x += dx
+            residual -= self._fwd_op(dx)
+
+    def wrap(self, pre_op, dot_op):
+        """Preconditioner augmented with the deflation space.
+
+        """
+        if len(self.W) == 0: return pre_op
+
+        def _pre_op(residual):
+            c = np.dot(self.Einv, [dot_op(w, residual) for w in self.W])
+            ret = pre_op(residual - self._lincomb(self.AW, c))
+            return ret - self._coarse(self.AW, ret, dot_op) + self._lincomb(self.W, c)
+        return _pre_op
+
+    def collect(self, searchdirs, searchfwds):
+        for searchdir, searchfwd in zip(searchdirs, searchfwds):
+            if len(self._Z) < self.ncollect:
+                self._Z.append(searchdir)
+                self._AZ.append(searchfwd)
+
+    def update(self, dot_op):
+        """Harmonic Ritz extraction of the new basis from the span of W and of the collected search directions.
+
+            Solves (AZ)^t (AZ) y = theta Z^t A Z y, after A-orthonormalization of Z, and keeps the nvecs
+            vectors Z y with smallest theta.
+
+        """
+        Z, AZ = self.W + self._Z, self.AW + self._AZ
+        self._Z, self._AZ = [], []
+        if len(Z) == 0: return
+        F = np.array([[dot_op(z, az) for az in AZ] for z in Z])
+        G = np.array([[dot_op(az1, az2) for az2 in AZ] for az1 in AZ])
+        s, U = np.linalg.eigh(0.5 * (F + F.T))
+        ii = np.where(s > 1e-10 * np.max(s))[0]
+        T = U[:, ii] / np.sqrt(s[ii])
+        theta, V = np.linalg.eigh(np.dot(T.T, np.dot(0.5 * (G + G.T), T)))
+        Y = np.dot(T, V[:, :min(self.nvecs, len(ii))])
+        self.W = [self._lincomb(Z, Yi) for Yi in Y.T]
+        self.AW = [self._lincomb(AZ, Yi) for Yi in Y.T]
+        self.Einv = None
+
+
+def cd_solve(x, b, fwd_op, pre_ops, dot_op, criterion, tr, cache=cache_mem(), roundoff=25, fwd_op_roundoff=None,
+             deflation=None):
     # customizable conjugate directions loop for x=[fwd_op]^{-1}b
     # initial value of x is taken as guess
     # fwd_op, pre_op(s) and dot_op must not modify their arguments!
@@ -44,10 +158,22 @@ def cd_solve(x, b, fwd_op, pre_ops, dot_op, criterion, tr, cache=cache_mem(), ro
     #           nb: must be monotonically increasing.
     #              
     # cache   = cacher for search objects.
+    #
+    # fwd_op_roundoff = forward operation used for the residual refresh every roundoff iterations
+    #                   (defaults to fwd_op). With a reduced precision fwd_op, a full precision
+    #                   refresh here keeps the residual from drifting.
+    #
+    # deflation = deflation_space instance recycled across solves (optional). The residual is deflated and the
+    #             preconditioner(s) augmented with the current basis, which is updated at the end of the solve.
 
     n_pre_ops = len(pre_ops)
+    if fwd_op_roundoff is None: fwd_op_roundoff = fwd_op
 
-    residual = b - fwd_op(x)
+    residual = b - fwd_op_roundoff(x)
+    if deflation is not None:
+        deflation.prepare(fwd_op_roundoff, dot_op)
+        deflation.deflate(x, residual, dot_op)
+        pre_ops = [deflation.wrap(pre_op, dot_op) for pre_op in pre_ops]
 
     searchdirs = [op(residual) for op in pre_ops]
 
@@ -70,11 +196,12 @@ def cd_solve(x, b, fwd_op, pre_ops, dot_op, criterion, tr, cache=cache_mem(), ro
 
         # append to cache.
         cache.store(iter, [dTAd_inv, searchdirs, searchfwds])
+        if deflation is not None: deflation.collect(searchdirs, searchfwds)
 
         # update residual
         iter += 1
         if (np.mod(iter, roundoff) == 0):
-            residual = b - fwd_op(x)
+            residual = b - fwd_op_roundoff(x)
         else:
             for (searchfwd, alpha) in zip(searchfwds, alphas):
                 residual -= searchfwd * alpha
@@ -98,4 +225,5 @@ def cd_solve(x, b, fwd_op, pre_ops, dot_op, criterion, tr, cache=cache_mem(), ro
         # clear old keys from cache
         cache.trim(range(tr(iter + 1), iter))
 
+    if deflation is not None: deflation.update(dot_op)
     return iter
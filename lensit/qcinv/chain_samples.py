@@ -17,12 +17,12 @@ def get_defaultmgchain(lmax_sky, lsides, datshape, tol=1e-5, iter_max=np.inf, de
             lmax_dense = int(np.round(min(lmax_dense, 1300)))
         print("chain_samples : setting lmax_dense to ", lmax_dense)
         chain_descr = [
-            [3, ["split(dense(" + dense_file + "), %s, diag_cl)" % (int(lmax_dense))], 1400, nside_max / 4, 3, 0.,
+            [3, ["split(dense(" + dense_file + "), %s, diag_cl)" % (int(lmax_dense))], 1400, nside_max // 4, 3, 0.,
              cd_solve.tr_cg,
              cd_solve.cache_mem()],
-            [2, ["split(stage(3), %s, diag_cl)" % 1400], 3000, nside_max / 2, 3, 0., cd_solve.tr_cg,
+            [2, ["split(stage(3), %s, diag_cl)" % 1400], 3000, nside_max // 2, 3, 0., cd_solve.tr_cg,
              cd_solve.cache_mem()],
-            [1, ["split(stage(2), %s, diag_cl)" % 3000], 4000, nside_max / 2, 3, 0., cd_solve.tr_cg,
+            [1, ["split(stage(2), %s, diag_cl)" % 3000], 4000, nside_max // 2, 3, 0., cd_solve.tr_cg,
              cd_solve.cache_mem()],
             [0, ["split(stage(1), %s, diag_cl)" % 4000], lmax_sky, nside_max, iter_max, tol, cd_solve.tr_cg,
              cd_solve.cache_mem()]]
@@ -32,14 +32,14 @@ def get_defaultmgchain(lmax_sky, lsides, datshape, tol=1e-5, iter_max=np.inf, de
         lmax_dense = int(np.round(min(lmax_dense, 1300)))
         print("chain_samples : setting lmax_dense to " + str(lmax_dense))
         chain_descr = [
-            [2, ["split(dense(" + dense_file + "), %s, diag_cl)" % (int(lmax_dense))], 1400, nside_max / 4, 3, 0.,
+            [2, ["split(dense(" + dense_file + "), %s, diag_cl)" % (int(lmax_dense))], 1400, nside_max // 4, 3, 0.,
              cd_solve.tr_cg, cd_solve.cache_mem()],
-            [1, ["split(stage(2), %s, diag_cl)" % 1400], 3000, nside_max / 2, 3, 0., cd_solve.tr_cg,
+            [1, ["split(stage(2), %s, diag_cl)" % 1400], 3000, nside_max // 2, 3, 0., cd_solve.tr_cg,
              cd_solve.cache_mem()],
-            [0, ["split(stage(1), %s, diag_cl)" % 3000], lmax_sky, nside_max / 2, iter_max, tol, cd_solve.tr_cg,
+            [0, ["split(stage(1), %s, diag_cl)" % 3000], lmax_sky, nside_max // 2, iter_max, tol, cd_solve.tr_cg,
              cd_solve.cache_mem()]]
     else:
-        res = lambda fac: max(10, nside_max / fac)
+        res = lambda fac: max(10, nside_max // fac)
         chain_descr = [
             [3, ["split(dense(" + dense_file + "), %s, diag_cl)" % 64], 256, res(16), 3, 0., cd_solve.tr_cg,
              cd_solve.cache_mem()],
@@ -16,7 +16,7 @@ class pre_op_dense:
 
         if cache_fname is not None and os.path.exists(cache_fname):
             assert cache_fname[-3:] == '.pk'
-            [cache_lmax, cache_hashdict] = pk.load(open(cache_fname, 'r'))
+            [cache_lmax, cache_hashdict] = pk.load(open(cache_fname, 'rb'))
             self.minv = np.load(cache_fname[:-3] + '.npy')
 
             if (lmax != cache_lmax) or (self.hashdict() != cache_hashdict):
@@ -70,7 +70,7 @@ class pre_op_dense:
             #self.minv = np.linalg.inv(tmat)
         if cache_fname is not None:
             assert cache_fname[-3:] == '.pk'
-            pk.dump([self.cov.lib_skyalm.ellmax, self.hashdict()], open(cache_fname, 'w'))
+            pk.dump([self.cov.lib_skyalm.ellmax, self.hashdict()], open(cache_fname, 'wb'))
             np.save(cache_fname[:-3] + '.npy', self.minv)
 
     def hashdict(self):
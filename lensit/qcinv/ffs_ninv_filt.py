@@ -9,6 +9,8 @@ from lensit.misc.rfft2_utils import degrade_mask
 
 load_map = lambda _map: np.load(_map) if type(_map) is str else _map
 
+_allow_harmonic = True  # Applies homogeneous noise without templates as harmonic-space products
+
 
 def cl_inv(cl):
     ret = np.zeros_like(cl)
@@ -17,13 +19,18 @@ def cl_inv(cl):
 
 class ffs_ninv_filt(object):
     def __init__(self, lib_datalm, lib_skyalm, len_cls, cl_transf, ninv_rad,
-                 marge_maps=None, marge_uptolmin=None,marge_ells = None,eigv_thres = 0., cls_noise=None, verbose=False):
+                 marge_maps=None, marge_uptolmin=None,marge_ells = None,eigv_thres = 0., cls_noise=None, verbose=False,
+                 precision='double'):
         """
         ninv_rad is the inverse variance map in 1 / rad ** 2, not the pixel variance maps.
         This is the inverse pixel variance map / volume of cell.
 
         eigenvalues in the template matrix with eigv <= max(eigv) * eigv_thres will be set to zero before inversion
+
+        precision ('double' or 'single') sets the floating point precision of apply_alms, the operation
+        entering the conjugate gradient forward operation. Its output is always double precision.
         """
+        assert precision in ['double', 'single'], precision
         if marge_maps is None : marge_maps = dict()
         if marge_uptolmin is None : marge_uptolmin = dict()
         if marge_ells is None : marge_ells = dict()
@@ -76,23 +83,25 @@ class ffs_ninv_filt(object):
             templs = templates[key]
             if len(templs) > 0:
                 nmodes = int(np.sum([t.nmodes for t in templs]))
-                modes_idx_t = np.concatenate(([t.nmodes * [int(im)] for im, t in enumerate(templs)]))
-                modes_idx_i = np.concatenate(([range(0, t.nmodes) for t in templs]))
                 print("   Building %s - %s template projection matrix" % (nmodes, nmodes))
-                Pt_Nn1_P = np.zeros((nmodes, nmodes))
-                for ir in range(0, nmodes):
-                    if np.mod(ir, int(0.1 * nmodes)) == 0: print("   filling TNiT: %4.1f" % (100. * ir / nmodes)), "%"
-                    tmap = np.copy(ninv_rad[key])
-                    templs[modes_idx_t[ir]].apply_mode(tmap, int(modes_idx_i[ir]))
-                    ic = 0
-                    for tc in templs[0:modes_idx_t[ir] + 1]:
-                        Pt_Nn1_P[ir, ic:(ic + tc.nmodes)] = tc.dot(tmap)
-                        Pt_Nn1_P[ic:(ic + tc.nmodes), ir] = Pt_Nn1_P[ir, ic:(ic + tc.nmodes)]
-                        ic += tc.nmodes
-                eigv, eigw = np.linalg.eigh(Pt_Nn1_P)
-                eigv_inv = np.where(eigv <= np.max(eigv) * eigv_thres,np.zeros_like(eigv),1.0 / eigv)
-                if eigv_thres > 0: print("Kept %.2f percent of the modes"%( (100. * len(eigv_inv.nonzero())) / len(eigv)))
-                self.Pt_Nn1_P_inv[key] = np.dot(np.dot(eigw, np.diag(eigv_inv)), np.transpose(eigw))
+                Pt_Nn1_P, cho = template_removal.get_TtNiT_cho(templs, ninv_rad[key])
+                if cho is not None and eigv_thres <= 0.:  # P^t Ni P = L L^t
+                    from scipy.linalg import solve_triangular
+                    icho = solve_triangular(cho, np.eye(nmodes), lower=True)
+                    self.Pt_Nn1_P_inv[key] = np.dot(icho.T, icho)
+                else:
+                    eigv, eigw = np.linalg.eigh(Pt_Nn1_P)
+                    eigv_inv = np.where(eigv <= np.max(eigv) * eigv_thres,np.zeros_like(eigv),1.0 / eigv)
+                    if eigv_thres > 0: print("Kept %.2f percent of the modes"%( (100. * len(eigv_inv.nonzero())) / len(eigv)))
+                    self.Pt_Nn1_P_inv[key] = np.dot(np.dot(eigw, np.diag(eigv_inv)), np.transpose(eigw))
+        # Homogeneous noise with nothing to marginalise over is diagonal in harmonic space:
+        self._ninv_harmonic = {}
+        for key in ninv_rad.keys():
+            ni = ninv_rad[key].flat[0]
+            if _allow_harmonic and len(templates[key]) == 0 and ni > 0. and np.all(ninv_rad[key] == ni):
+                self._ninv_harmonic[key] = float(ni)
+        self._ninv_rad32 = {}
+        self.precision = precision
         self.templates = templates
         self.marge_uptolmin = marge_uptolmin
         self.cls_noise = cls_noise
@@ -100,9 +109,32 @@ class ffs_ninv_filt(object):
 
     def hashdict(self):
         #FIXME:
-        return {'transf':cls_hash({'transf':self.cl_transf}, astype=np.float32),'cls':cls_hash(self.cls, astype=np.float32),
+        ret = {'transf':cls_hash({'transf':self.cl_transf}, astype=np.float32),'cls':cls_hash(self.cls, astype=np.float32),
                 'ninv':{k:npy_hash(self.ninv_rad[k], astype=np.float32) for k in self.ninv_rad.keys()},
                 'marge_lmin':self.marge_uptolmin,'lib_datalm':self.lib_datalm.hashdict(),'lib_skyalm':self.lib_skyalm.hashdict()}
+        if self.precision != 'double':  # leaves the hash of double precision filters unchanged
+            ret['precision'] = self.precision
+        return ret
+
+    def get_ninv_path(self, field):
+        """Returns 'harmonic' if the inverse noise of this field is applied as harmonic-space product, else 'pixel'.
+
+        """
+        return 'harmonic' if field.lower() in self._ninv_harmonic else 'pixel'
+
+    def _get_ninv_rad(self, field, dtype=np.float64):
+        if dtype != np.float32:
+            return self.ninv_rad[field]
+        if field not in self._ninv_rad32:
+            self._ninv_rad32[field] = self.ninv_rad[field].astype(np.float32)
+        return self._ninv_rad32[field]
+
+    def _apply_alm_harmonic(self, field, alm):
+        """
+        Applies B^t Ni B to T, Q or U lms for homogeneous noise and no templates.
+        """
+        alm = self.lib_datalm.project_real(self._deg(self.lib_skyalm.almxfl(alm, self.cl_transf)))
+        return self.lib_skyalm.almxfl(self._upg(alm * self._ninv_harmonic[field.lower()]), self.cl_transf)
 
     def Nlev_uKamin(self, field):
         return np.sqrt(np.mean(1. / self.ninv_rad[field.lower()][np.where(self.ninv_rad[field.lower()] > 0)])) \
@@ -185,6 +217,9 @@ class ffs_ninv_filt(object):
         assert field.lower() in ['t', 'q', 'u'], field
         assert alm.size == self.lib_skyalm.alm_size, (alm.size, self.lib_skyalm.alm_size)
         assert inplace
+        if inplace and field.lower() in self._ninv_harmonic:
+            alm[:] = self._apply_alm_harmonic(field, alm)
+            return
         if inplace:
             self.lib_skyalm.almxfl(alm, self.cl_transf, inplace=True)
             _map = self.lib_datalm.alm2map(self._deg(alm))
@@ -193,16 +228,27 @@ class ffs_ninv_filt(object):
             self.lib_skyalm.almxfl(alm, self.cl_transf, inplace=True)
             return
 
-    def apply_alms(self,TQUtype, TEBalms, inplace=True):
+    def apply_alms(self,TQUtype, TEBalms, inplace=True, precision=None):
         """
         Applies B^t Ni B. (TEB skyalms to TEB skyalms)
+
+        The operation is performed in the instance precision, unless specified otherwise.
         """
         assert TQUtype in ['T','QU','TQU']
+        if (precision or self.precision) == 'single':
+            _TEBalms = TEBalms.astype(np.complex64)
+        else:
+            _TEBalms = TEBalms
+        if np.all([f.lower() in self._ninv_harmonic for f in TQUtype]):
+            TQUlms = ffs_specmat.TEB2TQUlms(TQUtype, self.lib_skyalm, _TEBalms)
+            TQUlms = np.array([self._apply_alm_harmonic(f, alm) for f, alm in zip(TQUtype, TQUlms)])
+            ret = ffs_specmat.TQU2TEBlms(TQUtype, self.lib_skyalm, TQUlms)
+        else:
+            ret = self.apply_Rts(TQUtype,self.apply_maps(TQUtype,self.apply_Rs(TQUtype,_TEBalms),inplace=False))
         if inplace:
-            TEBalms[:] = self.apply_Rts(TQUtype,self.apply_maps(TQUtype,self.apply_Rs(TQUtype,TEBalms),inplace=False))
+            TEBalms[:] = ret
             return
-        else:
-            return self.apply_Rts(TQUtype,self.apply_maps(TQUtype,self.apply_Rs(TQUtype,TEBalms),inplace=False))
+        return ret.astype(complex, copy=False)
 
     def apply_map(self, field, _map, inplace=True):
         """
@@ -246,7 +292,7 @@ class ffs_ninv_filt(object):
         assert TQUtype in ['T','QU','TQU']
         if inplace:
             for i, f in enumerate(TQUtype.lower()):
-                _maps[i] *= self.ninv_rad[f]
+                _maps[i] *= self._get_ninv_rad(f, dtype=_maps.dtype)
                 if len(self.templates[f]) > 0:
                     coeffs = np.concatenate(([t.dot(_maps[i]) for t in self.templates[f]]))
                     coeffs = np.dot(self.Pt_Nn1_P_inv[f], coeffs)
@@ -261,7 +307,7 @@ class ffs_ninv_filt(object):
         else:
             nmaps = np.zeros_like(_maps)
             for i, f in enumerate(TQUtype.lower()):
-                nmaps[i] = _maps[i] * self.ninv_rad[f]
+                nmaps[i] = _maps[i] * self._get_ninv_rad(f, dtype=_maps.dtype)
                 if len(self.templates[f]) > 0:
                     coeffs = np.concatenate(([t.dot(nmaps[i]) for t in self.templates[f]]))
                     coeffs = np.dot(self.Pt_Nn1_P_inv[f], coeffs)
@@ -284,12 +330,12 @@ class ffs_ninv_filt(object):
         for key in self.ninv_rad.keys():
             ninvLD[key] = degrade_mask(self.ninv_rad[key], shape)
         return ffs_ninv_filt(lib_almdat, lib_almsky, self.cls, self.cl_transf, ninvLD,
-                             marge_uptolmin=self.marge_uptolmin, cls_noise=self.cls_noise)
+                             marge_uptolmin=self.marge_uptolmin, cls_noise=self.cls_noise, precision=self.precision)
 
     def turn2wlfilt(self, f, fi):
         return ffs_ninv_filt_wl(self.lib_datalm, self.lib_skyalm, self.cls, self.cl_transf, self.ninv_rad, f, fi,
                                 marge_maps=self.marge_maps, marge_uptolmin=self.marge_uptolmin,
-                                cls_noise=self.cls_noise)
+                                cls_noise=self.cls_noise, precision=self.precision)
 
     def turn2isofilt(self):
         """Returns an isotropic (no mask, homog. noise) filter built from the average noise levels.
@@ -299,18 +345,19 @@ class ffs_ninv_filt(object):
         for key in self.ninv_rad.keys():
             ninv_rad[key] = np.ones(self.lib_datalm.shape, dtype=float) * (1. / (self.Nlev_uKamin(key) / 60 / 180. * np.pi) ** 2)
         return ffs_ninv_filt(self.lib_datalm, self.lib_skyalm, self.cls, self.cl_transf, ninv_rad,
-                             marge_maps=self.marge_maps, marge_uptolmin=self.marge_uptolmin)
+                             marge_maps=self.marge_maps, marge_uptolmin=self.marge_uptolmin, precision=self.precision)
 
 
 class ffs_ninv_filt_wl(ffs_ninv_filt):
     def __init__(self, lib_datalm, lib_skyalm, unl_cls, cl_transf, ninv_rad, f, fi,
-                 marge_maps=None, marge_uptolmin=None, cls_noise=None, lens_pool=0):
+                 marge_maps=None, marge_uptolmin=None, cls_noise=None, lens_pool=0, precision='double'):
         """
         Same as above, but the transfer functions contain the lensing.
         Note that the degradation will kill the lensing.
         """
         super(ffs_ninv_filt_wl, self).__init__(lib_datalm, lib_skyalm, unl_cls, cl_transf, ninv_rad,
-                                    marge_maps=marge_maps, marge_uptolmin=marge_uptolmin, cls_noise=cls_noise)
+                                    marge_maps=marge_maps, marge_uptolmin=marge_uptolmin, cls_noise=cls_noise,
+                                    precision=precision)
         # Forward and inverse displacement instances :
         assert self.lib_skyalm.shape == f.shape and self.lib_skyalm.lsides == f.lsides
         assert self.lib_skyalm.shape == fi.shape and self.lib_skyalm.lsides == fi.lsides
@@ -344,6 +391,14 @@ class ffs_ninv_filt_wl(ffs_ninv_filt):
         skyalm = self.lib_skyalm.almxfl(self._upg(self.lib_datalm.map2alm(_map)), self.cl_transf)
         return self.fi.lens_alm(self.lib_skyalm, skyalm, use_Pool=self.lens_pool, mult_magn=True)
 
+    def _apply_alm_harmonic(self, field, alm):
+        """
+        Applies D^t B^t Ni B D to T, Q or U lms for homogeneous noise and no templates.
+        """
+        _alm = self.f.lens_alm(self.lib_skyalm, alm, use_Pool=self.lens_pool)
+        _alm = super(ffs_ninv_filt_wl, self)._apply_alm_harmonic(field, _alm)
+        return self.fi.lens_alm(self.lib_skyalm, _alm, use_Pool=self.lens_pool, mult_magn=True)
+
     def apply_alm(self, field, alm, inplace=True):
         """
         Applies D^t B^T Ni B D to T, Q or U lms.
@@ -351,6 +406,9 @@ class ffs_ninv_filt_wl(ffs_ninv_filt):
         assert field.lower() in ['t', 'q', 'u'], field
         assert alm.size == self.lib_skyalm.alm_size, (alm.size, self.lib_skyalm.alm_size)
         assert inplace
+        if inplace and field.lower() in self._ninv_harmonic:
+            alm[:] = self._apply_alm_harmonic(field, alm)
+            return
         if inplace:
             alm[:] = self.f.lens_alm(self.lib_skyalm, alm, use_Pool=self.lens_pool)
             self.lib_skyalm.almxfl(alm, self.cl_transf, inplace=True)
@@ -370,9 +428,10 @@ class ffs_ninv_filt_wl(ffs_ninv_filt):
         print("DEGRADING WITH NO MARGE MAPS")
         if no_lensing:
             return ffs_ninv_filt(lib_almdat, lib_almsky, self.cls, self.cl_transf, ninvLD,
-                                 marge_uptolmin=self.marge_uptolmin, cls_noise=self.cls_noise)
+                                 marge_uptolmin=self.marge_uptolmin, cls_noise=self.cls_noise, precision=self.precision)
         else:
             fLD = self.f.degrade(shape, no_lensing)
             fiLD = self.fi.degrade(shape, no_lensing)
             return ffs_ninv_filt_wl(lib_almdat, lib_almsky, self.cls, self.cl_transf, ninvLD, fLD, fiLD,
-                                    marge_uptolmin=self.marge_uptolmin, cls_noise=self.cls_noise)
\ No newline at end of file
+                                    marge_uptolmin=self.marge_uptolmin, cls_noise=self.cls_noise,
+                                    precision=self.precision)
\ No newline at end of file
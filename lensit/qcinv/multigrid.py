@@ -4,6 +4,8 @@ import sys, re, copy
 import numpy as np
 import time
 from lensit.qcinv import cd_solve, cd_monitors
+from lensit.misc.misc_utils import dict_hash
+from lensit.misc.profiler import profiled
 
 
 # ===
@@ -63,7 +65,9 @@ class multigrid_chain:
         self.cov = cov
         self._type = _type
         self.no_deglensing = no_deglensing
+        self.degraded_covs = []  # filters of the coarse levels, registered by parse_pre_op_descr
 
+        t0 = time.time()
         stages = {}
         for [id, pre_ops_descr, lmax, nside, iter_max, eps_min, tr, cache] in self.chain_descr:
             stages[id] = multigrid_stage(id, pre_ops_descr, lmax, nside, iter_max, eps_min, tr, cache)
@@ -75,8 +79,25 @@ class multigrid_chain:
         # TODO   maps. It might be useful to be more clever, e.g. doing at least the dense part with lensing but switching it then
         # TODO   off, or using a crude lensing method.
         self.bstage = stages[0]  # these are the pre_ops called in cd_solve
+        self.setup_time = time.time() - t0
 
-    def solve(self, soltn, alms, finiop=None, d0=None, no_calc_prep=False, logger=None):
+    def set_ffi(self, f, fi):
+        """Updates the displacement of the chain filter and of its lensed coarse levels.
+
+            The isotropic levels and the dense preconditioners are kept as they are.
+
+        """
+        self.cov.set_ffi(f, fi)
+        fLDs = {}
+        for cov in self.degraded_covs:
+            if hasattr(cov, 'set_ffi'):
+                shape = cov.lib_skyalm.shape
+                if shape not in fLDs:
+                    fLDs[shape] = (f.degrade(shape, False), fi.degrade(shape, False))
+                cov.set_ffi(*fLDs[shape])
+
+    @profiled('cg')
+    def solve(self, soltn, alms, finiop=None, d0=None, no_calc_prep=False, logger=None, deflation=None):
         self.watch = stopwatch()
 
         self.iter_tot = 0
@@ -98,8 +119,12 @@ class multigrid_chain:
         if d0 is None: d0 = crit_op(_b, _b)
         monitor = cd_monitors.monitor_basic(crit_op, logger=logger, iter_max=self.bstage.iter_max,
                                             eps_min=self.bstage.eps_min, d0=d0)
+        fwd_op_roundoff = None
+        if getattr(self.cov, 'precision', 'double') != 'double':  # residual refreshed in double precision
+            fwd_op_roundoff = lambda _soltn: fwd_op(_soltn, precision='double')
         cd_solve.cd_solve(soltn, _b, fwd_op, self.bstage.pre_ops, self.opfilt.dot_op(self.cov.lib_skyalm), monitor,
-                          tr=self.bstage.tr, cache=self.bstage.cache)
+                          tr=self.bstage.tr, cache=self.bstage.cache, fwd_op_roundoff=fwd_op_roundoff,
+                          deflation=deflation)
         if finiop is None:
             return
         else:
@@ -202,8 +227,43 @@ class multigrid_chain:
 
 
 
+def get_chain(chains, opfilt, _type, chain_descr, cov, no_deglensing=False):
+    """Returns a multigrid chain for this filter and chain description, reusing the one in *chains* if present.
+
+        Chains are cached in the dictionary *chains* per (filter hash, chain description). A reused chain only gets
+        the displacement of *cov* passed on to its lensed levels. (Filters with a displacement but without
+        set_ffi method are not cached.)
+
+    """
+    t0 = time.time()
+    key = (opfilt.__name__, _type, no_deglensing, dict_hash(cov.hashdict()),
+           tuple((c[0], tuple(c[1]), c[2], c[3], c[4], c[5], id(c[6]), id(c[7])) for c in chain_descr))
+    if hasattr(cov, 'f') and not hasattr(cov, 'set_ffi'):
+        chains.pop(key, None)
+    if key not in chains:
+        chains[key] = multigrid_chain(opfilt, _type, chain_descr, cov, no_deglensing=no_deglensing)
+        print('**** multigrid : chain setup in %.2f s' % chains[key].setup_time)
+    else:
+        chains[key].cov = cov
+        if hasattr(cov, 'f'):
+            chains[key].set_ffi(cov.f, cov.fi)
+        print('**** multigrid : reusing chain, setup in %.2f s instead of %.2f s' % (time.time() - t0, chains[key].setup_time))
+    chains[key].last_setup_time = time.time() - t0
+    return chains[key]
+
+
 # ===
 
+def _degrade(kwargs, no_lensing):
+    """Degraded filter of a coarse level, registered to the chain for later displacement updates.
+
+    """
+    cov = kwargs['cov'].degrade((kwargs['nside'], kwargs['nside']), no_lensing=no_lensing, ellmin=kwargs['lmin'],
+                                ellmax=kwargs['lmax'], libtodegrade=kwargs['libtosplit'])
+    kwargs['chain'].degraded_covs.append(cov)
+    return cov
+
+
 def parse_pre_op_descr(pre_op_descr, **kwargs):
     if re.match("split\((.*),\s*(.*),\s*(.*)\)\Z", pre_op_descr):
         (low_descr, lsplit, hgh_descr) = re.match("split\((.*),\s*(.*),\s*(.*)\)\Z", pre_op_descr).groups()
@@ -226,24 +286,15 @@ def parse_pre_op_descr(pre_op_descr, **kwargs):
         pre_op_hgh = parse_pre_op_descr(hgh_descr, **kwargs_hgh)
         # return pre_op_split(kwargs['cov'], pre_op_low, pre_op_hgh)
         split = pre_op_split_sky  # if kwargs['libtosplit'] == 'sky' else pre_op_split
-        return split(kwargs['cov'].degrade(_shape, no_lensing=kwargs['no_lensing'], ellmax=lmax, ellmin=lmin,
-                                           libtodegrade=kwargs['libtosplit']), pre_op_low, pre_op_hgh)
+        return split(_degrade(kwargs, kwargs['no_lensing']), pre_op_low, pre_op_hgh)
         # return pre_op_split(kwargs['cov'].degrade(_shape, kwargs['no_lensing'], ellmax=lmax), pre_op_low,pre_op_hgh)
 
     elif re.match("diag_cl\Z", pre_op_descr):
-        lmax = kwargs['lmax']
-        lmin = kwargs['lmin']
-        _shape = (kwargs['nside'], kwargs['nside'])
-        cov = kwargs['cov'].degrade(_shape, no_lensing=True, ellmin=lmin, ellmax=lmax,
-                                    libtodegrade=kwargs['libtosplit'])
+        cov = _degrade(kwargs, True)
         return kwargs['opfilt'].pre_op_diag(cov, kwargs['no_lensing'])
 
     elif re.match("pseuddiag_cl\Z", pre_op_descr):
-        lmax = kwargs['lmax']
-        lmin = kwargs['lmin']
-        _shape = (kwargs['nside'], kwargs['nside'])
-        cov = kwargs['cov'].degrade(_shape, no_lensing=True, ellmin=lmin, ellmax=lmax,
-                                    libtodegrade=kwargs['libtosplit'])
+        cov = _degrade(kwargs, True)
         return kwargs['opfilt'].pre_op_pseudiag(cov, kwargs['no_lensing'])
 
     elif re.match("dense\((.*)\)\Z", pre_op_descr):
@@ -255,9 +306,8 @@ def parse_pre_op_descr(pre_op_descr, **kwargs):
         _shape = (kwargs['nside'], kwargs['nside'])
 
         print('creating dense preconditioner. (nside = %d, lmax = %d, cache = %s)' % (kwargs['nside'], lmax, dense_cache_fname))
-        cov = kwargs['cov'].degrade(_shape, no_lensing=no_lensing, ellmin=lmin, ellmax=lmax,
-                                    libtodegrade=kwargs['libtosplit'])
-        print('DENSE CACHE FNAME' + dense_cache_fname)
+        cov = _degrade(kwargs, no_lensing)
+        print('DENSE CACHE FNAME %s' % dense_cache_fname)
         return kwargs['opfilt'].pre_op_dense(cov, no_lensing, cache_fname=dense_cache_fname)
 
     elif re.match("stage\(.*\)\Z", pre_op_descr):
@@ -269,9 +319,7 @@ def parse_pre_op_descr(pre_op_descr, **kwargs):
         lmax = kwargs['lmax']
         lmin = kwargs['lmin']
         no_lensing = kwargs['no_lensing']
-        _shape = (kwargs['nside'], kwargs['nside'])
-        cov = kwargs['cov'].degrade(_shape, no_lensing=no_lensing, ellmin=lmin, ellmax=lmax,
-                                    libtodegrade=kwargs['libtosplit'])
+        cov = _degrade(kwargs, no_lensing)
         assert (stage.lmax == kwargs['lmax'])
 
         return pre_op_multigrid(kwargs['opfilt'], stage.nside,
@@ -88,11 +88,29 @@ class dot_op:
     def __init__(self, lib_skyalm):
         self.lib_skyalm = lib_skyalm
         self.Nell = lib_skyalm.get_Nell()
+        self._weights = None
+
+    def get_weights(self):
+        """Real alm array w such that sum(w * Re(alm1 alm2^*)) = sum(alm2cl(alm1, alm2) * Nell)
+
+        """
+        if self._weights is None:
+            lib = self.lib_skyalm
+            counts = lib._get_ell_counts()[:lib.ellmax + 1]
+            wl = np.zeros(lib.ell_mat.ellmax + 1, dtype=float)
+            ii = np.where(counts > 0)[0]
+            wl[ii] = self.Nell[ii] / counts[ii]
+            w = np.zeros(lib.ell_mat.rshape, dtype=float)
+            w[:, 1:lib.ell_mat.rshape[1] - 1] = 1.
+            w[0:lib.shape[0] // 2 + 1, [-1, 0]] = 1.
+            self._weights = lib.almmap2alm(w * wl[lib.ell_mat()])
+        return self._weights
 
     def __call__(self, alms1, alms2, **kwargs):
         ret = 0.
+        w = self.get_weights()
         for alm1, alm2 in zip(alms1, alms2):
-            ret += np.sum(self.lib_skyalm.alm2cl(alm1,alm2=alm2) * self.Nell)
+            ret += np.sum(w * (alm1.real * alm2.real + alm1.imag * alm2.imag))
         return ret
         #return np.sum(alms1.real * alms2.real + alms1.imag * alms2.imag)
 
@@ -101,8 +119,9 @@ class fwd_op:  # (P^-1 + R^t Ni R)^{-1} (skyalms)
         self.cov = cov
         self.lib_alm = self.cov.lib_skyalm
 
-    def __call__(self, TEBlms):
-        return filtTEBlms( SM.apply_pinvTEBmat(_type, self.lib_alm, self.cov.cls, TEBlms) +  self.cov.apply_alms(_type, TEBlms,inplace=False),self.cov)
+    def __call__(self, TEBlms, **kwargs):
+        # kwargs (e.g. precision) are passed to the filter apply_alms
+        return filtTEBlms( SM.apply_pinvTEBmat(_type, self.lib_alm, self.cov.cls, TEBlms) +  self.cov.apply_alms(_type, TEBlms,inplace=False, **kwargs),self.cov)
 
 
 # =====================
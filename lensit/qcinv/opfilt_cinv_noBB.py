@@ -79,7 +79,7 @@ class fwd_op():  # (P^-1 + B^t Ni B)^{-1} (skyalms)
         self.cov = cov
         self.lib_alm = self.cov.lib_skyalm
 
-    def __call__(self, TElms):
+    def __call__(self, TElms, **kwargs):
         # print "This is fwd_op w. no_lensing %s _type %s"%(self.no_lensing,_type)
         if _type == 'T':
             TEBlms = TElms.copy()
@@ -89,7 +89,7 @@ class fwd_op():  # (P^-1 + B^t Ni B)^{-1} (skyalms)
             TEBlms = np.array([TElms[0], TElms[1], np.zeros_like(TElms[0])])
         else:
             assert 0
-        self.cov.apply_alms(_type, TEBlms, inplace=True)
+        self.cov.apply_alms(_type, TEBlms, inplace=True, **kwargs)
         return filtTElms(SM.apply_pinvTEmat(_type, self.lib_alm, self.cov.cls, TElms)  + TEBlms[:TEBlen(_type)], self.cov)
 
 # =====================
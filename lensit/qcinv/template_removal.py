@@ -1,6 +1,9 @@
 import numpy as np
 from lensit.qcinv.utils import ffs_converter
+from lensit.misc.misc_utils import npy_hash, dict_hash
 
+_TtNiT_cache = {}  # T^t Ni T matrices and their Cholesky factors, keyed by noise map and template set hashes
+_TtNiT_cache_size = 8
 
 
 class template:
@@ -39,6 +42,12 @@ class template:
     def accum(self, map, coeffs):
         assert (0)
 
+    def apply_modes(self, maps, modes):
+        """maps -> maps[i] * T_i modes[i] for a stack of maps (inplace)"""
+        assert len(maps) == len(modes), (len(maps), len(modes))
+        for m, mode in zip(maps, modes):
+            self.apply_mode(m, int(mode))
+
     def dot(self, map):
         ret = []
 
@@ -49,15 +58,64 @@ class template:
 
         return ret
 
+    def dots(self, maps):
+        """T^t m for a stack of maps, (nmaps, nmodes) output"""
+        return np.array([self.dot(m) for m in maps]).reshape(len(maps), self.nmodes)
+
     def _build_TtNiT(self,Ni):
         """ return the nmodes x nmodes matrix T^t Ni T """
-        TtNiT = np.zeros((self.nmodes,self.nmodes),dtype = float)
-        for a in range(self.nmodes):
-            _Ni = np.copy(Ni)
-            self.apply_mode(_Ni,a)
-            TtNiT[:,a] = self.dot(_Ni)
-            TtNiT[a,:] = TtNiT[:,a]
-        return TtNiT
+        return build_TtNiT([self], Ni)
+
+
+def build_TtNiT(templates, Ni, maxbytes=2 ** 28):
+    """Returns the nmodes x nmodes matrix T^t Ni T for the concatenated modes of a list of templates.
+
+        Rows are built per blocks of modes: Ni T_a for all modes a of a block is formed as one stack of maps
+        (one batched inverse FFT for the harmonic templates), and projected on all templates at once.
+        As in the mode by mode construction, the entry (a, b) is the dot of template b with Ni T_a for b <= a,
+        mirrored to the upper triangle.
+
+    """
+    nmodes = int(np.sum([t.nmodes for t in templates]))
+    offsets = np.cumsum([0] + [t.nmodes for t in templates])
+    nbatch = max(1, maxbytes // (3 * Ni.nbytes))
+    C = np.zeros((nmodes, nmodes), dtype=float)
+    for it, t in enumerate(templates):
+        for i0 in range(0, t.nmodes, nbatch):
+            modes = np.arange(i0, min(i0 + nbatch, t.nmodes))
+            NiT = np.empty((len(modes),) + Ni.shape, dtype=float)
+            NiT[:] = Ni
+            t.apply_modes(NiT, modes)
+            for jt, tc in enumerate(templates[:it + 1]):
+                C[offsets[it] + modes, offsets[jt]:offsets[jt + 1]] = tc.dots(NiT)
+            del NiT
+    return np.tril(C) + np.tril(C, -1).T
+
+
+def get_TtNiT_cho(templates, Ni):
+    """Returns the matrix T^t Ni T and its lower Cholesky factor (None if not positive definite).
+
+        These are cached in memory, keyed by the hashes of the noise map and of the template set,
+        if all templates have a hashdict method.
+
+    """
+    try:
+        key = dict_hash({'Ni': npy_hash(Ni, astype=np.float64),
+                         'templates': {str(i): dict_hash(t.hashdict()) for i, t in enumerate(templates)}})
+    except AttributeError:
+        key = None
+    if key is not None and key in _TtNiT_cache:
+        return _TtNiT_cache[key]
+    TtNiT = build_TtNiT(templates, Ni)
+    try:
+        cho = np.linalg.cholesky(TtNiT)
+    except np.linalg.LinAlgError:
+        cho = None
+    if key is not None and _TtNiT_cache_size > 0:
+        while len(_TtNiT_cache) >= _TtNiT_cache_size:
+            del _TtNiT_cache[next(iter(_TtNiT_cache))]
+        _TtNiT_cache[key] = (TtNiT, cho)
+    return TtNiT, cho
 
 
 class template_map(template):
@@ -78,6 +136,12 @@ class template_map(template):
     def dot(self, map):
         return [(self.map * map).sum()]
 
+    def dots(self, maps):
+        return np.dot(np.reshape(maps, (len(maps), -1)), self.map.flatten())[:, None]
+
+    def hashdict(self):
+        return {'map': npy_hash(self.map, astype=np.float64)}
+
 
 class template_uptolmin(template):
     def __init__(self, ellmat, lmin):
@@ -110,6 +174,20 @@ class template_uptolmin(template):
         assert tmap.shape == self.lib_alm.shape
         return self._alm2rlm(self.lib_alm.map2alm(tmap)) * self.lib_alm.nbar()
 
+    def apply_modes(self, tmaps, modes):
+        assert tmaps.shape[1:] == self.lib_alm.shape and len(tmaps) == len(modes), (tmaps.shape, len(modes))
+        rlms = np.zeros((len(modes), self.nmodes))
+        rlms[np.arange(len(modes)), modes] = 1.
+        tmaps *= self.lib_alm.alms2maps(self.conv.rlms2datalms(len(modes), rlms.flatten()))
+
+    def dots(self, tmaps):
+        assert tmaps.shape[1:] == self.lib_alm.shape, tmaps.shape
+        rlms = self.conv.datalms2rlms(len(tmaps), self.lib_alm.maps2alms(tmaps))
+        return rlms.reshape(len(tmaps), self.nmodes) * self.lib_alm.nbar()
+
+    def hashdict(self):
+        return {'lmin': self.lmin, 'lib_alm': self.lib_alm.hashdict()}
+
 class template_ellfilt(template):
     def __init__(self, ellmat,filt_func):
         try:
@@ -140,6 +218,20 @@ class template_ellfilt(template):
         assert tmap.shape == self.lib_alm.shape
         return self._alm2rlm(self.lib_alm.map2alm(tmap)) * self.lib_alm.nbar() # (norm. totally irrelevant in principle)
 
+    def apply_modes(self, tmaps, modes):
+        assert tmaps.shape[1:] == self.lib_alm.shape and len(tmaps) == len(modes), (tmaps.shape, len(modes))
+        rlms = np.zeros((len(modes), self.nmodes))
+        rlms[np.arange(len(modes)), modes] = 1.
+        tmaps *= self.lib_alm.alms2maps(self.conv.rlms2datalms(len(modes), rlms.flatten()))
+
+    def dots(self, tmaps):
+        assert tmaps.shape[1:] == self.lib_alm.shape, tmaps.shape
+        rlms = self.conv.datalms2rlms(len(tmaps), self.lib_alm.maps2alms(tmaps))
+        return rlms.reshape(len(tmaps), self.nmodes) * self.lib_alm.nbar()
+
+    def hashdict(self):
+        return {'lib_alm': self.lib_alm.hashdict()}
+
 
 class template_pol:
     """
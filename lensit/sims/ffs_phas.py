@@ -2,6 +2,8 @@ import numpy as np
 import os
 
 from lensit.sims import sims_generic
+from lensit.misc.misc_utils import enumerate_progress
+from lensit.pbs import pbs
 
 
 class _lib_ffsphas(sims_generic.sim_lib):
@@ -42,13 +44,45 @@ class _pix_lib_phas(sims_generic.sim_lib):
         return {'shape': self.shape}
 
 
+def _generate(libs, nsims, label=''):
+    """Stores the rng states of the first nsims sims of the field libraries.
+
+        Seeded libraries distribute the sims over the mpi ranks, by sim index. Unseeded
+        libraries depend on the order of generation, and are generated serially on rank 0.
+
+    """
+    if np.all([lib.seed is not None for lib in libs]):
+        idxs = np.arange(nsims, dtype=int)[pbs.rank::pbs.size]
+        for i, lib in enumerate_progress(libs, label=label):
+            lib.store_states(idxs)
+    elif pbs.rank == 0:
+        for i, idx in enumerate_progress(np.arange(nsims, dtype=int), label=label):
+            for lib in libs:
+                lib.get_sim(int(idx), phas_only=True)
+    pbs.barrier()
+    missing = [(idf, idx) for idf, lib in enumerate(libs) for idx in range(nsims) if not lib.is_stored(idx)]
+    assert len(missing) == 0, ('phases generation failed', missing[:10], len(missing))
+
+
+def _field_seed(seed, idf):
+    """Seed of field idf of a library with this (integer or sequence of integers) seed"""
+    return tuple(int(s) for s in np.atleast_1d(seed)) + (idf,)
+
+
 class ffs_lib_phas:
-    def __init__(self, lib_dir, nfields, lib_alm, **kwargs):
+    def __init__(self, lib_dir, nfields, lib_alm, seed=None, **kwargs):
         self.lib_alm = lib_alm
         self.nfields = nfields
         self.lib_phas = {}
         for i in range(nfields):
-            self.lib_phas[i] = _lib_ffsphas(os.path.join(lib_dir, 'ffs_pha_%04d' % i), lib_alm, **kwargs)
+            self.lib_phas[i] = _lib_ffsphas(os.path.join(lib_dir, 'ffs_pha_%04d' % i), lib_alm,
+                                            seed=None if seed is None else _field_seed(seed, i), **kwargs)
+
+    def generate(self, nsims, label='Generating phases'):
+        """Generates the phases of sims 0 to nsims - 1, distributed over the mpi ranks
+
+        """
+        _generate([self.lib_phas[i] for i in range(self.nfields)], nsims, label=label)
 
     def is_full(self):
         return np.all([lib.is_full() for lib in self.lib_phas.values()])
@@ -64,12 +98,19 @@ class ffs_lib_phas:
 
 
 class pix_lib_phas:
-    def __init__(self, lib_dir, nfields, shape, **kwargs):
+    def __init__(self, lib_dir, nfields, shape, seed=None, **kwargs):
         self.nfields = nfields
         self.lib_pix = {}
         self.shape = shape
         for i in range(nfields):
-            self.lib_pix[i] = _pix_lib_phas(os.path.join(lib_dir, 'pix_pha_%04d'%i), shape, **kwargs)
+            self.lib_pix[i] = _pix_lib_phas(os.path.join(lib_dir, 'pix_pha_%04d'%i), shape,
+                                            seed=None if seed is None else _field_seed(seed, i), **kwargs)
+
+    def generate(self, nsims, label='Generating phases'):
+        """Generates the phases of sims 0 to nsims - 1, distributed over the mpi ranks
+
+        """
+        _generate([self.lib_pix[i] for i in range(self.nfields)], nsims, label=label)
 
     def is_full(self):
         return np.all([lib.is_full() for lib in self.lib_pix.values()])
@@ -6,6 +6,7 @@ import six
 import os, io
 import pickle as pk
 import operator
+import zlib
 
 from lensit.pbs import pbs
 
@@ -71,6 +72,19 @@ class rng_db:
         except:
             print("rng_db::rngdb delete %s failed!" % idx)
 
+def seeded_state(seed):
+    """ np.random rng state initialized with this seed (integer or sequence of integers) """
+    return np.random.RandomState(seed).get_state()
+
+def path_seed(path):
+    """ Seed derived from a path, e.g. of a library relative to the lensit directory.
+
+        Libraries at different locations get independent realisations, identical across machines and processes.
+
+    """
+    return zlib.crc32(path.encode('utf-8')) & 0xffffffff
+
+
 class sim_lib(object):
     """
     Generic class for simulations where only rng state is stored.
@@ -79,12 +93,15 @@ class sim_lib(object):
     By default the rng state function is np.random.get_state.
     The rng_db class is tuned for this state fct, you may need to adapt this.
 
+    If a seed is given, the rng state of sim idx is instead seeded with (seed, idx), and does not depend on the order
+    or on the process in which the sims are generated.
+
     Subclass the ._build_sim_from_rng routine and .hashdict and .get_ callables
 
     jcarron Nov. 2015.
     """
 
-    def __init__(self, lib_dir, get_state_func=np.random.get_state, nsims_max=None):
+    def __init__(self, lib_dir, get_state_func=np.random.get_state, nsims_max=None, seed=None):
         if not os.path.exists(lib_dir) and pbs.rank == 0:
             os.makedirs(lib_dir)
         self.nmax = nsims_max
@@ -97,6 +114,18 @@ class sim_lib(object):
 
         self._rng_db = rng_db(os.path.join(lib_dir, 'rngdb.db'), idtype='INTEGER')
         self._get_rng_state = get_state_func
+        self.seed = seed
+
+    def get_seed(self, idx):
+        """ Seed of the rng state of sim idx (seeded libraries only) """
+        assert self.seed is not None
+        return [int(s) for s in np.atleast_1d(self.seed)] + [int(idx)]
+
+    def store_states(self, idxs):
+        """ Stores the rng states of the sims idxs not stored yet (seeded libraries only). """
+        for idx in idxs:
+            if not self.is_stored(int(idx)):
+                self._rng_db.add(int(idx), seeded_state(self.get_seed(idx)))
 
     def get_sim(self, idx, **kwargs):
         """ Returns sim number idx """
@@ -105,7 +134,7 @@ class sim_lib(object):
             # Checks that the sim idx - 1 was previously calculated :
             # if idx > 0 : assert self.is_stored(idx - 1),\
             #    "sim_lib::sim %s absent from the database while calling sim %s"%(str(idx-1),str(idx))
-            self._rng_db.add(idx, self._get_rng_state())
+            self._rng_db.add(idx, self._get_rng_state() if self.seed is None else seeded_state(self.get_seed(idx)))
         return self._build_sim_from_rng(self._rng_db.get(idx), **kwargs)
 
     def has_nmax(self):
@@ -14,7 +14,7 @@ def configuration(parent_package='', top_path=''):
 setup(
     name='lensit',
     packages=['lensit', 'lensit.qcinv', 'lensit.ffs_covs', 'lensit.ffs_deflect',
-              'lensit.pbs', 'lensit.misc', 'lensit.pseudocls', 'lensit.ffs_iterators'],
+              'lensit.pbs', 'lensit.misc', 'lensit.pseudocls', 'lensit.ffs_iterators', 'lensit.benchmarks'],
     data_files=[('lensit/data/cls', ['lensit/data/cls/fiducial_flatsky_lensedCls.dat',
                                          'lensit/data/cls/fiducial_flatsky_lenspotentialCls.dat',
                                          'lensit/data/cls/fiducial_params_tensor.ini',
@@ -43,6 +43,142 @@ def test_biases():
     assert np.all(N0s[1][ell] == 0.)
 
 
+def test_N0cache():
+    import shutil
+    import time
+    import pickle as pk
+    import lensit as li
+    from lensit.ffs_covs import ffs_cov
+    isocov = li.get_isocov('S4', 6, 6)
+    lib_dir = os.path.join(os.environ['LENSIT'], 'temp', '_testN0cache')
+    assert not os.path.exists(lib_dir), lib_dir
+    cov = ffs_cov.ffs_diagcov_alm(lib_dir, isocov.lib_datalm, isocov.cls_unl, isocov.cls_len, isocov.cl_transf,
+                                  isocov.cls_noise, lib_skyalm=isocov.lib_skyalm)
+    lib_qlm = cov.lib_skyalm
+    cache_dir = os.path.join(lib_dir, 'N0cache')
+    cls = [{k: (1. + 0.1 * i) * cl for k, cl in cov.cls_len.items()} for i in range(3)]
+    N0s = [cov.get_N0cls('QU', lib_qlm, cls_obs=cls[i]) for i in range(2)]
+    fnames = sorted(os.listdir(cache_dir))
+    assert len(fnames) == 2, fnames
+    assert not np.allclose(N0s[0][0], N0s[1][0])
+    assert np.all(cov.get_N0cls('QU', lib_qlm, cls_obs=cls[0])[0] == N0s[0][0])
+    assert sorted(os.listdir(cache_dir)) == fnames
+    # Over budget, the least recently used entry goes first
+    t = time.time()
+    for i, fname in enumerate(fnames):
+        os.utime(os.path.join(cache_dir, fname), (t - 100 + 10 * i, t - 100 + 10 * i))
+    maxbytes = ffs_cov._N0cache_maxbytes
+    ffs_cov._N0cache_maxbytes = int(2.5 * os.path.getsize(os.path.join(cache_dir, fnames[0])))
+    try:
+        cov.get_N0cls('QU', lib_qlm, cls_obs=cls[2])
+    finally:
+        ffs_cov._N0cache_maxbytes = maxbytes
+    left = os.listdir(cache_dir)
+    assert len(left) == 2 and fnames[0] not in left and fnames[1] in left, (fnames, left)
+    # Iterated N0 directories are checked against the covariance they are built for
+    N0iter = cov.iterateN0cls('QU', lib_qlm, 1)
+    assert np.all(cov.iterateN0cls('QU', lib_qlm, 1) == N0iter)
+    N0iter_dir, = [os.path.join(lib_dir, 'QU_N0iter', d) for d in os.listdir(os.path.join(lib_dir, 'QU_N0iter'))]
+    fn = os.path.join(N0iter_dir, 'cov_hash.pk')
+    h = pk.load(open(fn, 'rb'))
+    h['cl_transf'] = 'stale'
+    pk.dump(h, open(fn, 'wb'), protocol=2)
+    try:
+        cov.iterateN0cls('QU', lib_qlm, 1)
+        assert 0, 'stale N0iter directory not detected'
+    except AssertionError as e:
+        assert 'stale' not in str(e), e
+    shutil.rmtree(lib_dir)
+
+
+def test_response_flexible():
+    import lensit as li
+    from concurrent.futures import ThreadPoolExecutor
+    from lensit.ffs_qlms import qlms
+    isocov = li.get_isocov('S4', 8, 8)
+    lib_alm = isocov.lib_datalm
+    cl_transf = {'t': isocov.cl_transf, 'e': isocov.cl_transf, 'b': isocov.cl_transf}
+    cls_noise = {'tt': isocov.cls_noise['t'], 'ee': isocov.cls_noise['q'], 'bb': isocov.cls_noise['u']}
+    R = isocov.get_response('TQU', isocov.lib_skyalm)
+    with ThreadPoolExecutor(4) as ex:
+        for maxbytes, executor in [(2 ** 28, None), (1, ex)]:
+            r = qlms.get_response_flexible(lib_alm, lib_alm, lib_alm, isocov.cls_len, cl_transf, cls_noise,
+                                           isocov.lib_skyalm, maxbytes=maxbytes, executor=executor)
+            for _r, _R in zip(r, R[:2]):
+                assert np.max(np.abs(_r - _R)) < 1e-12 * np.max(np.abs(_R))
+
+
+def test_delensingcorrbias():
+    import lensit as li
+    from concurrent.futures import ThreadPoolExecutor
+    from lensit.ffs_covs import ffs_specmat as pmat
+    isocov = li.get_isocov('S4', 8, 8)
+    lib_dat, lib_qlm = isocov.lib_datalm, isocov.lib_skyalm
+    alwfcl = li.get_fidcls()[0]['pp'][:lib_qlm.ellmax + 1]
+    ik_d, ik_q = [lib_dat.get_iky(), lib_dat.get_ikx()], [lib_qlm.get_iky(), lib_qlm.get_ikx()]
+    TQUalms, args = isocov._get_delensingcorrbias_TQUalms, []
+    isocov._get_delensingcorrbias_TQUalms = lambda *a, **kw: args.append(a) or TQUalms(*a, **kw)
+    cls_noise = {k: isocov.cls_noise[k] / isocov.cl_transf[:len(isocov.cls_noise[k])] ** 2 for k in isocov.cls_noise}
+    for typ in ['QU', 'TQU']:
+        isocov.get_delensingcorrbias(typ, lib_qlm, alwfcl)
+        ACmj, BCamj = args[-1][2:4]
+        # Previous implementation, products and transforms redone for each (a, b, i, j, m)
+        n = len(typ)
+        datcl = lambda l, j: pmat.get_datPmat_ij('TQU', lib_dat, isocov.cls_len, np.ones_like(isocov.cl_transf),
+                                                 cls_noise, l + (typ == 'QU'), j)
+        pmati = lambda k, l: isocov._get_pmati(typ, k, l, use_cls_len=True)
+        A = lambda k, m: lib_dat.almxfl(pmati(m, k), isocov.cl_transf ** 2)
+        B = lambda a, l, m: lib_dat.almxfl(sum([pmat.get_unlPmat_ij(typ, lib_dat, isocov.cls_len, m, i) * pmati(i, l)
+                                                for i in range(n)]), isocov.cl_transf ** 2) * ik_d[a]
+        AC = lambda m, j: sum([A(k, m) * datcl(k, j) for k in range(n)])
+        BC = lambda a, m, j: sum([B(a, l, m) * datcl(l, j) for l in range(n)])
+        retalms = np.zeros((3, 3, lib_dat.alm_size), dtype=complex)
+        for a in [0, 1]:
+            for b in [0, 1]:
+                Hab = lib_qlm.alm2map(alwfcl[lib_qlm.reduced_ellmat()] * ik_q[a] * ik_q[b])
+                for i in range(3):
+                    for j in range(3):
+                        for m in range(n):
+                            retalms[i, j] += lib_dat.map2alm(Hab * lib_dat.alm2map((AC(m, i) * ik_d[a]).conjugate())) * BC(b, m, j)
+                            retalms[i, j] += lib_dat.map2alm(Hab * lib_dat.alm2map((BC(b, m, i) * ik_d[a]).conjugate())) * AC(m, j)
+        for m in range(n):
+            for j in range(3):
+                assert np.allclose(ACmj[m, j], AC(m, j), rtol=1e-12, atol=0.)
+                for a in [0, 1]:
+                    assert np.allclose(BCamj[a, m, j], BC(a, m, j), rtol=1e-12, atol=0.)
+        with ThreadPoolExecutor(4) as ex:
+            for executor in [None, ex]:
+                ret = TQUalms(lib_qlm, alwfcl, ACmj, BCamj, executor=executor)
+                assert np.max(np.abs(ret - retalms)) < 1e-12 * np.max(np.abs(retalms))
+
+
+def test_apply_signal_mem():
+    import tracemalloc
+    import lensit as li
+    from lensit.ffs_covs import ffs_cov
+    from lensit.ffs_deflect import ffs_deflect
+    isocov = li.get_isocov('S4', 10, 10)
+    lib_skyalm = isocov.lib_skyalm
+    rng = np.random.RandomState(0)
+    g = lambda n: rng.standard_normal(n) + 1j * rng.standard_normal(n)
+    plm = lib_skyalm.almxfl(g(lib_skyalm.alm_size), np.sqrt(0.5 * isocov.cls_unl['pp'][:lib_skyalm.ellmax + 1]))
+    f = ffs_deflect.displacement_fromplm(lib_skyalm, plm)
+    cov = ffs_cov.ffs_lencov_alm(os.path.join(os.environ['LENSIT'], 'temp', 'test_lencov'), isocov.lib_datalm, lib_skyalm,
+                                 isocov.cls_unl, isocov.cls_len, isocov.cl_transf, isocov.cls_noise, f, f)
+    alms = np.array([g(isocov.lib_datalm.alm_size) for i in range(3)])
+    ret = cov._apply_signal('TQU', alms)  # allocates the work buffer
+    tracemalloc.start()
+    assert np.all(cov._apply_signal('TQU', alms) == ret)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    # about 5.2 maps with the sky alms work buffer, 6.6 maps before
+    assert peak < 6 * 8 * np.prod(lib_skyalm.ell_mat.shape), peak
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=2) as ex:  # concurrent calls do not share the work buffer
+        rets = list(ex.map(lambda i: cov._apply_signal('TQU', alms), range(4)))
+    assert np.all([np.all(r == ret) for r in rets])
+
+
 def test_iters4():
     import lensit as li
     from lensit.ffs_iterators.ffs_iterator import ffs_iterator_pertMF
@@ -121,7 +257,6 @@ def test_iters4():
     lib_dir = os.path.join(os.environ['LENSIT'], 'temp', '_testiterator_S4_sim%03d_456EF' % 0)
     assert not os.path.exists(lib_dir), lib_dir
     itlib = get_itlib(lib_dir, plm0, lib_qlm, datalms, lib_datalm, H0)
-    itlib.soltn_cond = True
     for i in range(11):
         itlib.iterate(i, 'p')
 
@@ -133,9 +268,507 @@ def test_iters4():
     import shutil
     shutil.rmtree(itlib.lib_dir)
 
+def _cli(cl):
+    return np.where(cl > 0, 1. / np.where(cl > 0, cl, 1.), 0.)
+
+
+def _get_starting_point(idx, LDres, HDres, nsims=1, noiseless=False):
+    """S4 polarization data of sim idx, and normalised Wiener-filtered quadratic estimate starting the iterations
+
+    """
+    import lensit as li
+    sims = li.get_maps_lib('S4', LDres, HDres, nsims=nsims)
+    isocov = li.get_isocov('S4', LDres, HDres)
+    lib_qlm = isocov.lib_skyalm
+    qumaps = sims.get_sim_qumap(idx)
+    if noiseless:
+        qumaps = qumaps - np.array([sims.get_noise_sim_qmap(idx), sims.get_noise_sim_umap(idx)])
+    datalms = np.array([isocov.lib_datalm.map2alm(m) for m in qumaps])
+    H0len = _cli(isocov.get_N0cls('QU', lib_qlm, use_cls_len=True)[0])
+    plm0 = 0.5 * isocov.get_qlms('QU', isocov.get_iblms('QU', datalms, use_cls_len=True)[0], lib_qlm,
+                                 use_cls_len=True)[0]
+    cpp_prior = li.get_fidcls()[0]['pp'][:lib_qlm.ellmax + 1]
+    lib_qlm.almxfl(plm0, _cli(H0len + _cli(cpp_prior)), inplace=True)
+    H0 = _cli(isocov.get_N0cls('QU', lib_qlm, use_cls_len=False)[0])
+    return plm0, lib_qlm, datalms, isocov.lib_datalm, H0, cpp_prior
+
+
+def _get_filt(lib_datalm):
+    """S4 filter with unlensed spectra, and its multigrid chain with diagonal preconditioner
+
+    """
+    import lensit as li
+    from lensit.misc.misc_utils import gauss_beam
+    lib_skyalm = li.ffs_covs.ell_mat.ffs_alm_pyFFTW(lib_datalm.ell_mat, filt_func=lambda ell: ell <= 6000)
+    transf = gauss_beam(3. / 180. / 60. * np.pi, lmax=6000)
+    filt = li.qcinv.ffs_ninv_filt_ideal.ffs_ninv_filt(lib_datalm, lib_skyalm, li.get_fidcls(6000)[0], transf, 1.5,
+                                                      1.5 * np.sqrt(2.))
+    return filt, li.qcinv.chain_samples.get_isomgchain(filt.lib_skyalm.ellmax, filt.lib_datalm.shape, tol=1e-6,
+                                                       iter_max=200)
+
+
+def _get_itlib(lib_dir, start, filt_chain=None, **kwargs):
+    """Polarization pertMF iterator from a *_get_starting_point* output
+
+    """
+    import lensit as li
+    from lensit.ffs_iterators.ffs_iterator import ffs_iterator_pertMF
+    plm0, lib_qlm, datalms, lib_datalm, H0, cpp_prior = start
+    filt, chain_descr = _get_filt(lib_datalm) if filt_chain is None else filt_chain
+    opfilt = li.qcinv.opfilt_cinv_noBB
+    opfilt._type = 'QU'
+    return ffs_iterator_pertMF(lib_dir, 'QU', filt, datalms, lib_qlm, plm0, H0, cpp_prior, chain_descr=chain_descr,
+                               opfilt=opfilt, verbose=False, **kwargs)
+
+
+def test_MSC_binned():
+    from lensit.ffs_covs import ell_mat
+    from lensit.pseudocls import ffs_MSC
+    ellmat = ell_mat.ell_mat(os.path.join(os.environ['LENSIT'], 'temp', 'ellmat_msc'), (64, 64), (np.pi / 45.,) * 2, cache=0)
+    lib_alm = ell_mat.ffs_alm_pyFFTW(ellmat, filt_func=lambda ell: ell <= 3000)
+    x, y = np.meshgrid(np.arange(64), np.arange(64))
+    mask = ((np.abs(x - 32) < 16) & (np.abs(y - 32) < 20)).astype(float)
+    mask = ffs_MSC.apodize(lib_alm, mask, sigma_fwhm_armin=20.)
+    lmax = 1000
+    ii, = np.where(lib_alm.get_Nell()[:lmax + 1] > 0)
+    pbins = ffs_MSC.get_binmat(lmax, ii, np.arange(100, lmax, 100), w=lambda ell: ell * (ell + 1.))
+    tbins = ffs_MSC.get_binmat(lmax, ii, np.arange(100, lmax, 100), w=lambda ell: 1. / (ell * (ell + 1.)), meanorsum='sum')
+    for _type, nspec in [('T', 1), ('QU', 3)]:
+        M = ffs_MSC.get_MSCdense(_type, lib_alm, mask, lmax)
+        assert np.allclose(ffs_MSC.get_MSCbinned(_type, lib_alm, mask, lmax, maxbytes=1), M, rtol=0., atol=1e-12 * np.max(np.abs(M)))
+        M = ffs_MSC.get_MSCdense(_type, lib_alm, mask, lmax, full=True)
+        M = np.kron(np.eye(nspec), pbins).dot(M).dot(np.kron(np.eye(nspec), tbins).T)
+        Mb = ffs_MSC.get_MSCbinned(_type, lib_alm, mask, lmax, pbins=pbins, tbins=tbins)
+        assert np.max(np.abs(Mb - M)) < 1e-12 * np.max(np.abs(M))
+
+
+def test_clder_binned():
+    import lensit as li
+    from concurrent.futures import ThreadPoolExecutor
+    from lensit.misc import ffs_clder, misc_utils
+    from lensit.ffs_covs.ell_mat import ffs_alm_pyFFTW
+    ellmat = li.get_ellmat(7, 7)
+    cl_unl, cl_len = li.get_fidcls(ellmax_sky=6000)
+    lmax = 3000
+    ii, = np.where(ellmat.get_Nell()[:lmax + 1] > 0)
+    bins = misc_utils.get_binmat(lmax, ii, np.arange(100, lmax + 1, 200))
+    with ThreadPoolExecutor(2) as ex:
+        for f, _type, arg in [(ffs_clder.get_dcllendclunl_pert, 'T', cl_unl['pp']),
+                              (ffs_clder.get_dcllendclunl_pert, 'QU', cl_unl['pp']),
+                              (ffs_clder.get_dcllendclphi_pert, 'QU', cl_unl)]:
+            M = f(_type, ellmat, lmax, lmax, arg)
+            nspec = 1 if _type == 'T' else 3
+            Bl = np.kron(np.eye(nspec), bins[:, ii])
+            Bu = Bl if f is ffs_clder.get_dcllendclunl_pert else bins[:, ii]
+            M = Bl.dot(M).dot(Bu.T)
+            Mb = f(_type, ellmat, lmax, lmax, arg, lenbins=bins, unlbins=bins, executor=ex, maxbytes=1)
+            assert np.max(np.abs(Mb - M)) < 1e-12 * np.max(np.abs(M))
+    # Reference: column-by-column temperature calculation, one multipole at a time
+    ellmat = li.get_ellmat(5, 5)
+    lmax = 1000
+    libalm = ffs_alm_pyFFTW(ellmat, filt_func=lambda ell: ell >= 0)
+    clpp = np.zeros(libalm.ellmax + 1)
+    clpp[:min(len(clpp), len(cl_unl['pp']))] = cl_unl['pp'][:min(len(clpp), len(cl_unl['pp']))]
+    ikx, iky = libalm.get_ikx(), libalm.get_iky()
+    sigs = [libalm.alm2map(libalm.almxfl(k, clpp)) for k in [ikx ** 2, iky ** 2, ikx * iky]]
+    sigs = [sig - sig[0, 0] for sig in sigs]
+    Nell = libalm.get_Nell()[:lmax + 1]
+    ells, = Nell.nonzero()
+    M = np.zeros((len(ells), len(ells)))
+    for i, l in enumerate(ells):
+        cl = np.zeros(libalm.ellmax + 1)
+        cl[l] = 1. / Nell[l]
+        ones = libalm.alm2map(libalm.almxfl(np.ones(libalm.alm_size, dtype=complex), cl))
+        alm = np.zeros(libalm.alm_size, dtype=complex)
+        for kfac, sig in zip([ikx ** 2, iky ** 2, 2 * ikx * iky], sigs):
+            alm += kfac * libalm.map2alm(sig * ones)
+        M[i] = libalm.bin_realpart_inell(alm)[ells] * Nell[ells]
+    M /= np.sqrt(np.prod(libalm.lsides))
+    Mb = ffs_clder.get_dcllendclunl_pert('T', ellmat, lmax, lmax, cl_unl['pp'])
+    assert np.max(np.abs(Mb - M)) < 1e-10 * np.max(np.abs(M))
+
+
+def test_ffs_converter():
+    import lensit as li
+    from lensit.ffs_covs import ell_mat
+    from lensit.qcinv.utils import ffs_converter
+    ellmat = li.get_ellmat(6, 8)
+    for lmax in [400, 401, ellmat.ellmax]:
+        for lmin in [0, 1]:
+            lib_alm = ell_mat.ffs_alm(ellmat, filt_func=lambda ell: (ell >= lmin) & (ell <= lmax))
+            conv = ffs_converter(lib_alm)
+            for TEBlen in [1, 3]:
+                rlms = np.random.standard_normal(TEBlen * conv.rlms_size)
+                alms = conv.rlms2datalms(TEBlen, rlms)
+                assert np.array_equal(conv.datalms2rlms(TEBlen, alms), rlms)
+                assert np.array_equal(conv.rlms2datalms(TEBlen, conv.datalms2rlms(TEBlen, alms)), alms)
+                pos, neg = lib_alm.get_conj_idc()
+                assert np.array_equal(alms[:, neg], alms[:, pos].conj())
+                assert np.array_equal(lib_alm.rlms2alms(lib_alm.alms2rlms(alms)), alms)
+
+
+def test_TtNiT():
+    import lensit as li
+    from lensit.qcinv import template_removal
+    ellmat = li.get_ellmat(6, 8)
+    Ni = np.random.uniform(0.5, 1.5, ellmat.shape)
+    Ni[:8] = 0.
+    templs = [template_removal.template_uptolmin(ellmat, 600),
+              template_removal.template_ellfilt(ellmat, lambda ell: (ell >= 2000) & (ell <= 2400))]
+    nmodes = np.sum([t.nmodes for t in templs])
+    TtNiT = np.zeros((nmodes, nmodes))
+    offsets = np.cumsum([0] + [t.nmodes for t in templs])
+    for ia, (ta, oa) in enumerate(zip(templs, offsets)):
+        for a in range(ta.nmodes):
+            tmap = np.copy(Ni)
+            ta.apply_mode(tmap, a)
+            for tb, ob in zip(templs[:ia + 1], offsets):
+                TtNiT[oa + a, ob:ob + tb.nmodes] = tb.dot(tmap)
+    TtNiT = np.tril(TtNiT) + np.tril(TtNiT, -1).T
+    assert np.allclose(template_removal.build_TtNiT(templs, Ni, maxbytes=1), TtNiT, rtol=0., atol=1e-12 * np.max(np.abs(TtNiT)))
+    P, cho = template_removal.get_TtNiT_cho(templs, Ni)
+    assert np.allclose(np.dot(cho, cho.T), P) and template_removal.get_TtNiT_cho(templs, Ni)[1] is cho
+
+
+def test_ninv_harmonic():
+    import lensit as li
+    from lensit.qcinv import ffs_ninv_filt
+    isocov = li.get_isocov('S4', 6, 8)
+    lib_datalm, lib_skyalm = isocov.lib_datalm, isocov.lib_skyalm
+    ninv = {f: np.ones(lib_datalm.shape) * 1e4 for f in ['t', 'q', 'u']}
+    filt = ffs_ninv_filt.ffs_ninv_filt(lib_datalm, lib_skyalm, isocov.cls_len, isocov.cl_transf, ninv)
+    ffs_ninv_filt._allow_harmonic = False
+    filt_pix = ffs_ninv_filt.ffs_ninv_filt(lib_datalm, lib_skyalm, isocov.cls_len, isocov.cl_transf, ninv)
+    ffs_ninv_filt._allow_harmonic = True
+    assert filt.get_ninv_path('q') == 'harmonic' and filt_pix.get_ninv_path('q') == 'pixel'
+    assert filt.hashdict() == filt_pix.hashdict()  # same operator, same caches
+    assert filt.degrade((32, 32)).get_ninv_path('t') == 'harmonic'
+    alms = np.array([lib_skyalm.map2alm(np.random.standard_normal(lib_skyalm.shape)) for f in 'QU'])
+    ret, ret_pix = filt.apply_alms('QU', alms, inplace=False), filt_pix.apply_alms('QU', alms, inplace=False)
+    assert np.allclose(ret, ret_pix, rtol=0., atol=1e-12 * np.max(np.abs(ret_pix)))
+    from lensit.ffs_deflect import ffs_deflect
+    dx, dy = [np.random.standard_normal(lib_skyalm.shape) * 1e-4 for i in range(2)]
+    f = ffs_deflect.ffs_displacement(dx, dy, lib_skyalm.lsides)
+    filt_wl = ffs_ninv_filt.ffs_ninv_filt_wl(lib_datalm, lib_skyalm, isocov.cls_unl, isocov.cl_transf, ninv, f, f)
+    ffs_ninv_filt._allow_harmonic = False
+    filt_wlpix = ffs_ninv_filt.ffs_ninv_filt_wl(lib_datalm, lib_skyalm, isocov.cls_unl, isocov.cl_transf, ninv, f, f)
+    ffs_ninv_filt._allow_harmonic = True
+    assert filt_wl.get_ninv_path('q') == 'harmonic' and filt_wlpix.get_ninv_path('q') == 'pixel'
+    ret, ret_pix = filt_wl.apply_alms('QU', alms, inplace=False), filt_wlpix.apply_alms('QU', alms, inplace=False)
+    assert np.allclose(ret, ret_pix, rtol=0., atol=1e-12 * np.max(np.abs(ret_pix)))
+    alm, alm_pix = alms[0].copy(), alms[0].copy()
+    filt_wl.apply_alm('q', alm)
+    filt_wlpix.apply_alm('q', alm_pix)
+    assert np.allclose(alm, alm_pix, rtol=0., atol=1e-12 * np.max(np.abs(alm_pix)))
+
+
+def test_single_precision_filt():
+    import lensit as li
+    from lensit.ffs_deflect import ffs_deflect
+    from lensit.qcinv import ffs_ninv_filt
+    isocov = li.get_isocov('S4', 7, 10)
+    lib_datalm, lib_skyalm = isocov.lib_datalm, isocov.lib_skyalm
+    dx, dy = [np.random.standard_normal(lib_skyalm.shape) * 1e-4 for i in range(2)]
+    f = ffs_deflect.ffs_displacement(dx, dy, lib_skyalm.lsides)
+    ninv = {f: np.random.uniform(0.5, 1.5, lib_datalm.shape) * 1e4 for f in ['q', 'u']}
+    filt = ffs_ninv_filt.ffs_ninv_filt_wl(lib_datalm, lib_skyalm, isocov.cls_unl, isocov.cl_transf, ninv, f, f,
+                                          precision='single')
+    alms = np.array([lib_skyalm.map2alm(np.random.standard_normal(lib_skyalm.shape)) for i in range(2)])
+    ret = filt.apply_alms('QU', alms, inplace=False)
+    ret_dp = filt.apply_alms('QU', alms, inplace=False, precision='double')
+    assert ret.dtype == np.complex128 and filt.degrade((64, 64)).precision == 'single'
+    assert np.max(np.abs(ret - ret_dp)) < 1e-5 * np.max(np.abs(ret_dp))
+
+
+def test_cd_deflation():
+    from lensit.qcinv import cd_solve, cd_monitors
+    np.random.seed(1)
+    n = 200
+    U = np.linalg.qr(np.random.standard_normal((n, n)))[0]
+    dot_op = lambda a, b: np.sum(a * b)
+    defl = cd_solve.deflation_space(nvecs=4, ncollect=12)
+    for k in range(4):  # slowly varying operator with a few small eigenvalues
+        ev = np.concatenate([np.array([1e-3, 2e-3, 5e-3, 1e-2]) * (1. + 0.05 * k), np.linspace(0.5, 2., n - 4)])
+        A = np.dot(U * ev, U.T)
+        b = np.random.standard_normal(n)
+        its = []
+        for d in [None, defl]:
+            x = np.zeros(n)
+            monitor = cd_monitors.monitor_basic(dot_op, iter_max=n, eps_min=1e-8, logger=lambda *args, **kwargs: None)
+            its.append(cd_solve.cd_solve(x, b, lambda v: np.dot(A, v), [lambda v: v.copy()], dot_op, monitor,
+                                         cd_solve.tr_cg, cache=cd_solve.cache_mem(), deflation=d))
+            assert np.allclose(np.dot(A, x), b, atol=1e-6 * np.sqrt(dot_op(b, b)))
+        if k > 0: assert its[1] < its[0], its
+
+def test_taskqueue():
+    from lensit.pbs import pbs
+    queue = pbs.taskqueue([[0, 1], [2, 3], [4]], master_tasks=[[-1]], rank=0, size=1)
+    done = []
+    for idxs in queue:
+        if idxs == [2, 3] and [2, 3] not in done:
+            done.append(idxs)
+            break  # leaving mid-run requeues the current task
+        done.append(idxs)
+    assert done == [[-1], [0, 1], [2, 3]], done
+    assert [idxs for idxs in queue] == [[2, 3], [4]]
+    assert queue.utilisation()[0][0] == 2
+    # Master side with a fake communicator: rank 1 dies with its task, rank 2 gets it once, and the queue ends
+    import time
+    class fake_comm:
+        def __init__(self, requests):
+            self.t0, self.requests, self.sent, self.isent, self.qid = time.time(), requests, [], [], None
+        def Iprobe(self, source=None, tag=None, status=None):
+            if len(self.requests) == 0 or time.time() - self.t0 < self.requests[0][0]: return False
+            status.src = self.requests[0][1]
+            return True
+        def recv(self, source=None, tag=None):
+            t, src, kind = self.requests.pop(0)
+            return self.qid, kind, (0, 0., 0.)
+        def send(self, obj, dest=None, tag=None):
+            self.sent.append((dest, obj[1]))
+        def isend(self, obj, dest=None, tag=None):
+            self.send(obj, dest=dest, tag=tag)
+            request = fake_request()
+            self.isent.append(request)
+            return request
+    class fake_request:
+        done = False
+        def wait(self):
+            self.done = True
+    class fake_MPI:
+        ANY_SOURCE = -1
+        THREAD_SERIALIZED, THREAD_MULTIPLE = 2, 3
+        thread_level = 3
+        @classmethod
+        def Query_thread(cls):
+            return cls.thread_level
+        class Status:
+            def Get_source(self):
+                return self.src
+    fake = fake_comm([(0., 1, 'next'), (0., 2, 'next'), (0.3, 2, 'next'), (0.4, 2, 'next'), (0.5, 2, 'next')])
+    comm, MPI = pbs.comm, getattr(pbs, 'MPI', None)
+    pbs.comm, pbs.MPI = fake, fake_MPI
+    try:
+        fake.qid = pbs._nqueues + 1
+        queue = pbs.taskqueue([['a'], ['b']], timeout=0.1, rank=0, size=3)
+        queue._thread.join(5.)
+        assert not queue._thread.is_alive(), 'queue still waiting for a dead rank'
+        # Without MPI_THREAD_MULTIPLE, a static round-robin share of the tasks
+        fake_MPI.thread_level = fake_MPI.THREAD_SERIALIZED
+        static = [pbs.taskqueue(list(range(7)), master_tasks=[-1], rank=r, size=3) for r in range(3)]
+        assert [list(queue) for queue in static] == [[-1, 0, 3, 6], [1, 4], [2, 5]]
+        assert np.all([queue._thread is None for queue in static])
+    finally:
+        pbs.comm, pbs.MPI = comm, MPI
+    assert fake.sent == [(1, ['a']), (2, ['b']), (2, ['a']), (2, None), (1, None)], fake.sent
+    assert len(fake.isent) == 1 and fake.isent[0].done  # the release of rank 1 is completed
+    assert len(fake.requests) == 1  # rank 2 left with its None, its last request goes unanswered
+
+def test_qlms_stacks():
+    import shutil
+    import lensit as li
+    from lensit.ffs_qlms import qlms as ql
+    from lensit.qcinv import multigrid
+    from lensit.sims import ffs_phas
+    plm0, lib_qlm, datalms, lib_datalm, H0, cpp_prior = _get_starting_point(0, 6, 7, noiseless=True)
+    filt, chain_descr = _get_filt(lib_datalm)
+    lib_sky = filt.lib_skyalm
+    rng = np.random.RandomState(1)
+    rand = lambda nsims: np.array([[lib_sky.map2alm(rng.standard_normal(lib_sky.shape)) for i in range(2)]
+                                   for j in range(nsims)])
+    Mliks, Res = rand(3), rand(3)
+    cls_unl = li.get_fidcls(6000)[0]
+    lib_dir = os.path.join(os.environ['LENSIT'], 'temp', '_testqlms_stacks')
+    assert not os.path.exists(lib_dir), lib_dir
+    opfilt = li.qcinv.opfilt_cinv_noBB
+    opfilt._type = 'QU'
+    MFest = ql.MFestimator(filt, opfilt, multigrid.get_chain({}, opfilt, 'QU', chain_descr, filt), lib_qlm,
+                           pix_pha=ffs_phas.pix_lib_phas(lib_dir, 2, lib_datalm.shape, seed=1))
+    nsims_chunk = ql.nsims_chunk
+    ql.nsims_chunk = 2  # stacks of 3 are done in two chunks
+    try:
+        stacks = [ql.get_qlms_wl('QU', lib_sky, Mliks, Res, lib_qlm),
+                  ql.get_qlms('QU', lib_sky, Res, cls_unl, lib_qlm),
+                  MFest.get_MFqlms('QU', 12, [0, 1, 2])]
+    finally:
+        ql.nsims_chunk = nsims_chunk
+    singles = [[ql.get_qlms_wl('QU', lib_sky, _M, _R, lib_qlm) for _M, _R in zip(Mliks, Res)],
+               [ql.get_qlms('QU', lib_sky, _R, cls_unl, lib_qlm) for _R in Res],
+               [MFest.get_MFqlms('QU', 12, idx) for idx in range(3)]]
+    for stack, single in zip(stacks, singles):
+        assert stack.shape == (3, 2, lib_qlm.alm_size), stack.shape
+        assert np.allclose(stack, np.array(single), rtol=1e-10, atol=1e-10 * np.max(np.abs(stack)))
+    shutil.rmtree(lib_dir)
+
+def test_wolfe_linesearch():
+    from lensit.ffs_iterators import bfgs
+    phi = lambda a: (a - 3.) ** 4 - 2. * a
+    dphi = lambda a: 4. * (a - 3.) ** 3 - 2.
+    rule = bfgs.wolfe_linesearch(c2=0.5, step_max=10.)
+    a = rule(1, 1., phi, dphi)
+    assert phi(a) <= phi(0.) + rule.c1 * a * dphi(0.)
+    assert abs(dphi(a)) <= rule.c2 * abs(dphi(0.)), (a, rule.trials)
+    assert bfgs.fixed_step(0.5)(1, 1., phi, dphi) == 0.5
+
+def test_iterate_until():
+    from lensit.ffs_iterators.ffs_iterator import crit_gradnorm, crit_plmincr, crit_loglik
+    lib_dir = os.path.join(os.environ['LENSIT'], 'temp', '_testiterate_until')
+    assert not os.path.exists(lib_dir), lib_dir
+    itlib = _get_itlib(lib_dir, _get_starting_point(0, 8, 9, noiseless=True))
+    criteria = [crit_gradnorm(0.05), crit_plmincr(1e-3), crit_loglik(1e-2)]
+    it, reason = itlib.iterate_until(criteria, 15)
+    assert it < 15 and 'converged' in reason, (it, reason)
+    assert np.any([crit(itlib, it, 'p')[1] for crit in criteria])
+    assert crit_plmincr(1e-3, ellbins=(10000, 20000))(itlib, it, 'p') == (np.inf, False)
+    assert crit_loglik(1.)(itlib, 1, 'p') == (np.inf, False) and crit_loglik(1.)(itlib, 2, 'p')[0] == 1.
+    assert 0. < crit_loglik(1.)(itlib, it, 'p')[0] < crit_loglik(1.)(itlib, it - 1, 'p')[0]
+    assert not os.path.exists(os.path.join(lib_dir, 'Phi_plm_it%03d.npy' % (it + 1)))
+    # The line model is only built when a step rule evaluates it
+    from lensit.ffs_iterators import bfgs
+    phi, dphi = itlib.get_linemodel(it, 'p', None, None)
+    assert bfgs.fixed_step(0.5)(it, 1., phi, dphi) == 0.5
+    ffinv = np.loadtxt(os.path.join(lib_dir, 'cghistories', 'history_ffinv.txt'), usecols=(0, 2, 3), ndmin=2)
+    assert list(ffinv[:, 0]) == list(range(it)) and np.all(ffinv[:, 1:] >= 0.), ffinv
+    import shutil
+    shutil.rmtree(lib_dir)
+
+def test_f_storage():
+    start = _get_starting_point(0, 6, 7, noiseless=True)
+    plm0 = start[0]
+    lib_dir = os.path.join(os.environ['LENSIT'], 'temp', '_testf_storage')
+    assert not os.path.exists(lib_dir), lib_dir
+    def displacements(storage, **kwargs):
+        itlib = _get_itlib(os.path.join(lib_dir, storage), start, f_storage=storage, **kwargs)
+        for it in range(1, 4):
+            itlib.cache_qlm(os.path.join(itlib.lib_dir, 'Phi_plm_it%03d.npy' % it), (1. + 0.1 * it) * plm0)
+        for it in range(4):
+            itlib._calc_ffinv(it, 'p')
+        ref = [(itlib._load_f(it, 'p').get_dx(), itlib._load_finv(it, 'p').get_dx()) for it in range(4)]
+        itlib._apply_f_storage('p')
+        return itlib, ref
+    itlib, ref = displacements('float32', f_nkeep=2)
+    assert itlib._get_f_its('p') == [0, 1, 2, 3]
+    for it in range(4):
+        dtypes = [np.load(fn, mmap_mode='r').dtype for fn in itlib._getfnames_f('p', it) + itlib._getfnames_finv('p', it)]
+        assert np.all([dtype == (np.float32 if it < 2 else np.float64) for dtype in dtypes]), (it, dtypes)
+    assert np.allclose(itlib._load_f(0, 'p').get_dx(), ref[0][0], rtol=1e-6)
+    itlib, ref = displacements('plm', f_nkeep=2)
+    assert itlib._get_f_its('p') == [2, 3]
+    assert not os.path.exists(os.path.join(itlib.lib_dir, 'finv_0000_libdir'))
+    assert np.all(itlib._load_f(0, 'p').get_dx() == ref[0][0])  # regenerated from the plm
+    assert np.all(itlib._load_finv(1, 'p').get_dx() == ref[1][1])
+    itlib, ref = displacements('plm', f_budget=1e-12)  # evicts all but the last one, oldest first
+    assert itlib._get_f_its('p') == [3]
+    open(itlib._getfnames_f('p', 1000)[0], 'w').close()
+    assert itlib._get_f_its('p') == [3, 1000]
+    import shutil
+    shutil.rmtree(lib_dir)
+
+def test_profiler():
+    from lensit.misc import profiler
+    fname = os.path.join(os.environ['LENSIT'], 'temp', '_testprofiler.jsonl')
+    if os.path.exists(fname): os.remove(fname)
+    for it in range(2):
+        with profiler.phase('gradlik'):
+            for i in range(3):
+                with profiler.phase('cg'): pass
+        profiler.dump(fname, it=it, rank=0)
+    records = profiler.load([fname])
+    assert len(records) == 2 and records[1]['phases']['gradlik/cg']['count'] == 3
+    assert profiler.aggregate(records)['gradlik/cg']['count'] == 6
+    assert 'cg' in profiler.summary(records)
+    os.remove(fname)
+
+def test_iterator_multi():
+    import lensit as li
+    from lensit.ffs_iterators.ffs_iterator import ffs_iterator_multi
+    starts = [_get_starting_point(idx, 8, 9, nsims=2) for idx in range(2)]
+    lib_dir = os.path.join(os.environ['LENSIT'], 'temp', '_testiterator_multi')
+    assert not os.path.exists(lib_dir), lib_dir
+    filt, chain_descr = _get_filt(starts[0][3])
+    opfilt = li.qcinv.opfilt_cinv_noBB
+    opfilt._type = 'QU'
+    plm0, lib_qlm, datalms, lib_datalm, H0, cpp_prior = starts[0]
+    itlib = ffs_iterator_multi.from_dat_maps(lib_dir, 'QU', filt, [start[2] for start in starts], lib_qlm,
+                                             [start[0] for start in starts], H0, cpp_prior, chain_descr=chain_descr,
+                                             opfilt=opfilt, verbose=False)
+    itlib0, itlib1 = itlib.itlibs
+    assert itlib1.cov is itlib0.cov and itlib1._mchains is itlib0._mchains and itlib1.isocov is itlib0.isocov
+    assert not os.path.exists(os.path.join(lib_dir, 'map0001', 'isocov'))
+    for it in range(4):
+        plms = itlib.iterate(it, 'p')
+    assert itlib.how_many_iter_done('p') == 4
+    standalone = _get_itlib(os.path.join(lib_dir, 'standalone'), starts[1])
+    for it in range(4):
+        plm = standalone.iterate(it, 'p')
+    assert np.sqrt(np.sum(np.abs(plm - plms[1]) ** 2) / np.sum(np.abs(plm) ** 2)) < 1e-4
+    assert np.sqrt(np.sum(np.abs(plm - plms[0]) ** 2) / np.sum(np.abs(plm) ** 2)) > 1e-1
+    import shutil
+    shutil.rmtree(lib_dir)
+
+def test_lazy_import():
+    import sys, subprocess
+    code = 'import time, sys; t0 = time.time(); import lensit; print(time.time() - t0, "pyfftw" in sys.modules)'
+    out = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+    if sys.version_info >= (3, 7):  # eager imports otherwise
+        assert out[-1] == 'False', 'pyfftw imported by import lensit'
+    import lensit as li
+    assert li.ell_mat is li.ffs_covs.ell_mat and li.qcinv.opfilt_cinv_noBB
+    assert li.get_fidcls()[0]['pp'] is not li.get_fidcls()[0]['pp']  # memoised files, but independent outputs
+    assert np.all(li.get_fidcls(3000)[1]['tt'] == li.get_fidcls()[1]['tt'][:3001])
+
+def test_phas_generation():
+    import shutil
+    import lensit as li
+    from lensit.sims import ffs_phas
+    lib_skyalm = li.get_isocov('S4', 6, 7).lib_datalm
+    lib_dir = os.path.join(os.environ['LENSIT'], 'temp', '_testphas')
+    sims = {}
+    for nranks in [1, 4]:
+        skypha = ffs_phas.ffs_lib_phas(os.path.join(lib_dir, 'sky%s' % nranks), 2, lib_skyalm, nsims_max=8, seed=1)
+        pixpha = ffs_phas.pix_lib_phas(os.path.join(lib_dir, 'pix%s' % nranks), 2, (16, 16), nsims_max=8, seed=2)
+        if nranks == 1:
+            skypha.generate(8)
+            pixpha.generate(8)
+        else:  # the share of each of 4 mpi ranks, in some order
+            for r in [2, 0, 3, 1]:
+                for lib in list(skypha.lib_phas.values()) + list(pixpha.lib_pix.values()):
+                    lib.store_states(np.arange(8)[r::nranks])
+        assert skypha.is_full() and pixpha.is_full()
+        sims[nranks] = [(skypha.get_sim(idx), pixpha.get_sim(idx)) for idx in range(8)]
+    pixpha = ffs_phas.pix_lib_phas(os.path.join(lib_dir, 'pix_ondemand'), 2, (16, 16), nsims_max=8, seed=2)
+    for idx in range(8)[::-1]:  # generation order does not matter
+        assert np.all(pixpha.get_sim(idx) == sims[1][idx][1])
+    for idx in range(8):
+        assert np.all(sims[1][idx][0] == sims[4][idx][0]) and np.all(sims[1][idx][1] == sims[4][idx][1])
+    assert not np.any(sims[1][0][1][0] == sims[1][0][1][1])  # fields and sims are independent
+    assert not np.any(sims[1][0][1][0] == sims[1][1][1][0])
+    from lensit.sims import sims_generic
+    seeds = [sims_generic.path_seed(path) for path in ['a/skypha', 'a/pixpha', 'b/skypha']]
+    assert len(set(seeds)) == 3 and seeds[0] == sims_generic.path_seed('a/skypha')
+    pixpha = ffs_phas.pix_lib_phas(os.path.join(lib_dir, 'pix_tupleseed'), 2, (16, 16), nsims_max=8, seed=(2, 1))
+    assert not np.any(pixpha.get_sim(0)[0] == sims[1][0][1][0])  # other seed, independent realisations
+    shutil.rmtree(lib_dir)
+
+def test_bench():
+    from lensit.benchmarks import runner
+    from lensit import bench
+    fname = os.path.join(os.environ['LENSIT'], 'temp', '_testbench.json')
+    bench.main(['run', '--res', '6,7', '--only', 'alm2map', 'cd_solve', 'iteration', 'get_N0cls_TQU', '--repeat', '2', '-o', fname])
+    results = runner.load(fname)
+    assert [res['name'] for res in results['results']] == ['alm2map', 'cd_solve', 'iteration', 'get_N0cls_TQU']
+    assert len(results['results'][0]['times']) == 2 and results['results'][1]['info']['iterations'] > 0
+    times = results['results'][2]['times']  # the same iteration each time
+    assert len(times) == 2 and max(times) < 3. * min(times), times
+    assert not [d for d in os.listdir(os.path.join(os.environ['LENSIT'], 'temp')) if d.startswith('bench_')]
+    assert 'numpy' in results['metadata'] and 'host' in results['metadata']
+    table = runner.compare(results, results)
+    assert 'cd_solve' in table and '1.00' in table
+    os.remove(fname)
+
 if __name__ == '__main__':
     test_lencmbs()
     test_inverse()
     test_maps()
     test_cl()
-    test_iters4()
\ No newline at end of file
+    test_iters4()